@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Throughput of the storage backends, with the db cache disabled:
+inserts and updates one at a time and in batches, single loads
+and load_many
+
+Usage: python bench/backend_bench.py [records]
+
+Always runs MockDB (in memory - the ceiling), SQLite and LogDB
+(in temp files) and Couch against dammit.fakecouch (so mostly measuring
+HTTP and JSON, not CouchDB). MySQL is added if MySQLdb is
+installed and a server is reachable with the default
+dammit.db_mysql settings, overridden by the DB_HOST, DB_USER,
+DB_PASS environment variables - records go in a scratch
+database, urldammit_bench, which is dropped first
+"""
+import sys, os, time, random, datetime, tempfile, shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dammit'))
+import cachemanager, db_cache
+from nullcache import NullCache
+from uri import URI
+from db_mock import MockDB
+from db_sqlite import SQLite
+from db_log import LogDB
+
+BATCH = 100
+
+def make_uris(n, tag):
+    uris = []
+    now = datetime.datetime.now()
+    for i in xrange(n):
+        u = URI()
+        u.uri = 'http://local.ch/bench/%s.html' % i
+        u.status = 200
+        u.created = now
+        u.updated = now
+        u.tags = [tag, 'tag%s' % (i % 10)]
+        u.pairs = {'title': 'page %s' % i}
+        uris.append(u)
+    return uris
+
+def batches(items):
+    for i in range(0, len(items), BATCH):
+        yield items[i:i + BATCH]
+
+def rate(fn, items, count = None):
+    """
+    fn is called once per item - returns operations per
+    second, counting count operations per item if given
+    """
+    start = time.time()
+    for item in items:
+        fn(item)
+    elapsed = time.time() - start
+    return (count or len(items)) / max(elapsed, 1e-9)
+
+def run(db, records):
+    ids = [u.id for u in make_uris(records, 'ids')]
+    sample = [random.choice(ids) for i in xrange(records)]
+    results = []
+
+    results.append(rate(db.insert, make_uris(records, 'one')))
+    results.append(rate(db.update, make_uris(records, 'two')))
+    results.append(rate(db.insert_many,
+                        list(batches(make_uris(records, 'three'))), records))
+    results.append(rate(db.update_many,
+                        list(batches(make_uris(records, 'four'))), records))
+    results.append(rate(db.load, sample))
+    results.append(rate(db.load_many, list(batches(sample)), records))
+
+    assert db.load(ids[0]).tags[0] == 'four'
+    return results
+
+def couch_backend():
+    from fakecouch import FakeCouch
+    from db_couch import Couch, VIEW_FUNCTIONS
+    couch = FakeCouch(VIEW_FUNCTIONS)
+    return Couch({'db_host': couch.start(), 'db_name': 'bench'}), couch.stop
+
+def log_backend(tmp):
+    def backend():
+        db = LogDB({'log_path': os.path.join(tmp, 'bench.log'),
+                    'compact_interval': 0})
+        return db, db.close
+    return backend
+
+def mysql_backend():
+    from db_mysql import MySQL
+    conf = {'db_name': 'urldammit_bench'}
+    for key in ('db_host', 'db_user', 'db_pass'):
+        if key.upper() in os.environ:
+            conf[key] = os.environ[key.upper()]
+    return MySQL(conf, dropfirst = True), lambda: None
+
+def main(records):
+    cachemanager.register_cache_constructor(lambda namespace: NullCache(), 'db')
+    db_cache.cache_instance = None
+
+    tmp = tempfile.mkdtemp()
+    backends = [
+        ('MockDB', lambda: (MockDB(), lambda: None)),
+        ('SQLite', lambda: (SQLite({'db_path': os.path.join(tmp, 'bench.db')},
+                                   dropfirst = True), lambda: None)),
+        ('LogDB', log_backend(tmp)),
+        ('Couch (fake)', couch_backend),
+        ('MySQL', mysql_backend),
+        ]
+
+    print "%-14s %10s %10s %10s %10s %10s %10s" % (
+        'ops/sec', 'insert', 'update', 'insert*%s' % BATCH,
+        'update*%s' % BATCH, 'load', 'load*%s' % BATCH)
+    try:
+        for name, backend in backends:
+            try:
+                db, stop = backend()
+            except Exception, e:
+                print "%-14s skipped: %s" % (name, e)
+                continue
+            try:
+                print "%-14s %10.0f %10.0f %10.0f %10.0f %10.0f %10.0f" % (
+                    (name, ) + tuple(run(db, records)))
+            finally:
+                stop()
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    records = 2000
+    if len(sys.argv) > 1:
+        records = int(sys.argv[1])
+    main(records)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+HTTP requests to CouchDB per URIManager.register call that
+updates a record: Couch.update writing with the _rev carried
+in uri.meta against the load-then-write update it replaced
+
+Usage: python bench/couch_register_bench.py [records]
+
+Runs against dammit.fakecouch, which counts requests. With the
+db cache disabled every load goes to CouchDB; with a local
+cache warm, register's own load is a hit
+"""
+import sys, os, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dammit'))
+import cachemanager, db_cache
+from nullcache import NullCache
+from uri import URI, URIManager
+from fakecouch import FakeCouch
+from db_couch import Couch, VIEW_FUNCTIONS, uri_to_record
+
+class LoadFirstCouch(Couch):
+    """
+    Couch with the old update, which loaded the record again
+    for its _rev
+    """
+    @db_cache.update
+    def update(self, uri):
+        stored_uri = self.load(uri.id)
+
+        if not stored_uri:
+            self.insert(uri)
+            return
+
+        data = uri_to_record(uri)
+        try:
+            data['_rev'] = stored_uri.meta['_rev']
+        except:
+            pass
+
+        self.db[uri.id] = data
+
+def requests_per_register(backend, cache, records):
+    cachemanager.register_cache_constructor(cache, 'db')
+    db_cache.cache_instance = None
+
+    couch = FakeCouch(VIEW_FUNCTIONS)
+    db = backend({'db_host': couch.start(), 'db_name': 'bench'})
+    manager = URIManager(db)
+
+    uris = ['http://local.ch/bench/%s.html' % i for i in range(records)]
+    for uri in uris:
+        manager.register(uri, tags = ['first'])
+    for uri in uris:
+        manager.load(URI.hash(uri))
+
+    before = len(couch.requests)
+    for uri in uris:
+        manager.register(uri, tags = ['second'])
+    count = len(couch.requests) - before
+    couch.stop()
+    return float(count) / records
+
+def main(records):
+    caches = (
+        ('no db cache', lambda namespace: NullCache()),
+        ('warm db cache', cachemanager.dict_constructor),
+        )
+    print "%-16s %12s %12s" % ('requests/update', 'load first', 'meta _rev')
+    for name, cache in caches:
+        print "%-16s %12.2f %12.2f" % (
+            name,
+            requests_per_register(LoadFirstCouch, cache, records),
+            requests_per_register(Couch, cache, records),
+            )
+
+if __name__ == '__main__':
+    records = 200
+    if len(sys.argv) > 1:
+        records = int(sys.argv[1])
+    main(records)
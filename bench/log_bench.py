@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+dammit.db_log at scale: write throughput, read latency and the
+time to recover (reopen and rebuild the index) with the db
+cache disabled
+
+Usage: python bench/log_bench.py [records] [path]
+
+Defaults to 10M records, in a temp dir unless path is given -
+that's about 2GB of log and some GB of memory for the index.
+Records are written in batches of 1000 (insert_many), except
+the first 10000 which are written one at a time
+"""
+import sys, os, time, random, datetime, tempfile, shutil, resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dammit'))
+import cachemanager, db_cache
+from nullcache import NullCache
+from uri import URI
+from db_log import LogDB
+
+BATCH = 1000
+SINGLE = 10000
+LOADS = 100000
+
+def make_uri(i, now):
+    u = URI()
+    u.uri = 'http://local.ch/bench/%s.html' % i
+    u.status = 200
+    u.created = now
+    u.updated = now
+    u.tags = ['tag%s' % (i % 10)]
+    u.pairs = {'title': 'page %s' % i}
+    return u
+
+def percentile(times, p):
+    return times[min(len(times) - 1, int(len(times) * p))]
+
+def main(records, path):
+    cachemanager.register_cache_constructor(lambda namespace: NullCache(), 'db')
+    db_cache.cache_instance = None
+
+    db = LogDB({'log_path': path, 'compact_interval': 0})
+    now = datetime.datetime.now()
+
+    single = min(SINGLE, records)
+    start = time.time()
+    for i in xrange(single):
+        db.insert(make_uri(i, now))
+    single_rate = single / (time.time() - start)
+
+    start = time.time()
+    for i in xrange(single, records, BATCH):
+        db.insert_many([make_uri(j, now) for j in
+                        xrange(i, min(i + BATCH, records))])
+    batch_rate = (records - single) / max(time.time() - start, 1e-9)
+
+    ids = [URI.hash('http://local.ch/bench/%s.html' % random.randrange(records))
+           for i in xrange(min(LOADS, records))]
+    times = []
+    for id in ids:
+        start = time.time()
+        db.load(id)
+        times.append(time.time() - start)
+    times.sort()
+
+    db.close()
+    size = os.path.getsize(path)
+    start = time.time()
+    db = LogDB({'log_path': path, 'compact_interval': 0})
+    recovery = time.time() - start
+    assert len(db.index) == records
+    db.close()
+
+    print "records            %d" % records
+    print "log size           %.1f MB" % (size / 1e6)
+    print "insert             %.0f/s" % single_rate
+    print "insert_many*%d   %.0f/s" % (BATCH, batch_rate)
+    print "load p50 / p99     %.1f / %.1f usec" % (
+        percentile(times, 0.5) * 1e6, percentile(times, 0.99) * 1e6)
+    print "recovery           %.1f s" % recovery
+    print "max rss            %.0f MB" % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+if __name__ == '__main__':
+    records = 10000000
+    if len(sys.argv) > 1:
+        records = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        main(records, sys.argv[2])
+    else:
+        tmp = tempfile.mkdtemp()
+        try:
+            main(records, os.path.join(tmp, 'bench.log'))
+        finally:
+            shutil.rmtree(tmp)
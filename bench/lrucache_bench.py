@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare dammit.lrucache.LRUCache against the heap based
+implementation it replaced
+
+Usage: python bench/lrucache_bench.py [size ...]
+
+For each size the cache is filled to capacity then timed over
+a mix of hits, overwrites and evicting inserts. The heap based
+cache re-heapifies on every access so it only gets a fraction
+of the operations at the larger sizes - compare the per-op
+figures, not the totals.
+"""
+import sys, os, time, random
+from heapq import heappush, heappop, heapify
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dammit'))
+from lrucache import LRUCache
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+
+class HeapLRUCache(object):
+    """
+    The previous (lrucache 0.2) LRUCache - kept here only
+    as the baseline for this benchmark
+    """
+    class Node(object):
+        def __init__(self, key, obj, timestamp):
+            self.key = key
+            self.obj = obj
+            self.atime = timestamp
+            self.mtime = self.atime
+
+        def __cmp__(self, other):
+            return cmp(self.atime, other.atime)
+
+    def __init__(self, size):
+        self.heap = []
+        self.dict = {}
+        self.size = size
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, key):
+        return self.dict.has_key(key)
+
+    def __setitem__(self, key, obj):
+        if self.dict.has_key(key):
+            node = self.dict[key]
+            node.obj = obj
+            node.atime = time.time()
+            node.mtime = node.atime
+            heapify(self.heap)
+        else:
+            while len(self.heap) >= self.size:
+                lru = heappop(self.heap)
+                del self.dict[lru.key]
+            node = self.Node(key, obj, time.time())
+            self.dict[key] = node
+            heappush(self.heap, node)
+
+    def __getitem__(self, key):
+        node = self.dict[key]
+        node.atime = time.time()
+        heapify(self.heap)
+        return node.obj
+
+def fill(cache, size):
+    for i in xrange(size):
+        cache[i] = i
+
+def workload(size, ops):
+    """
+    80% reads of resident keys, 10% overwrites, 10% new keys
+    """
+    rnd = random.Random(size)
+    plan = []
+    fresh = size
+    for i in xrange(ops):
+        r = rnd.random()
+        if r < 0.8:
+            plan.append(('get', rnd.randrange(size)))
+        elif r < 0.9:
+            plan.append(('set', rnd.randrange(size)))
+        else:
+            plan.append(('set', fresh))
+            fresh += 1
+    return plan
+
+def run(cache, plan):
+    start = time.time()
+    for op, key in plan:
+        if op == 'get':
+            try:
+                cache[key]
+            except KeyError:
+                pass
+        else:
+            cache[key] = key
+    return time.time() - start
+
+def bench(size):
+    # keep the heap cache to roughly comparable wall-clock time
+    heap_ops = max(10, min(20000, 20000000 / size))
+    ops = 200000
+    results = []
+    for name, cls, n in (('heap', HeapLRUCache, heap_ops),
+                         ('linked', LRUCache, ops)):
+        cache = cls(size)
+        fill(cache, size)
+        elapsed = run(cache, workload(size, n))
+        results.append((name, n, elapsed))
+    return results
+
+def main(sizes):
+    print "%10s %8s %10s %14s" % ('size', 'impl', 'ops', 'usec/op')
+    for size in sizes:
+        per_op = {}
+        for name, n, elapsed in bench(size):
+            per_op[name] = elapsed / n * 1e6
+            print "%10d %8s %10d %14.2f" % (size, name, n, per_op[name])
+        print "%10s %8s %10s %13.0fx" % (
+            '', 'speedup', '', per_op['heap'] / per_op['linked'])
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or DEFAULT_SIZES
+    main(sizes)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Latency of loading a record from MySQL: the single UNION ALL
+statement used by MySQL.load against the three queries (uris,
+tags, pairs) it replaced
+
+Usage: python bench/mysql_load_bench.py [records] [loads]
+
+Needs MySQLdb and a MySQL compatible server (MySQL, MariaDB...)
+reachable with the default dammit.db_mysql settings, overridden
+by the DB_HOST, DB_USER, DB_PASS environment variables. Records
+go in a scratch database, urldammit_bench, which is dropped first.
+Each record gets 10 tags and 10 pairs
+"""
+import sys, os, time, random, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dammit'))
+from uri import URI
+from db_mysql import MySQL, uri_data, add_tag, add_pair
+
+def three_queries(cursor, id):
+    """
+    The old MySQL.load
+    """
+    sql = """SELECT
+    uri, location, status, created, updated
+    FROM urldammit_uris WHERE id = %s"""
+    cursor.execute(sql, (id, ))
+    row = cursor.fetchone()
+
+    if not row:
+        return None
+
+    data = uri_data(row)
+
+    sql = "SELECT tag FROM urldammit_tags WHERE id = %s"
+    cursor.execute(sql, (id, ))
+    for row in cursor.fetchall():
+        add_tag(data, row[0])
+
+    sql = "SELECT pair_key, pair_value FROM urldammit_pairs WHERE id = %s"
+    cursor.execute(sql, (id, ))
+    for row in cursor.fetchall():
+        add_pair(data, row[0], row[1])
+
+    return URI.load(data)
+
+def populate(m, n):
+    ids = []
+    for i in xrange(n):
+        u = URI()
+        u.uri = 'http://local.ch/bench/%s.html' % i
+        u.status = 200
+        u.created = datetime.datetime.now()
+        u.updated = datetime.datetime.now()
+        u.tags = ['tag%s' % j for j in range(10)]
+        u.pairs = dict(('key%s' % j, 'value%s' % j) for j in range(10))
+        m.insert(u)
+        ids.append(u.id)
+    return ids
+
+def timeit(fn, ids):
+    start = time.time()
+    for id in ids:
+        fn(id)
+    return (time.time() - start) / len(ids) * 1e6
+
+def main(records, loads):
+    conf = {'db_name': 'urldammit_bench'}
+    for key in ('db_host', 'db_user', 'db_pass'):
+        if key.upper() in os.environ:
+            conf[key] = os.environ[key.upper()]
+    m = MySQL(conf, dropfirst = True)
+    ids = populate(m, records)
+    sample = [random.choice(ids) for i in xrange(loads)]
+
+    db = m.pool.get()
+    try:
+        cursor = db.cursor()
+        for id in ids[:10]:
+            old = three_queries(cursor, id)
+            new = m._load_many(cursor, [id])[id]
+            assert (old.uri, old.status, old.tags, old.pairs) == \
+                   (new.uri, new.status, new.tags, new.pairs)
+
+        before = timeit(lambda id: three_queries(cursor, id), sample)
+        after = timeit(lambda id: m._load_many(cursor, [id]), sample)
+    finally:
+        m.pool.put(db)
+
+    print "%-16s %10s" % ('', 'usec/load')
+    print "%-16s %10.1f" % ('three queries', before)
+    print "%-16s %10.1f" % ('union all', after)
+
+if __name__ == '__main__':
+    records, loads = 1000, 10000
+    if len(sys.argv) > 1:
+        records = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        loads = int(sys.argv[2])
+    main(records, loads)
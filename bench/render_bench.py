@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+CPU cost of answering GET /<sha1> from the 'known' cache: rendering
+the URI with pack_response on every request, against returning the
+body pre-rendered in a dammit.request.Rendered entry
+
+Usage: python bench/render_bench.py [requests]
+"""
+import sys, os, time, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dammit'))
+from uri import URI
+from request import pack_response, Rendered
+
+def make_uri():
+    u = URI()
+    u.uri = 'http://local.ch/articles/4.html'
+    u.status = 200
+    u.created = datetime.datetime.now()
+    u.updated = datetime.datetime.now()
+    u.tags = ['article%s' % i for i in range(10)]
+    u.pairs = dict(('key%s' % i, 'x' * 100) for i in range(10))
+    return u
+
+def timeit(fn, n):
+    start = time.time()
+    for i in xrange(n):
+        fn()
+    return (time.time() - start) / n * 1e6
+
+def main(n):
+    u = make_uri()
+    entry = Rendered(u)
+    assert entry.response() == pack_response(u)
+
+    per_request = timeit(lambda: pack_response(u), n)
+    prerendered = timeit(entry.response, n)
+
+    print "%-24s %10s" % ('', 'usec/req')
+    print "%-24s %10.2f" % ('pack_response', per_request)
+    print "%-24s %10.2f" % ('Rendered.response', prerendered)
+    print "%-24s %10.2f" % ('saved per request', per_request - prerendered)
+
+if __name__ == '__main__':
+    n = 100000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    main(n)
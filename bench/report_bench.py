@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+by_status pages (as behind /_report) at increasing depth,
+against the same pages fetched with OFFSET, on SQLite
+
+Usage: python bench/report_bench.py [records] [page size]
+
+A tenth of the records are 404s, spread over a year of updated
+times. The cursor for each depth (down to the last page) is found
+by walking every page before it - only the page at that depth
+is timed
+"""
+import sys, os, time, datetime, tempfile, shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dammit'))
+import cachemanager, db_cache
+from nullcache import NullCache
+from uri import URI
+from db_sqlite import SQLite
+
+BATCH = 1000
+
+def make_uri(i, start):
+    u = URI()
+    u.uri = 'http://local.ch/bench/%s.html' % i
+    u.status = 200
+    if i % 10 == 0:
+        u.status = 404
+    u.created = u.updated = start + datetime.timedelta(seconds = i * 31)
+    return u
+
+def offset_page(db, status, limit, offset):
+    rows = db.connection().execute("""SELECT id FROM urldammit_uris
+    WHERE status = ? ORDER BY updated DESC, id DESC LIMIT ? OFFSET ?""",
+                                   (status, limit, offset)).fetchall()
+    found = db._load_many(db.connection(), [row[0] for row in rows])
+    return [found[row[0]] for row in rows if row[0] in found]
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+def main(records, limit):
+    cachemanager.register_cache_constructor(lambda namespace: NullCache(), 'db')
+    db_cache.cache_instance = None
+
+    tmp = tempfile.mkdtemp()
+    try:
+        db = SQLite({'db_path': os.path.join(tmp, 'bench.db')})
+        start = datetime.datetime(2009, 1, 1)
+        for i in xrange(0, records, BATCH):
+            db.insert_many([make_uri(j, start) for j in
+                            xrange(i, min(i + BATCH, records))])
+
+        pages = records // 10 // limit
+        depths = [0, 1]
+        while depths[-1] * 10 < pages:
+            depths.append(depths[-1] * 10)
+        depths.append(pages - 1)
+
+        print "%-10s %12s %12s" % ('page', 'keyset ms', 'offset ms')
+        after, page = None, 0
+        for depth in depths:
+            while page < depth:
+                last = db.by_status(404, limit, after)[-1]
+                after = (last.updated, last.id)
+                page += 1
+            keyset, uris = timed(db.by_status, 404, limit, after)
+            offset, expected = timed(offset_page, db, 404, limit, depth * limit)
+            assert [u.id for u in uris] == [u.id for u in expected]
+            print "%-10d %12.2f %12.2f" % (depth, keyset * 1e3, offset * 1e3)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    records, limit = 1000000, 100
+    if len(sys.argv) > 1:
+        records = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        limit = int(sys.argv[2])
+    main(records, limit)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+dammit.statusindex: snapshot size, lookup latency and resident
+memory for a given number of URIs, against the 'known' cache
+(a dict of Rendered entries) it stands in front of
+
+Usage: python bench/statusindex_bench.py [entries] [lookups]
+
+Entries are written straight to a snapshot (no backend) - 1%
+of them 301s. The known cache is only filled for the first
+100000 entries, and its size per entry estimated from that
+"""
+import sys, os, time, random, datetime, tempfile, shutil, sha, resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dammit'))
+from uri import URI
+from request import Rendered
+from statusindex import StatusIndex, write, seconds
+import sizeof
+
+KNOWN_SAMPLE = 100000
+
+def entries(n):
+    updated = seconds(datetime.datetime.now())
+    digests = [sha.new('http://local.ch/bench/%s.html' % i).digest()
+               for i in xrange(n)]
+    digests.sort()
+    for i, digest in enumerate(digests):
+        if i % 100 == 0:
+            yield (digest, 301, updated, 'http://local.ch/moved/%s.html' % i)
+        else:
+            yield (digest, 200, updated, None)
+
+def rss():
+    """
+    Current resident MB where /proc is available, otherwise
+    the peak
+    """
+    try:
+        pages = int(open('/proc/self/statm').read().split()[1])
+        return pages * resource.getpagesize() / 1e6
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def main(n, lookups):
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'status.idx')
+        start = time.time()
+        write(path, entries(n))
+        built = time.time() - start
+
+        before = rss()
+        index = StatusIndex(path)
+        ids = [URI.hash('http://local.ch/bench/%s.html' % random.randrange(n))
+               for i in xrange(lookups)]
+        times = []
+        for id in ids:
+            start = time.time()
+            assert index.get(id)
+            times.append(time.time() - start)
+        times.sort()
+        growth = rss() - before
+
+        known = {}
+        for i in xrange(min(n, KNOWN_SAMPLE)):
+            u = URI()
+            u.uri = 'http://local.ch/bench/%s.html' % i
+            u.status = 200
+            u.created = u.updated = datetime.datetime.now()
+            known[u.id] = Rendered(u)
+        per_entry = sizeof.estimate(known) / float(len(known))
+
+        print "entries             %d" % n
+        print "build               %.1f s" % built
+        print "snapshot            %.1f MB (%.1f bytes/entry)" % (
+            os.path.getsize(path) / 1e6, os.path.getsize(path) / float(n))
+        print "rss growth          %.1f MB after %d lookups" % (growth, lookups)
+        print "lookup p50 / p99    %.1f / %.1f usec" % (
+            times[len(times) // 2] * 1e6, times[int(len(times) * 0.99)] * 1e6)
+        print "known cache         ~%.0f bytes/entry, %.1f MB for all" % (
+            per_entry, per_entry * n / 1e6)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    n, lookups = 5000000, 100000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        lookups = int(sys.argv[2])
+    main(n, lookups)
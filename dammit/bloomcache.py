@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A fixed memory cache for ids we know nothing about,
+built on a pair of rotating Bloom filters
+
+Intended for the 'unknown' namespace, where every random
+path probed by a bot would otherwise cost a dict entry
+"""
+import time, math, sha, struct
+import stats
+from array import array
+from binascii import unhexlify
+
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 0.001
+
+def sizing(capacity, error_rate):
+    """
+    Number of bits and hash functions for a Bloom filter
+    holding capacity items with the given false positive rate
+
+    >>> sizing(1000000, 0.001)
+    (14377588, 10)
+    """
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    hashes = int(round(math.log(2) * bits / capacity))
+    return bits, max(1, hashes)
+
+def digest(key):
+    """
+    The 20 byte SHA-1 digest for a key - ids in urldammit are
+    already hex SHA-1 digests so are just decoded
+
+    >>> len(digest('c909d39688beb7b00e4fd47788329a61b39f73d5'))
+    20
+    >>> digest('foo') == sha.new('foo').digest()
+    True
+    """
+    if len(key) == 40:
+        try:
+            return unhexlify(key)
+        except TypeError:
+            pass
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return sha.new(key).digest()
+
+class BloomCache(object):
+    """
+    Mapping style negative cache - remembers that ids were
+    stored (the value is ignored) in a fixed amount of memory,
+    at the price of occasional false positives.
+
+    Ids are added to the current filter. When it holds
+    'capacity' ids, or is older than 'ttl' seconds, it becomes
+    the previous filter and the old previous filter is dropped,
+    so an id is remembered for between one and two generations
+    and the false positive rate stays around 2 x error_rate.
+
+    Deleting an id (e.g. once the URI gets registered) records
+    it in a small overlay which masks the filters, until the
+    generations holding its bits have rotated away.
+
+    >>> bc = BloomCache(capacity = 100)
+    >>> 'c909d39688beb7b00e4fd47788329a61b39f73d5' in bc
+    False
+    >>> bc['c909d39688beb7b00e4fd47788329a61b39f73d5'] = True
+    >>> 'c909d39688beb7b00e4fd47788329a61b39f73d5' in bc
+    True
+    >>> bc['c909d39688beb7b00e4fd47788329a61b39f73d5']
+    True
+    >>> bc.get('c909d39688beb7b00e4fd47788329a61b39f73d5')
+    True
+    >>> print bc.get('foo')
+    None
+    >>> bc.set_many({'a': True, 'b': True})
+    >>> sorted(bc.get_many(['a', 'b', 'c']))
+    ['a', 'b']
+    >>> bc.delete_many(['a', 'c'])
+    >>> sorted(bc.get_many(['a', 'b', 'c']))
+    ['b']
+    >>> del bc['c909d39688beb7b00e4fd47788329a61b39f73d5']
+    >>> 'c909d39688beb7b00e4fd47788329a61b39f73d5' in bc
+    False
+    >>> bc['c909d39688beb7b00e4fd47788329a61b39f73d5']
+    Traceback (most recent call last):
+    KeyError: 'c909d39688beb7b00e4fd47788329a61b39f73d5'
+    >>> del bc['foo']
+    Traceback (most recent call last):
+    KeyError: 'foo'
+
+    Ids survive one rotation but not two
+
+    >>> bc['foo'] = True
+    >>> for i in range(100):
+    ...     bc[str(i)] = True
+    >>> bc.generation, 'foo' in bc, '99' in bc
+    (1, True, True)
+    >>> for i in range(100, 200):
+    ...     bc[str(i)] = True
+    >>> bc.generation, 'foo' in bc, '99' in bc
+    (2, False, True)
+    >>> len([i for i in range(1000, 2000) if str(i) in bc]) < 10
+    True
+    """
+    def __init__(self, capacity = DEFAULT_CAPACITY,
+                 error_rate = DEFAULT_ERROR_RATE, ttl = None):
+        self.namespace = 'bloom'
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.ttl = ttl
+        self.bits, self.hashes = sizing(capacity, error_rate)
+        self.generation = 0
+        self.current = self._new_filter()
+        self.previous = self._new_filter()
+        self.count = 0
+        self.previous_count = 0
+        self.started = time.time()
+        self.cleared = {}
+
+    def __len__(self):
+        """
+        Approximate number of ids remembered
+        """
+        return self.count + self.previous_count
+
+    def __contains__(self, key):
+        if key in self.cleared:
+            return False
+        positions = self._positions(key)
+        return self._test(self.current, positions) or \
+               self._test(self.previous, positions)
+
+    def __setitem__(self, key, val):
+        self._maybe_rotate()
+        if key in self.cleared:
+            del self.cleared[key]
+        bits = self.current
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+        stats.incr(self.namespace, 'sets')
+
+    def __getitem__(self, key):
+        found = key in self
+        stats.lookup(self.namespace, found)
+        if not found:
+            raise KeyError(key)
+        return True
+
+    def __delitem__(self, key):
+        if not key in self:
+            raise KeyError(key)
+        self.cleared[key] = self.generation
+        stats.incr(self.namespace, 'deletes')
+
+    def get(self, key, default = None):
+        found = key in self
+        stats.lookup(self.namespace, found)
+        if found:
+            return True
+        return default
+
+    def get_many(self, keys):
+        found = dict((key, True) for key in keys if key in self)
+        stats.lookup(self.namespace, True, len(found))
+        stats.lookup(self.namespace, False, len(keys) - len(found))
+        return found
+
+    def set_many(self, mapping):
+        for key in mapping:
+            self[key] = True
+
+    def delete_many(self, keys):
+        for key in keys:
+            if key in self:
+                del self[key]
+
+    def gauges(self):
+        """
+        For stats.register_gauge - the filters take the same
+        memory however many ids they hold
+        """
+        return {
+            'size': self.__len__,
+            'bytes': lambda: len(self.current) + len(self.previous),
+            }
+
+    def __repr__(self):
+        return "BloomCache"
+
+    def _new_filter(self):
+        return array('B', '\0' * ((self.bits + 7) // 8))
+
+    def _positions(self, key):
+        """
+        Bit positions for a key, by double hashing
+        the two halves of its digest
+        """
+        a, b, c, d, e = struct.unpack('>5I', digest(key))
+        h1 = (a << 32) | b
+        h2 = (c << 32) | d | 1
+        m = self.bits
+        return [(h1 + i * h2) % m for i in xrange(self.hashes)]
+
+    def _test(self, bits, positions):
+        for pos in positions:
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def _maybe_rotate(self):
+        expired = self.ttl is not None and \
+                  time.time() - self.started >= self.ttl
+        if self.count < self.capacity and not expired:
+            return
+        self.previous = self.current
+        self.previous_count = self.count
+        self.current = self._new_filter()
+        self.count = 0
+        self.started = time.time()
+        self.generation += 1
+        # ids cleared before the previous generation began
+        # no longer have bits in either filter
+        oldest = self.generation - 1
+        for key, generation in self.cleared.items():
+            if generation < oldest:
+                del self.cleared[key]
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -1,21 +1,58 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import threading
+import stats
 
 def dict_constructor(namespace):
     return dict()
 
 cache_constructor = dict_constructor
 
-def register_cache_constructor(func):
+constructors = {}
+ttls = {}
+max_bytes = {}
+
+def register_cache_constructor(func, namespace = None):
     """
     Register a function to be called to create
     cache instances - the function should return
     an instance of the cache
+
+    If a namespace is given, the function is only used
+    for that namespace (e.g. a BloomCache for 'unknown'),
+    overriding the default for all other namespaces
     """
     global cache_constructor
-    cache_constructor = func
+    if namespace is None:
+        cache_constructor = func
+    else:
+        constructors[namespace] = func
+
+def constructor_for(namespace):
+    """
+    The function currently used to create caches for a namespace
+
+    >>> constructor_for('foo') is cache_constructor
+    True
+    """
+    return constructors.get(namespace, cache_constructor)
+
+def register_ttl(namespace, ttl):
+    """
+    Register a time to live (in seconds) for records
+    in caches created for the namespace - None means
+    records never expire
+    """
+    ttls[namespace] = ttl
+
+def register_max_bytes(namespace, limit):
+    """
+    Register a memory budget (estimated bytes) for caches
+    created for the namespace - None means no limit
+    """
+    max_bytes[namespace] = limit
 
-def new_instance(namespace):
+def new_instance(namespace, ttl = None, limit = None):
     """
     Create a new instance of the current cache class
     
@@ -23,19 +60,193 @@ def new_instance(namespace):
     pass some identifier to prevent keys colliding
     hence the namespace param (e.g. use as key prefix
     for memcached impl)
+
+    ttl overrides any time to live registered for the
+    namespace. It is applied to caches which have a ttl
+    attribute (LRUCache, MemcachedWrapper) - a plain
+    dict never expires anything
+
+    Likewise limit overrides any memory budget registered
+    for the namespace, for caches with a max_bytes
+    attribute (LRUCache, or the local tier of a TieredCache)
+
+    Caches with a namespace attribute count their hits,
+    misses etc. under it, and any gauges they provide are
+    registered with the stats module
+    """
+    cache = constructor_for(namespace)(namespace)
+    if ttl is None:
+        ttl = ttls.get(namespace)
+    if ttl is not None and hasattr(cache, 'ttl'):
+        cache.ttl = ttl
+    if limit is None:
+        limit = max_bytes.get(namespace)
+    if limit is not None and hasattr(cache, 'max_bytes'):
+        cache.max_bytes = limit
+    if hasattr(cache, 'namespace'):
+        cache.namespace = namespace
+    if hasattr(cache, 'gauges'):
+        for name, fn in cache.gauges().items():
+            stats.register_gauge(namespace, name, fn)
+    return cache
+
+calls = threading.local()
+
+def reset_calls():
+    """
+    Start counting calls to namespaced caches afresh
+    for the current thread (e.g. at the start of a request)
+    """
+    calls.counts = {}
+
+def count_call(namespace):
+    try:
+        counts = calls.counts
+    except AttributeError:
+        counts = calls.counts = {}
+    counts[namespace] = counts.get(namespace, 0) + 1
+
+def call_counts():
+    """
+    Calls made by the current thread to namespaced caches
+    since reset_calls(), per namespace. For a shared cache
+    like memcached, each is one network round trip
+
+    NullCache counts through the imported module, which isn't
+    this one when it's run as a script
+
+    >>> import cachemanager
+    >>> from nullcache import NullCache
+    >>> cachemanager.reset_calls()
+    >>> nc = NullCache()
+    >>> nc.get('foo')
+    >>> nc['foo'] = 'bar'
+    >>> cachemanager.call_counts()
+    {'': 2}
+    >>> cachemanager.reset_calls()
+    >>> cachemanager.call_counts()
+    {}
     """
-    return cache_constructor(namespace)
+    try:
+        return calls.counts
+    except AttributeError:
+        return {}
 
 def namespacer(func):
     """
     Decorator for injecting a namespace prefix into
     the key argument, obtained from self.namespace
+
+    Also counts the call - see call_counts()
     """
     def namespace_wrapper(self, key, *args, **kwargs):
+        count_call(self.namespace)
         key = "%s_%s" % ( self.namespace, key.encode('UTF-8') )
         return func( self, key, *args, **kwargs )
     return namespace_wrapper
 
+def multi_namespacer(func):
+    """
+    Decorator like namespacer for methods taking a list of
+    keys (or a dict keyed by them) - encodes the keys and
+    passes the namespace prefix as an extra argument, for
+    use as the key_prefix of memcached's *_multi calls
+
+    Counts as one call - see call_counts()
+    """
+    def multi_namespace_wrapper(self, keys, *args, **kwargs):
+        count_call(self.namespace)
+        if isinstance(keys, dict):
+            keys = dict(
+                (k.encode('UTF-8'), v) for k, v in keys.items()
+                )
+        else:
+            keys = [k.encode('UTF-8') for k in keys]
+        prefix = "%s_" % self.namespace
+        return func( self, keys, prefix, *args, **kwargs )
+    return multi_namespace_wrapper
+
+def get_many(cache, keys):
+    """
+    Fetch many keys from a cache in one call where the cache
+    supports it. Returns a dict of the keys found
+
+    >>> c = {'a': 1, 'b': 2}
+    >>> get_many(c, ['a', 'c'])
+    {'a': 1}
+    >>> set_many(c, {'c': 3, 'd': 4})
+    >>> delete_many(c, ['a', 'b', 'x'])
+    >>> sorted(c.items())
+    [('c', 3), ('d', 4)]
+    """
+    if hasattr(cache, 'get_many'):
+        return cache.get_many(keys)
+    found = {}
+    for key in keys:
+        try:
+            found[key] = cache[key]
+        except KeyError:
+            pass
+    return found
+
+def set_many(cache, mapping, ttl = None):
+    """
+    Store a dict of keys / values in a cache - with a ttl,
+    where the cache supports a per-record ttl, as for
+    set_expiring
+
+    >>> class Expiring(dict):
+    ...     def set(self, key, val, ttl = None): pass
+    ...     def set_many(self, mapping, ttl = None):
+    ...         print sorted(mapping), ttl
+    >>> set_many(Expiring(), {'a': 1}, 60)
+    ['a'] 60
+    >>> c = {}
+    >>> set_many(c, {'a': 1}, 60)
+    >>> c
+    {'a': 1}
+    """
+    if hasattr(cache, 'set_many'):
+        if ttl is not None and hasattr(cache, 'set'):
+            cache.set_many(mapping, ttl)
+        else:
+            cache.set_many(mapping)
+        return
+    for key, val in mapping.items():
+        if ttl is None:
+            cache[key] = val
+        else:
+            set_expiring(cache, key, val, ttl)
+
+def set_expiring(cache, key, val, ttl):
+    """
+    Store a value which should only live for ttl seconds, where
+    the cache supports a per-record ttl (e.g. memcached), else
+    store it normally
+
+    >>> c = {}
+    >>> set_expiring(c, 'a', 1, 60)
+    >>> c
+    {'a': 1}
+    """
+    if hasattr(cache, 'set'):
+        cache.set(key, val, ttl)
+    else:
+        cache[key] = val
+
+def delete_many(cache, keys):
+    """
+    Remove many keys from a cache, ignoring those missing
+    """
+    if hasattr(cache, 'delete_many'):
+        cache.delete_many(keys)
+        return
+    for key in keys:
+        try:
+            del cache[key]
+        except KeyError:
+            pass
+
 def _test():
     """
     >>> c = new_instance('test')
@@ -50,6 +261,33 @@ def _test():
     >>> c1 = new_instance('test')
     >>> isinstance(c1, LRUCache)
     True
+    >>> print c1.ttl
+    None
+    >>> c1.namespace
+    'test'
+
+    >>> register_ttl('test', 60)
+    >>> new_instance('test').ttl
+    60
+    >>> new_instance('test', ttl = 5).ttl
+    5
+    >>> new_instance('other').ttl is None
+    True
+    >>> register_max_bytes('test', 1024)
+    >>> new_instance('test').max_bytes
+    1024
+    >>> new_instance('test', limit = 2048).max_bytes
+    2048
+    >>> register_cache_constructor(dict_constructor)
+    >>> isinstance(new_instance('test'), dict)
+    True
+
+    >>> from bloomcache import BloomCache
+    >>> register_cache_constructor(lambda x: BloomCache(100), 'unknown')
+    >>> new_instance('unknown')
+    BloomCache
+    >>> isinstance(new_instance('known'), dict)
+    True
     """
     import doctest
     doctest.testmod()
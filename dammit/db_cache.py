@@ -8,7 +8,21 @@ This is seperate to the cache of known
 and unknown URLs maintained by the urldammit
 server
 """
-import cachemanager
+import os, time, threading
+import cachemanager, stats
+
+LEASE_TIMEOUT = 3
+"""Seconds another process may spend loading a record before we give up waiting"""
+LEASE_POLL = 0.05
+"""Seconds between checks of the cache while waiting on another process"""
+ABSENT_TTL = 60
+"""Seconds to remember that an id has no record"""
+
+# Counted under the 'db' group of the stats module;
+#  load / load_many: calls through to the backend, with timings
+#  coalesced: callers served by a load in progress in this process
+#  lease_waits: waits on a load in progress in another process
+#  lease_hits: ... which were then served from the cache
 
 cache_instance = None
 def get_cache():
@@ -17,24 +31,232 @@ def get_cache():
         cache_instance = cachemanager.new_instance('db')
     return cache_instance
 
+class Absent(object):
+    """
+    Cached in place of a record the backend doesn't have, so
+    repeated lookups of a missing id don't reach the backend.
+    Ignored once expired, even if the cache keeps it longer
+    """
+    def __init__(self, ttl = None):
+        if ttl is None:
+            ttl = ABSENT_TTL
+        self.expires = time.time() + ttl
+
+    def __repr__(self):
+        return "Absent"
+
+def cached_record(cached):
+    """
+    Interpret a value from the cache - returns a tuple of
+    ( hit, record ), where a live Absent marker is a hit
+    with no record
+
+    >>> cached_record(None)
+    (False, None)
+    >>> cached_record('x')
+    (True, 'x')
+    >>> cached_record(Absent())
+    (True, None)
+    >>> cached_record(Absent(-1))
+    (False, None)
+    """
+    if cached is None:
+        return False, None
+    if isinstance(cached, Absent):
+        return cached.expires > time.time(), None
+    return True, cached
+
+def remember(cache, id, record):
+    """
+    Cache a record loaded from the backend, or an
+    Absent marker if there wasn't one
+    """
+    if record is None:
+        cachemanager.set_expiring(cache, id, Absent(), ABSENT_TTL)
+    else:
+        cache[id] = record
+
+def timed(name, method, *args):
+    """
+    Call through to the backend, recording the time taken
+    """
+    start = time.time()
+    try:
+        return method(*args)
+    finally:
+        stats.observe('db', name, time.time() - start)
+
+class Flight(object):
+    """
+    A backend load in progress, which other threads
+    asking for the same id can wait on
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+flights = {}
+flights_lock = threading.Lock()
+
 def load(method):
     """
     Decorator for load method
+
+    On a miss, only one thread per process loads a given id
+    from the backend - others asking for it meanwhile wait for
+    that result. Where the cache is shared between processes
+    and supports add() (memcached), a short lease in the cache
+    stops other processes loading it too.
+
+    >>> cachemanager.register_cache_constructor(cachemanager.dict_constructor)
+    >>> import time, threading
+    >>> class Backend(object):
+    ...     loads = 0
+    ...     @load
+    ...     def load(self, id):
+    ...         Backend.loads += 1
+    ...         time.sleep(0.1)
+    ...         return id.upper()
+    >>> db = Backend()
+    >>> threads = [threading.Thread(target = db.load, args = ('abc',))
+    ...            for i in range(5)]
+    >>> for t in threads: t.start()
+    >>> for t in threads: t.join()
+    >>> Backend.loads, stats.snapshot()['db']['coalesced']
+    (1, 4)
+    >>> db.load('abc'), Backend.loads
+    ('ABC', 1)
+
+    Missing records are remembered too, until
+    they're inserted or ABSENT_TTL passes
+
+    >>> class Backend(object):
+    ...     loads = 0
+    ...     records = {}
+    ...     @load
+    ...     def load(self, id):
+    ...         Backend.loads += 1
+    ...         return self.records.get(id)
+    ...     @insert
+    ...     def insert(self, uri):
+    ...         self.records[uri.id] = uri
+    >>> class Record(object):
+    ...     id = 'foo'
+    >>> db = Backend()
+    >>> print db.load('foo'), db.load('foo'), Backend.loads
+    None None 1
+    >>> get_cache()['foo']
+    Absent
+    >>> db.insert(Record())
+    >>> db.load('foo').id, Backend.loads
+    ('foo', 2)
     """
     def load_wrapper(self, id):
         cache = get_cache()
+        hit, record = cached_record(cache.get(id))
+        if hit:
+            return record
+
+        flights_lock.acquire()
         try:
-            cached = cache[id]
-            if cached is not None:
-                return cached
-        except:
-            pass
-        
-        cache[id] = method(self, id)
-        return cache[id]
+            flight = flights.get(id)
+            leader = flight is None
+            if leader:
+                flight = flights[id] = Flight()
+        finally:
+            flights_lock.release()
+
+        if not leader:
+            stats.incr('db', 'coalesced')
+            flight.done.wait(LEASE_TIMEOUT)
+            if flight.done.isSet() and not flight.failed:
+                return flight.result
+            return timed('load', method, self, id)
+
+        try:
+            try:
+                flight.result = leased_load(self, id, cache, method)
+            except:
+                flight.failed = True
+                raise
+        finally:
+            flights_lock.acquire()
+            try:
+                del flights[id]
+            finally:
+                flights_lock.release()
+            flight.done.set()
+
+        return flight.result
     
     return load_wrapper
 
+def leased_load(self, id, cache, method):
+    """
+    Load a record through method and cache it, holding a lease
+    on it in the cache while doing so if the cache supports
+    add(). If another process holds the lease, wait for it to
+    fill the cache instead - up to LEASE_TIMEOUT seconds
+    """
+    lease = "lease_%s" % id
+    if hasattr(cache, 'add') and \
+           not cache.add(lease, os.getpid(), LEASE_TIMEOUT):
+        stats.incr('db', 'lease_waits')
+        deadline = time.time() + LEASE_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(LEASE_POLL)
+            hit, record = cached_record(cache.get(id))
+            if hit:
+                stats.incr('db', 'lease_hits')
+                return record
+        lease = None
+
+    try:
+        loaded = timed('load', method, self, id)
+        remember(cache, id, loaded)
+        return loaded
+    finally:
+        if lease and hasattr(cache, 'add'):
+            try:
+                del cache[lease]
+            except KeyError:
+                pass
+
+def load_many(method):
+    """
+    Decorator for load_many - takes a list of ids and returns
+    a dict of id -> record for those found. One cache call
+    serves the hits and the wrapped method is only asked
+    for the misses
+    """
+    def load_many_wrapper(self, ids):
+        cache = get_cache()
+        found = {}
+        absent = {}
+        for id, cached in cachemanager.get_many(cache, ids).items():
+            hit, record = cached_record(cached)
+            if record is not None:
+                found[id] = record
+            elif hit:
+                absent[id] = True
+
+        missing = [id for id in ids if id not in found and id not in absent]
+        if missing:
+            loaded = timed('load_many', method, self, missing) or {}
+            if loaded:
+                cachemanager.set_many(cache, loaded)
+                found.update(loaded)
+            marker = Absent()
+            absent = dict((id, marker) for id in missing if id not in loaded)
+            if absent:
+                # expiring, as remember stores them for load
+                cachemanager.set_many(cache, absent, ABSENT_TTL)
+
+        return found
+    
+    return load_many_wrapper
+
 def insert(method):
     """
     Decorator for insert
@@ -63,6 +285,40 @@ def update(method):
 
     return update_wrapper
 
+def insert_many(method):
+    """
+    Decorator for insert_many - takes a list of records,
+    removing them from the cache in one call
+
+    >>> cachemanager.register_cache_constructor(cachemanager.dict_constructor)
+    >>> class Record(object):
+    ...     def __init__(self, id): self.id = id
+    >>> class Backend(object):
+    ...     @insert_many
+    ...     def insert_many(self, uris): pass
+    >>> cache = get_cache()
+    >>> cache['a'] = cache['b'] = cache['c'] = Absent()
+    >>> Backend().insert_many([Record('a'), Record('b')])
+    >>> [id for id in 'abc' if id in cache]
+    ['c']
+    """
+    def insert_many_wrapper(self, uris):
+        cachemanager.delete_many(get_cache(), [uri.id for uri in uris])
+        method(self, uris)
+
+    return insert_many_wrapper
+
+def update_many(method):
+    """
+    Decorator for update_many - takes a list of records,
+    removing them from the cache in one call
+    """
+    def update_many_wrapper(self, uris):
+        cachemanager.delete_many(get_cache(), [uri.id for uri in uris])
+        method(self, uris)
+
+    return update_many_wrapper
+
 def delete(method):
     """
     Decorator for delete
@@ -77,3 +333,21 @@ def delete(method):
 
     return delete_wrapper
 
+def delete_many(method):
+    """
+    Decorator for delete_many - takes a list of ids,
+    removing them from the cache in one call
+    """
+    def delete_many_wrapper(self, ids):
+        cachemanager.delete_many(get_cache(), ids)
+        method(self, ids)
+
+    return delete_many_wrapper
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -1,12 +1,67 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from couchdb import Server
+import datetime
+from couchdb import Server, ResourceConflict
 from uri import URI
-import db_cache
+import db_cache, stats, purge, sortedmerge
+
+DESIGN_ID = '_design/urldammit'
+
+VIEWS = {
+    'by_updated': {
+        'map': 'function(doc) { if (doc.updated) emit(doc.updated, null); }'
+        },
+    'by_status_updated': {
+        'map': 'function(doc) { if (doc.updated) emit([doc.status, doc.updated], null); }'
+        },
+    'by_tag': {
+        'map': 'function(doc) { if (doc.tags) for (var i = 0; i < doc.tags.length; i++) emit(doc.tags[i], null); }'
+        },
+    }
+
+def by_updated(doc):
+    if doc.get('updated'):
+        return [(doc['updated'], None)]
+    return []
+
+def by_status_updated(doc):
+    if doc.get('updated'):
+        return [([doc.get('status'), doc['updated']], None)]
+    return []
+
+def by_tag(doc):
+    return [(tag, None) for tag in doc.get('tags') or []]
+
+VIEW_FUNCTIONS = {
+    'urldammit/by_updated': by_updated,
+    'urldammit/by_status_updated': by_status_updated,
+    'urldammit/by_tag': by_tag,
+    }
+"""Python versions of VIEWS, for fakecouch"""
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+"""Dates are stored as strings which sort in date order"""
+
+CONFLICT_RETRIES = 3
+"""Times to refetch the _rev and write again after a conflict."""
+
+BULK_SIZE = 1000
+"""Most documents fetched or written per request by the _many methods."""
+
+def chunks(items, size = BULK_SIZE):
+    """
+    >>> list(chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 class Couch(object):
     """
+    >>> from fakecouch import FakeCouch
+    >>> couch = FakeCouch(VIEW_FUNCTIONS)
     >>> config = {}
+    >>> config['db_host'] = couch.start()
     >>> config['db_name'] = 'urldammit_doctest'
     >>> cdb = Couch(config)
     >>> del cdb.server['urldammit_doctest']
@@ -17,6 +72,7 @@ class Couch(object):
     >>> u = URI()
     >>> u.status = 200
     >>> u.uri = "http://local.ch/load_1.html"
+    >>> u.updated = datetime.datetime.now()
     >>> cdb.insert(u)
     
     >>> u1 = cdb.load(u.id)
@@ -38,76 +94,386 @@ class Couch(object):
     >>> u3 = cdb.load(u.id)
     >>> print u3.tags
     ['foo', 'bar']
+    >>> [[x.uri for x in batch] for batch in cdb.recent(5)]
+    [['http://local.ch/load_1.html']]
+
+    Batches take one request per BULK_SIZE documents
+
+    >>> uris = []
+    >>> for i in range(5):
+    ...     u = URI()
+    ...     u.status = 200
+    ...     u.uri = 'http://local.ch/bulk_%s.html' % i
+    ...     uris.append(u)
+    >>> before = len(couch.requests)
+    >>> cdb.insert_many(uris)
+    >>> found = cdb.load_many([u.id for u in uris] + ['123abc'])
+    >>> sorted(found.keys()) == sorted([u.id for u in uris])
+    True
+    >>> for u in uris: u.tags = ['bulk']
+    >>> cdb.update_many(uris)
+    >>> len(couch.requests) - before
+    3
+    >>> print cdb.load(uris[4].id).tags
+    ['bulk']
+
+    A stale _rev means fetching the current ones and trying again
+
+    >>> uris[0].meta['_rev'] = '1-stale'
+    >>> before = len(couch.requests)
+    >>> cdb.update_many(uris)
+    >>> len(couch.requests) - before
+    3
+    >>> cdb.load(uris[0].id).meta['_rev'] == uris[0].meta['_rev']
+    True
+
+    >>> before = len(couch.requests)
+    >>> cdb.delete_many([u.id for u in uris[:3]] + ['123abc'])
+    >>> len(couch.requests) - before
+    2
+    >>> len(cdb.load_many([u.id for u in uris]))
+    2
+    >>> for u in uris[3:]:
+    ...     u.updated = datetime.datetime(2009, 1, 1)
+    >>> cdb.update_many(uris[3:])
+    >>> page = cdb.by_status(200, 1)
+    >>> [x.uri for x in page]
+    ['http://local.ch/load_1.html']
+    >>> page = cdb.by_status(200, 1, (page[-1].updated, page[-1].id))
+    >>> page += cdb.by_status(200, 5, (page[-1].updated, page[-1].id))
+    >>> [x.id for x in page] == sorted([u.id for u in uris[3:]], reverse = True)
+    True
+    >>> cdb.by_status(404, 5)
+    []
+    >>> found = cdb.by_tags(['bulk'], 1, status = 200)
+    >>> found += cdb.by_tags(['bulk', 'none'], 5, found[-1].id, match_any = True)
+    >>> [x.id for x in found] == sorted([u.id for u in uris[3:]])
+    True
+    >>> [x.uri for x in cdb.by_tags(['foo', 'bar'], 5)]
+    ['http://local.ch/load_1.html']
+    >>> cdb.by_tags(['bulk', 'foo'], 5), cdb.by_tags(['bulk'], 5, status = 404)
+    ([], [])
+    >>> list(cdb.stale(200, datetime.datetime(2009, 1, 2), 1)) == [[u.id] for u in sorted(uris[3:], key = lambda u: u.id)]
+    True
+    >>> cdb.purge(retention = {200: 1}, batch_size = 1, pause = 0,
+    ...           now = datetime.datetime(2009, 1, 3))
+    2
+    >>> cdb.load_many([u.id for u in uris])
+    {}
 
     >>> del cdb.server['urldammit_doctest']
+    >>> couch.stop()
     """
     def __init__(self, config = None):
         self.config = self._default_config(config)
-        self.server = Server(config['db_host'])
+        self.server = Server(self.config['db_host'])
         self.bootstrap()
-        self.db = self.server[config['db_name']]
+        self.db = self.server[self.config['db_name']]
+
+    def fresh_connection(self):
+        """
+        The couchdb client makes a request per call, so
+        there's no connection state to refresh
+        """
+        return self
 
     @db_cache.load
     def load(self, id):
         record = self.db.get(id, None)
         if not record: return None
+        return record_to_uri(record)
 
-        data = {}
-        data['meta'] = {}
-        
-        for k, v in record.items():
-            k = k.encode('utf-8')
-            if k == 'tags':
-                try:
-                    data[k] = [tag.encode('utf-8') for tag in v]
-                except:
-                    data[k] = None
-            elif k == 'pairs':
-                data[k] = contract_dict(v)
-            elif k == '_rev':
-                data['meta']['_rev'] = v
-            elif isinstance(v, unicode):
-                data[k] = v.encode('utf-8')
-            else:
-                data[k] = v
+    @db_cache.load_many
+    def load_many(self, ids):
+        """
+        Takes a list of SHA-1 ids - returns a dict of id -> URI
+        for those found, fetching up to BULK_SIZE per request
+        from _all_docs
+        """
+        found = {}
+        for keys in chunks(list(ids)):
+            for row in self.db.view('_all_docs', keys = keys, include_docs = True):
+                if row.doc:
+                    found[row.key] = record_to_uri(row.doc)
+        return found
 
-        return URI.load(data)
+    def recent(self, limit, batch_size = 500):
+        """
+        Generate batches (lists) of the most recently updated
+        URIs, newest first, up to limit URIs in total - pages
+        through the by_updated view by key rather than skip
+        """
+        options = {}
+        while limit > 0:
+            size = min(batch_size, limit)
+            rows = list(self.db.view(
+                'urldammit/by_updated', descending = True,
+                include_docs = True, limit = size, **options
+                ))
+            if not rows:
+                return
+            last = rows[-1]
+            options = {
+                'startkey': last.key,
+                'startkey_docid': last.id,
+                'skip': 1
+                }
+            yield [record_to_uri(row.doc) for row in rows]
+            limit -= len(rows)
 
     @db_cache.insert
     def insert(self, uri):
-        self.db[uri.id] = uri.data()
+        self._put(uri)
 
     @db_cache.update
     def update(self, uri):
-        stored_uri = self.load(uri.id)
-
-        if not stored_uri:
-            self.insert(uri)
-            return
-
-        data = {}
-        try:
-            data['_rev'] = stored_uri.meta['_rev']
-        except:
-            pass
-        
-        for k, v in uri.data().items():
-            data[k] = v
-        
-        self.db[uri.id] = data
+        self._put(uri)
+
+    @db_cache.insert_many
+    def insert_many(self, uris):
+        """
+        Insert a list of URIs with _bulk_docs, up to BULK_SIZE
+        per request
+        """
+        self._put_many(uris)
+
+    @db_cache.update_many
+    def update_many(self, uris):
+        """
+        Update a list of URIs with _bulk_docs, up to BULK_SIZE
+        per request
+        """
+        self._put_many(uris)
+
+    def _put_many(self, uris):
+        """
+        As _put, for many URIs. A bulk update fails as a whole
+        if any document conflicts - then the current _revs are
+        fetched for that chunk and it's sent again, once. After
+        that, documents are written one by one
+        """
+        for batch in chunks(uris):
+            records = []
+            for uri in batch:
+                record = uri_to_record(uri)
+                record['_id'] = uri.id
+                rev = uri.meta.get('_rev')
+                if rev:
+                    record['_rev'] = rev
+                records.append(record)
+
+            try:
+                try:
+                    list(self.db.update(records))
+                except ResourceConflict:
+                    stats.incr('couch', 'conflicts')
+                    self._current_revs(records)
+                    list(self.db.update(records))
+            except ResourceConflict:
+                stats.incr('couch', 'conflicts')
+                for uri in batch:
+                    self._put(uri)
+                continue
+
+            for uri, record in zip(batch, records):
+                uri.meta['_rev'] = record['_rev']
+
+    def _current_revs(self, records):
+        """
+        Set the _rev of each record to that stored, in one
+        request - dropping it for records which aren't stored
+        """
+        rows = self.db.view('_all_docs', keys = [r['_id'] for r in records])
+        revs = {}
+        for row in rows:
+            if row.id and not row.value.get('deleted'):
+                revs[row.key] = row.value['rev']
+        for record in records:
+            if record['_id'] in revs:
+                record['_rev'] = revs[record['_id']]
+            else:
+                record.pop('_rev', None)
+
+    def _put(self, uri):
+        """
+        Write the URI in one request, using the _rev it was
+        loaded with (kept in uri.meta). Only if that's out of
+        date - or the URI wasn't loaded from couch - is the
+        current _rev fetched and the write tried again. The
+        new _rev is stored back in uri.meta
+        """
+        record = uri_to_record(uri)
+        rev = uri.meta.get('_rev')
+        if rev:
+            record['_rev'] = rev
+
+        attempts = 0
+        while True:
+            try:
+                self.db[uri.id] = record
+                break
+            except ResourceConflict:
+                if attempts == CONFLICT_RETRIES:
+                    raise
+                attempts += 1
+                stats.incr('couch', 'conflicts')
+                current = self.db.get(uri.id, None)
+                if current:
+                    record['_rev'] = current['_rev']
+                else:
+                    record.pop('_rev', None)
+
+        uri.meta['_rev'] = record['_rev']
 
     @db_cache.delete
     def delete(self, id):
         del self.db[id]
 
+    @db_cache.delete_many
+    def delete_many(self, ids):
+        """
+        Delete a list of URIs with _bulk_docs, after fetching
+        their current _revs - two requests per BULK_SIZE ids.
+        Ids not stored are ignored. On a conflict the _revs
+        are fetched and the chunk sent again, once
+        """
+        for batch in chunks(list(ids)):
+            try:
+                self._delete_batch(batch)
+            except ResourceConflict:
+                stats.incr('couch', 'conflicts')
+                self._delete_batch(batch)
+
+    def _delete_batch(self, ids):
+        records = [{'_id': id} for id in ids]
+        self._current_revs(records)
+        records = [r for r in records if '_rev' in r]
+        for record in records:
+            record['_deleted'] = True
+        if records:
+            list(self.db.update(records))
+
     def bootstrap(self, **kwargs):
         dbname = self.config['db_name']
         if not dbname in self.server:
             self.server.create(dbname)
+
+        # (re)install the views if they're missing or out of date
+        db = self.server[dbname]
+        design = db.get(DESIGN_ID, None) or {}
+        if design.get('views') != VIEWS:
+            design['language'] = 'javascript'
+            design['views'] = VIEWS
+            db[DESIGN_ID] = design
             
 
+    def stale(self, status, before, batch_size = 500):
+        """
+        Generate batches (lists) of the ids of records with
+        the status last updated before the given time, oldest
+        first - paging through the by_status_updated view by key.
+        Each page starts from the last row of the one before
+        rather than skipping it, as purge has usually deleted it
+        by then
+        """
+        before = before.strftime(DATE_FORMAT)
+        options = {'startkey': [status]}
+        start = None
+        while True:
+            rows = list(self.db.view(
+                'urldammit/by_status_updated', limit = batch_size + 1,
+                endkey = [status, before], **options
+                ))
+            rows = [row for row in rows if row.key[1] < before
+                    and (row.key, row.id) != start][:batch_size]
+            if not rows:
+                return
+            last = rows[-1]
+            start = (last.key, last.id)
+            options = {'startkey': last.key, 'startkey_docid': last.id}
+            yield [row.id for row in rows]
+
+    def by_status(self, status, limit, after = None):
+        """
+        A page (list) of up to limit URIs with the status, most
+        recently updated first - after is the ( updated, id ) of
+        the last URI on the previous page. Reads the
+        by_status_updated view backwards from that key, so a
+        page costs the same at any depth
+        """
+        if after:
+            start = [status, after[0].strftime(DATE_FORMAT)]
+            options = {'startkey': start, 'startkey_docid': after[1]}
+        else:
+            options = {'startkey': [status, u'\ufff0']}
+        # the first row is the one we started from, if it's still there
+        rows = list(self.db.view(
+            'urldammit/by_status_updated', descending = True,
+            endkey = [status], include_docs = True, limit = limit + 1,
+            **options
+            ))
+        if after:
+            rows = [row for row in rows
+                    if not (row.key == start and row.id == after[1])]
+        return [record_to_uri(row.doc) for row in rows[:limit]]
+
+    def by_tags(self, tags, limit, after = None, status = None,
+                match_any = False):
+        """
+        A page (list) of up to limit URIs with all the tags (or
+        any of them), optionally only those with the status, in
+        id order - after is the id of the last URI on the
+        previous page. For all, walks the first tag's rows in the
+        by_tag view and checks the others on each document; for
+        any, merges the rows of every tag
+        """
+        if match_any:
+            rows = sortedmerge.merge(
+                *[self._tagged(tag, after, limit) for tag in tags]
+                )
+        else:
+            rows = (
+                (id, doc) for id, doc in self._tagged(tags[0], after, limit)
+                if set(tags) <= set(doc.get('tags') or [])
+                )
+        uris = []
+        last = None
+        for id, doc in rows:
+            if id == last:
+                continue
+            last = id
+            if status is None or doc.get('status') == status:
+                uris.append(record_to_uri(doc))
+                if len(uris) == limit:
+                    break
+        return uris
+
+    def _tagged(self, tag, after, batch_size):
+        """
+        Generate ( id, doc ) for each document with the tag, in id
+        order after the given id - a batch of rows per request,
+        paging by startkey_docid
+        """
+        while True:
+            options = {}
+            if after:
+                options['startkey_docid'] = after
+            rows = list(self.db.view(
+                'urldammit/by_tag', startkey = tag, endkey = tag,
+                include_docs = True, limit = batch_size + 1, **options
+                ))
+            for row in rows:
+                if row.id > after:
+                    yield row.id, row.doc
+            if len(rows) <= batch_size:
+                return
+            after = rows[-1].id
+
     def purge(self, **kwargs):
-        pass
+        """
+        Delete stale records - see purge.run
+        """
+        return purge.run(self, **kwargs)
 
     def _default_config(self, config):
         """
@@ -121,6 +487,57 @@ class Couch(object):
     def _load(self, id):
         return 
 
+def uri_to_record(uri):
+    """
+    Build a couch document from a URI
+
+    >>> u = URI()
+    >>> u.status = 200
+    >>> u.uri = "http://local.ch/"
+    >>> u.updated = datetime.datetime(2009, 1, 2, 3, 4, 5)
+    >>> u.pairs = {'a': 'b'}
+    >>> record = uri_to_record(u)
+    >>> record['updated'], record['pairs']
+    ('2009-01-02T03:04:05', [{'k': 'a', 'v': 'b'}])
+    >>> u1 = record_to_uri(record)
+    >>> u1.updated == u.updated, u1.pairs == u.pairs
+    (True, True)
+    """
+    record = uri.data()
+    for k in ('created', 'updated'):
+        if isinstance(record[k], datetime.datetime):
+            record[k] = record[k].strftime(DATE_FORMAT)
+    if record['pairs'] is not None:
+        record['pairs'] = expand_dict(record['pairs'])
+    return record
+
+def record_to_uri(record):
+    """
+    Build a URI from a couch document
+    """
+    data = {}
+    data['meta'] = {}
+    
+    for k, v in record.items():
+        k = k.encode('utf-8')
+        if k == 'tags':
+            try:
+                data[k] = [tag.encode('utf-8') for tag in v]
+            except:
+                data[k] = None
+        elif k == 'pairs':
+            data[k] = contract_dict(v)
+        elif k == '_rev':
+            data['meta']['_rev'] = v
+        elif k in ('created', 'updated') and isinstance(v, basestring):
+            data[k] = datetime.datetime.strptime(v, DATE_FORMAT)
+        elif isinstance(v, unicode):
+            data[k] = v.encode('utf-8')
+        else:
+            data[k] = v
+
+    return URI.load(data)
+
 def expand_dict(d):
     """
     Couchdb doesn't directly support storing of hashes
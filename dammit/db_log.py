@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A log structured backend with no dependencies, for edge nodes.
+
+Every insert, update or delete appends a record to a single log
+file; nothing is ever rewritten in place. An in-memory dict maps
+each id to the offset of its latest record, and reads go through
+an mmap of the log.
+
+Each record is a header - crc32, operation, id (20 raw bytes),
+payload length - followed by the payload, the pickled URI.data().
+The crc covers everything after itself, so on opening, the log
+is replayed to rebuild the index and stops at the first record
+that's truncated or fails its crc (a crash mid-write) - the log
+is truncated there.
+
+Superseded and deleted records are garbage, reclaimed by
+compact(), which copies the live records to a new log and swaps
+it in. Writes carry on while it copies; records appended
+meanwhile are copied across under the lock, just before the swap.
+Compaction runs in a background thread once garbage passes
+compact_ratio of the log.
+
+Writes are not fsync'd unless sync is set - a crash of the
+machine (not just the process) can lose the last writes.
+"""
+import os, struct, mmap, zlib, threading, time, heapq, logging
+import binascii
+import cPickle as pickle
+from uri import URI
+import db_cache, purge
+
+HEADER = struct.Struct('>Ic20sI')
+"""crc32, operation, raw id, payload length"""
+
+PUT = 'P'
+DELETE = 'D'
+
+DEFAULT_COMPACT_RATIO = 0.5
+"""Compact once this fraction of the log is garbage."""
+
+DEFAULT_COMPACT_MIN = 64 * 1024 * 1024
+"""Don't bother compacting logs smaller than this (bytes)."""
+
+DEFAULT_COMPACT_INTERVAL = 60
+"""Seconds between checks for whether to compact."""
+
+class CorruptRecord(Exception):
+    pass
+
+def encode(op, id, payload = ''):
+    """
+    A log record for the given 40 character hex id
+
+    >>> r = encode(PUT, 'a' * 40, 'hello')
+    >>> len(r) == HEADER.size + 5
+    True
+    >>> decode(r, 0)
+    ('P', 'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa', 29, 5)
+    """
+    body = HEADER.pack(0, op, binascii.unhexlify(id), len(payload))[4:]
+    crc = zlib.crc32(payload, zlib.crc32(body)) & 0xffffffff
+    return struct.pack('>I', crc) + body + payload
+
+def decode(buffer, offset):
+    """
+    Check the record at offset - returns ( op, id, payload
+    offset, payload length ), raising CorruptRecord if
+    it's incomplete or fails its crc
+
+    >>> r = encode(DELETE, 'b' * 40)
+    >>> decode(r[:-1], 0)
+    Traceback (most recent call last):
+    ...
+    CorruptRecord: 0
+    >>> decode(r[:4] + 'P' + r[5:], 0)
+    Traceback (most recent call last):
+    ...
+    CorruptRecord: 0
+    """
+    start = offset + HEADER.size
+    if start > len(buffer):
+        raise CorruptRecord, offset
+    crc, op, raw, length = HEADER.unpack(buffer[offset:start])
+    if start + length > len(buffer) or op not in (PUT, DELETE):
+        raise CorruptRecord, offset
+    check = zlib.crc32(buffer[offset + 4:start])
+    check = zlib.crc32(buffer[start:start + length], check)
+    if check & 0xffffffff != crc:
+        raise CorruptRecord, offset
+    return op, binascii.hexlify(raw), start, length
+
+def dumps(uri):
+    return pickle.dumps(uri.data(), pickle.HIGHEST_PROTOCOL)
+
+def loads(payload):
+    return URI.load(pickle.loads(payload))
+
+def replay(buffer, offset, index):
+    """
+    Apply the records in buffer from offset to index, which
+    maps raw id -> record offset. Returns ( the offset where
+    the valid records end, bytes of garbage they leave )
+
+    >>> buffer = encode(PUT, 'a' * 40, 'one') + encode(PUT, 'a' * 40, 'two')
+    >>> index = {}
+    >>> replay(buffer + 'junk', 0, index)
+    (64, 32)
+    >>> index.values()
+    [32]
+    >>> buffer += encode(DELETE, 'a' * 40)
+    >>> replay(buffer, 64, index)
+    (93, 61)
+    >>> index
+    {}
+    """
+    garbage = 0
+    end = len(buffer)
+    while offset < end:
+        try:
+            op, id, start, length = decode(buffer, offset)
+        except CorruptRecord:
+            break
+        key = binascii.unhexlify(id)
+        old = index.pop(key, None)
+        if old is not None:
+            garbage += record_size(buffer, old)
+        if op == PUT:
+            index[key] = offset
+        else:
+            garbage += start + length - offset
+        offset = start + length
+    return offset, garbage
+
+def record_size(buffer, offset):
+    return HEADER.size + HEADER.unpack(buffer[offset:offset + HEADER.size])[3]
+
+class LogDB(object):
+    """
+    >>> import os, tempfile
+    >>> from datetime import datetime
+    >>> path = os.path.join(tempfile.mkdtemp(), 'urldammit.log')
+    >>> db = LogDB({'log_path': path, 'compact_interval': 0})
+    >>> uris = []
+    >>> for i in range(3):
+    ...     u = URI()
+    ...     u.uri = 'http://local.ch/%s.html' % i
+    ...     u.status = 200
+    ...     u.created = u.updated = datetime(2009, 1, i + 1)
+    ...     u.tags = ['foo']
+    ...     uris.append(u)
+    >>> db.insert(uris[0])
+    >>> db.insert_many(uris[1:])
+    >>> u = db.load(uris[0].id)
+    >>> u.uri, u.tags, u.created
+    ('http://local.ch/0.html', ['foo'], datetime.datetime(2009, 1, 1, 0, 0))
+    >>> u.pairs = {'title': 'Zero'}
+    >>> db.update(u)
+    >>> db.load(u.id).pairs
+    {'title': 'Zero'}
+    >>> db.delete(uris[1].id)
+    >>> print db.load(uris[1].id)
+    None
+    >>> sorted(db.load_many([x.id for x in uris]).keys()) == sorted([uris[0].id, uris[2].id])
+    True
+    >>> db.delete_many([uris[2].id])
+    >>> db.load_many([x.id for x in uris]).keys() == [uris[0].id]
+    True
+    >>> db.insert(uris[2])
+
+    Most recently written first
+
+    >>> [[x.uri for x in batch] for batch in db.recent(5, 1)]
+    [['http://local.ch/2.html'], ['http://local.ch/0.html']]
+
+    Compaction drops the superseded and deleted records
+
+    >>> size = os.path.getsize(path)
+    >>> db.garbage > 0
+    True
+    >>> db.compact()
+    >>> db.garbage, os.path.getsize(path) < size
+    (0, True)
+    >>> db.load(u.id).pairs
+    {'title': 'Zero'}
+
+    Recovery - a torn write at the end is dropped
+
+    >>> db.insert(uris[1])
+    >>> db.close()
+    >>> size = os.path.getsize(path)
+    >>> f = open(path, 'ab'); f.write(encode(PUT, u.id, 'xxx')[:-1]); f.close()
+    >>> db = LogDB({'log_path': path, 'compact_interval': 0})
+    >>> os.path.getsize(path) == size
+    True
+    >>> len(db.load_many([x.id for x in uris]))
+    3
+
+    By status
+
+    >>> [x.uri for x in db.by_status(200, 2)]
+    ['http://local.ch/2.html', 'http://local.ch/1.html']
+    >>> [x.uri for x in db.by_status(200, 2, (uris[1].updated, uris[1].id))]
+    ['http://local.ch/0.html']
+
+    By tags
+
+    >>> found = db.by_tags(['foo'], 2, status = 200)
+    >>> found += db.by_tags(['foo', 'bar'], 2, found[-1].id, match_any = True)
+    >>> [x.id for x in found] == sorted([x.id for x in uris])
+    True
+    >>> db.by_tags(['foo', 'bar'], 2), db.by_tags(['foo'], 2, status = 404)
+    ([], [])
+
+    Purging
+
+    >>> db.purge(retention = {200: 1}, pause = 0, now = datetime(2009, 1, 3))
+    1
+    >>> print db.load(uris[0].id)
+    None
+    >>> db.close()
+    """
+    def __init__(self, config = None, bootstrap = True):
+        self.config = self._default_config(config)
+        self.lock = threading.RLock()
+        self.fd = None
+        self.map = None
+        self.index = {}
+        self.size = 0
+        self.garbage = 0
+        self.compactor = None
+        self.compacting = threading.Lock()
+        if bootstrap:
+            self.bootstrap()
+
+    def fresh_connection(self):
+        """
+        Nothing to connect to
+        """
+        return self
+
+    @db_cache.load
+    def load(self, id):
+        """
+        Takes a SHA-1 id
+        """
+        self.lock.acquire()
+        try:
+            return self._read(binascii.unhexlify(id))
+        finally:
+            self.lock.release()
+
+    @db_cache.load_many
+    def load_many(self, ids):
+        """
+        Takes a list of SHA-1 ids, returns a dict
+        of id -> URI for those found
+        """
+        found = {}
+        self.lock.acquire()
+        try:
+            for id in ids:
+                uri = self._read(binascii.unhexlify(id))
+                if uri:
+                    found[id] = uri
+        finally:
+            self.lock.release()
+        return found
+
+    def recent(self, limit, batch_size = 500):
+        """
+        Generate batches (lists) of the most recently
+        written URIs, newest first, up to limit in total.
+        Written through URIManager, that's the order
+        of updated
+        """
+        self.lock.acquire()
+        try:
+            keys = heapq.nlargest(limit, self.index.iteritems(),
+                                  key = lambda item: item[1])
+        finally:
+            self.lock.release()
+        keys = [key for key, offset in keys]
+        for i in range(0, len(keys), batch_size):
+            self.lock.acquire()
+            try:
+                uris = [self._read(key) for key in keys[i:i + batch_size]]
+            finally:
+                self.lock.release()
+            yield [uri for uri in uris if uri]
+
+    @db_cache.insert
+    def insert(self, uri):
+        """
+        Takes a URI object
+        """
+        self._append([(PUT, uri.id, dumps(uri))])
+
+    @db_cache.insert_many
+    def insert_many(self, uris):
+        """
+        Takes a list of URI objects, appended with one write
+        """
+        self._append([(PUT, uri.id, dumps(uri)) for uri in uris])
+
+    @db_cache.update
+    def update(self, uri):
+        """
+        Takes a URI object
+        """
+        self._append([(PUT, uri.id, dumps(uri))])
+
+    @db_cache.update_many
+    def update_many(self, uris):
+        """
+        Takes a list of URI objects, appended with one write
+        """
+        self._append([(PUT, uri.id, dumps(uri)) for uri in uris])
+
+    @db_cache.delete
+    def delete(self, id):
+        """
+        Takes a SHA-1 id
+        """
+        self._append([(DELETE, id, '')])
+
+    @db_cache.delete_many
+    def delete_many(self, ids):
+        """
+        Takes a list of SHA-1 ids, appended with one write
+        """
+        self._append([(DELETE, id, '') for id in ids])
+
+    def bootstrap(self, **kwargs):
+        """
+        Open the log, recovering the index from it, and start
+        the background compactor
+        """
+        self.lock.acquire()
+        try:
+            self._open()
+        finally:
+            self.lock.release()
+
+        interval = self.config['compact_interval']
+        if interval and not self.compactor:
+            self.compactor = threading.Thread(
+                target = self._compact_loop, args = (interval, ))
+            self.compactor.setDaemon(True)
+            self.compactor.start()
+
+    def stale(self, status, before, batch_size = 500):
+        """
+        Generate batches (lists) of the ids of records with
+        the status last updated before the given time, oldest
+        first. There's no index on status, so this reads
+        every record
+        """
+        found = [(u.updated, u.id) for u in self._scan(batch_size)
+                 if u.status == status and u.updated and u.updated < before]
+        found.sort()
+        for i in range(0, len(found), batch_size):
+            yield [id for updated, id in found[i:i + batch_size]]
+
+    def by_status(self, status, limit, after = None):
+        """
+        A page (list) of up to limit URIs with the status, most
+        recently updated first - after is the ( updated, id ) of
+        the last URI on the previous page. There's no index on
+        status, so every page reads every record
+        """
+        uris = [u for u in self._scan() if u.status == status
+                and (after is None or (u.updated, u.id) < after)]
+        return heapq.nlargest(limit, uris, key = lambda u: (u.updated, u.id))
+
+    def by_tags(self, tags, limit, after = None, status = None,
+                match_any = False):
+        """
+        A page (list) of up to limit URIs with all the tags (or
+        any of them), optionally only those with the status, in
+        id order - after is the id of the last URI on the
+        previous page. There's no index on tags, so every page
+        reads every record
+        """
+        tags = set(tags)
+        def tagged(u):
+            found = tags.intersection(u.tags or [])
+            if match_any:
+                return found
+            return found == tags
+        uris = [u for u in self._scan()
+                if (after is None or u.id > after)
+                and (status is None or u.status == status) and tagged(u)]
+        return heapq.nsmallest(limit, uris, key = lambda u: u.id)
+
+    def purge(self, **kwargs):
+        """
+        Delete stale records - see purge.run
+        """
+        return purge.run(self, **kwargs)
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self._close()
+        finally:
+            self.lock.release()
+
+    def compact(self):
+        """
+        Rewrite the log with just the live records
+        """
+        path = self.config['log_path']
+        tmp = path + '.compact'
+
+        self.compacting.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                live = sorted(self.index.items(), key = lambda item: item[1])
+                buffer, end = self.map, self.size
+            finally:
+                self.lock.release()
+
+            out = open(tmp, 'wb')
+            try:
+                # the old mapping stays valid while writers
+                # carry on appending
+                index = {}
+                copied = 0
+                for key, offset in live:
+                    size = record_size(buffer, offset)
+                    out.write(buffer[offset:offset + size])
+                    index[key] = copied
+                    copied += size
+
+                self.lock.acquire()
+                try:
+                    # catch up with the records written meanwhile
+                    self._remap()
+                    if self.size > end:
+                        out.write(self.map[end:self.size])
+                    out.flush()
+                    os.fsync(out.fileno())
+                    size = out.tell()
+                    out.close()
+
+                    fd = os.open(tmp, os.O_RDWR | os.O_APPEND)
+                    map = None
+                    if size:
+                        map = mmap.mmap(fd, size, access = mmap.ACCESS_READ)
+                    garbage = replay(map or '', copied, index)[1]
+                    os.rename(tmp, path)
+                    self._close()
+                    self.fd, self.map, self.size = fd, map, size
+                    self.index, self.garbage = index, garbage
+                finally:
+                    self.lock.release()
+            finally:
+                if not out.closed:
+                    out.close()
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        finally:
+            self.compacting.release()
+
+    def _default_config(self, config):
+        if not config: config = {}
+        config['log_path'] = config.get('log_path', 'urldammit.log')
+        config['sync'] = config.get('sync', False)
+        config['compact_ratio'] = config.get(
+            'compact_ratio', DEFAULT_COMPACT_RATIO)
+        config['compact_min'] = config.get('compact_min', DEFAULT_COMPACT_MIN)
+        config['compact_interval'] = config.get(
+            'compact_interval', DEFAULT_COMPACT_INTERVAL)
+        return config
+
+    def _open(self):
+        """
+        Open the log and rebuild the index, truncating any
+        damaged tail
+        """
+        path = self.config['log_path']
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+        self.size = os.fstat(self.fd).st_size
+        self.index = {}
+        self.map = None
+        self._remap()
+        end, self.garbage = replay(self.map or '', 0, self.index)
+        if end < self.size:
+            logging.warning(
+                "db_log: %s damaged at byte %s of %s - truncating",
+                path, end, self.size)
+            os.ftruncate(self.fd, end)
+            self.size = end
+            self.map = None
+            self._remap()
+
+    def _close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _remap(self):
+        """
+        Map the log up to its current size
+        """
+        if self.map is not None and len(self.map) >= self.size:
+            return
+        # not closing the old map - compact() may be reading it.
+        # It's unmapped once unreferenced
+        if self.size:
+            self.map = mmap.mmap(self.fd, self.size, access = mmap.ACCESS_READ)
+
+    def _read(self, key):
+        offset = self.index.get(key)
+        if offset is None:
+            return None
+        self._remap()
+        op, id, start, length = decode(self.map, offset)
+        return loads(self.map[start:start + length])
+
+    def _append(self, records):
+        """
+        Write ( op, id, payload ) records in one write, then
+        point the index at them
+        """
+        data = []
+        sizes = []
+        for op, id, payload in records:
+            record = encode(op, id, payload)
+            data.append(record)
+            sizes.append(len(record))
+        data = ''.join(data)
+
+        self.lock.acquire()
+        try:
+            os.write(self.fd, data)
+            if self.config['sync']:
+                os.fsync(self.fd)
+            offset = self.size
+            self.size += len(data)
+            for (op, id, payload), size in zip(records, sizes):
+                key = binascii.unhexlify(id)
+                old = self.index.pop(key, None)
+                if old is not None:
+                    self._remap()
+                    self.garbage += record_size(self.map, old)
+                if op == PUT:
+                    self.index[key] = offset
+                else:
+                    self.garbage += size
+                offset += size
+        finally:
+            self.lock.release()
+
+    def _scan(self, batch_size = 500):
+        """
+        Generate every URI, taking the lock a batch at a time
+        """
+        self.lock.acquire()
+        try:
+            keys = self.index.keys()
+        finally:
+            self.lock.release()
+
+        for i in range(0, len(keys), batch_size):
+            self.lock.acquire()
+            try:
+                uris = [self._read(key) for key in keys[i:i + batch_size]]
+            finally:
+                self.lock.release()
+            for u in uris:
+                if u:
+                    yield u
+
+    def _compact_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            if self.fd is None:
+                continue
+            if self.size < self.config['compact_min']:
+                continue
+            if self.garbage < self.size * self.config['compact_ratio']:
+                continue
+            try:
+                self.compact()
+            except Exception:
+                logging.exception("db_log: compaction failed")
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
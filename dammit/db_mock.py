@@ -1,8 +1,45 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import purge
+
 class MockDB(object):
+    """
+    In memory, with an inverted index of tags
+
+    >>> from uri import URI
+    >>> db = MockDB()
+    >>> for n in range(4):
+    ...     u = URI()
+    ...     u.uri = 'http://local.ch/%s.html' % n
+    ...     u.status = 200
+    ...     u.tags = ['all', n % 2 and 'odd' or 'even']
+    ...     db.insert(u)
+    >>> u.tags = ['all']
+    >>> db.update(u)
+    >>> sorted(db.tags)
+    ['all', 'even', 'odd']
+    >>> [x.uri for x in db.by_tags(['all', 'odd'], 5)]
+    ['http://local.ch/1.html']
+    >>> page = db.by_tags(['odd', 'even'], 2, match_any = True)
+    >>> page += db.by_tags(['odd', 'even'], 2, page[-1].id, match_any = True)
+    >>> sorted(x.uri for x in page)
+    ['http://local.ch/0.html', 'http://local.ch/1.html', 'http://local.ch/2.html']
+    >>> [x.id for x in page] == sorted(x.id for x in page)
+    True
+    >>> db.delete_many([x.id for x in db.uris.values()])
+    >>> db.tags, db.tagged
+    ({}, {})
+    """
     def __init__(self):
         self.uris = {}
+        self.tags = {}
+        self.tagged = {}
+
+    def fresh_connection(self):
+        """
+        Nothing to connect to
+        """
+        return self
 
     def load(self, id):
         """
@@ -10,23 +47,116 @@ class MockDB(object):
         """
         return self.uris.get(id, None)
 
+    def load_many(self, ids):
+        """
+        Takes a list of SHA-1 ids, returns a dict
+        of id -> URI for those found
+        """
+        found = {}
+        for id in ids:
+            if id in self.uris:
+                found[id] = self.uris[id]
+        return found
+
+    def recent(self, limit, batch_size = 500):
+        """
+        Generate batches (lists) of the most recently
+        updated URIs, newest first, up to limit in total
+        """
+        uris = self.uris.values()
+        uris.sort(key = lambda u: (u.updated, u.id), reverse = True)
+        uris = uris[:limit]
+        for i in range(0, len(uris), batch_size):
+            yield uris[i:i + batch_size]
+
+    def stale(self, status, before, batch_size = 500):
+        """
+        Generate batches (lists) of the ids of records with
+        the status last updated before the given time, oldest
+        first
+        """
+        uris = [u for u in self.uris.values()
+                if u.status == status and u.updated and u.updated < before]
+        uris.sort(key = lambda u: (u.updated, u.id))
+        for i in range(0, len(uris), batch_size):
+            yield [u.id for u in uris[i:i + batch_size]]
+
+    def by_status(self, status, limit, after = None):
+        """
+        A page (list) of up to limit URIs with the status, most
+        recently updated first - after is the ( updated, id ) of
+        the last URI on the previous page
+        """
+        uris = [u for u in self.uris.values() if u.status == status
+                and (after is None or (u.updated, u.id) < after)]
+        uris.sort(key = lambda u: (u.updated, u.id), reverse = True)
+        return uris[:limit]
+
+    def by_tags(self, tags, limit, after = None, status = None,
+                match_any = False):
+        """
+        A page (list) of up to limit URIs with all the tags (or
+        any of them), optionally only those with the status, in
+        id order - after is the id of the last URI on the
+        previous page
+        """
+        found = [self.tags.get(tag, set()) for tag in tags]
+        if match_any:
+            ids = set().union(*found)
+        else:
+            ids = set(found[0]).intersection(*found[1:])
+        ids = [id for id in ids if after is None or id > after]
+        ids.sort()
+        uris = []
+        for id in ids:
+            u = self.uris[id]
+            if status is None or u.status == status:
+                uris.append(u)
+                if len(uris) == limit:
+                    break
+        return uris
+
     def insert(self, uri):
         """
         Takes a URI object
         """
-        self.uris[uri.id] = uri
+        self._store(uri)
 
     def update(self, uri):
         """
         Takes a URI object
         """
-        self.uris[uri.id] = uri
+        self._store(uri)
+
+    def insert_many(self, uris):
+        """
+        Takes a list of URI objects
+        """
+        for uri in uris:
+            self._store(uri)
+
+    def update_many(self, uris):
+        """
+        Takes a list of URI objects
+        """
+        for uri in uris:
+            self._store(uri)
 
     def delete(self, id):
         """
         Takes a SHA-1 id
         """
         del self.uris[id]
+        self._untag(id)
+
+    def delete_many(self, ids):
+        """
+        Takes a list of SHA-1 ids - those not stored
+        are ignored
+        """
+        for id in ids:
+            self.uris.pop(id, None)
+            self._untag(id)
 
     def bootstrap(self, **kwargs):
         """
@@ -36,6 +166,35 @@ class MockDB(object):
 
     def purge(self, **kwargs):
         """
-        Clean up old data
+        Delete stale records - see purge.run
         """
-        pass
+        return purge.run(self, **kwargs)
+
+    def _store(self, uri):
+        """
+        Store a URI and index its tags - tagged keeps the tags
+        indexed for each id, as the URI may have been changed in
+        place since
+        """
+        self.uris[uri.id] = uri
+        self._untag(uri.id)
+        if uri.tags:
+            self.tagged[uri.id] = list(uri.tags)
+            for tag in uri.tags:
+                self.tags.setdefault(tag, set()).add(uri.id)
+
+    def _untag(self, id):
+        for tag in self.tagged.pop(id, []):
+            ids = self.tags.get(tag)
+            if ids is None:
+                continue
+            ids.discard(id)
+            if not ids:
+                del self.tags[tag]
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -1,26 +1,242 @@
 
 # -*- coding: utf-8 -*-
-import time
+import time, threading
 import MySQLdb
 from MySQLdb import IntegrityError
 from uri import URI
-import db_cache, constants
+from pool import Pool
+import db_cache, constants, stats, purge
 
 def todatetime(dt):
     return time.strftime("%Y-%m-%d %H:%M:%S", dt.timetuple())
 
+def placeholders(values):
+    """
+    Parameter markers for an IN ( ... ) clause
+    >>> placeholders(['a', 'b', 'c'])
+    '%s, %s, %s'
+    """
+    return ", ".join(["%s"] * len(values))
+
+def uri_data(row):
+    """
+    Turn a ( uri, location, status, created, updated ) row
+    into data for URI.load - tags and pairs are added with
+    add_tag / add_pair
+    """
+    data = {}
+    data['uri'] = None
+    if isinstance(row[0], unicode):
+        data['uri'] = row[0].encode('utf8')
+
+    data['location'] = None
+    if isinstance(row[1], unicode):
+        data['location'] = row[1].encode('utf8')
+
+    data['status'] = int(row[2])
+    data['created'] = row[3]
+    data['updated'] = row[4]
+    data['tags'] = None
+    data['pairs'] = None
+    return data
+
+def add_tag(data, tag):
+    if data['tags'] == None:
+        data['tags'] = []
+    data['tags'].append(tag.encode('utf8'))
+
+def add_pair(data, key, value):
+    if data['pairs'] == None:
+        data['pairs'] = dict()
+    data['pairs'][key.encode('utf8')] = value.encode('utf8')
+
+LOAD_SQL = """SELECT 'u', %(id)s, uri, location, status, created, updated
+FROM urldammit_uris WHERE id IN (%(keys)s)
+UNION ALL
+SELECT 't', %(id)s, tag, NULL, NULL, NULL, NULL
+FROM urldammit_tags WHERE id IN (%(keys)s)
+UNION ALL
+SELECT 'p', %(id)s, pair_key, pair_value, NULL, NULL, NULL
+FROM urldammit_pairs WHERE id IN (%(keys)s)"""
+"""Records, tags and pairs in one round trip - see fold"""
+
+def create_tables(cursor, id_bytes = 40, suffix = ''):
+    """
+    Create the tables (if they don't exist), with ids stored
+    as 40 byte hex strings or 20 byte raw SHA-1 digests. The
+    suffix is added to the table names
+    """
+    sql = """CREATE TABLE IF NOT EXISTS urldammit_uris%s (
+        id BINARY( %s ) NOT NULL ,
+        uri VARCHAR( %s ) NOT NULL ,
+        location VARCHAR( %s ) NULL ,
+        status MEDIUMINT UNSIGNED NOT NULL ,
+        created DATETIME NOT NULL ,
+        updated DATETIME NOT NULL ,
+        PRIMARY KEY ( id ),
+        KEY updated_index ( updated ),
+        KEY status_updated_index ( status, updated )
+        ) ENGINE = innodb CHARACTER SET utf8 COLLATE utf8_unicode_ci;
+        """ % ( suffix, id_bytes, constants.URI_LEN, constants.URI_LOCATION_LEN )
+    cursor.execute(sql)
+
+    sql = """CREATE TABLE IF NOT EXISTS urldammit_tags%s (
+    id BINARY( %s ) NOT NULL ,
+    tag VARCHAR( %s ) NOT NULL ,
+    KEY id_index (id),
+    KEY tag_id_index (tag, id)
+    ) ENGINE = innodb CHARACTER SET utf8 COLLATE utf8_unicode_ci;
+    """ % ( suffix, id_bytes, constants.URI_TAG_LEN )
+    cursor.execute(sql)
+
+    sql = """CREATE TABLE IF NOT EXISTS urldammit_pairs%s (
+    id BINARY( %s ) NOT NULL ,
+    pair_key VARCHAR( %s ) NOT NULL ,
+    pair_value VARCHAR( %s ) NOT NULL ,
+    KEY id_index (id)
+    ) ENGINE = innodb CHARACTER SET utf8 COLLATE utf8_unicode_ci;
+    """ % ( suffix, id_bytes, constants.URI_PAIR_KEY_LEN, constants.URI_PAIR_VALUE_LEN )
+    cursor.execute(sql)
+
+def id_bytes(cursor, table = 'urldammit_uris'):
+    """
+    Size of the id column of an existing table - 40 for hex
+    ids, 20 for raw digests - or None if there's no table
+    """
+    cursor.execute("SHOW TABLES LIKE %s", (table, ))
+    if not cursor.fetchall():
+        return None
+    cursor.execute("SHOW COLUMNS FROM %s LIKE 'id'" % table)
+    type = cursor.fetchone()[1]
+    return int(type[type.index('(') + 1:type.index(')')])
+
+def fold(rows):
+    """
+    Fold the rows from LOAD_SQL into a dict of id -> data
+    for URI.load. Rows are ( kind, id, ... ) where kind is
+    'u' for the record itself, 't' for a tag or 'p' for a pair.
+    Tags and pairs keep the order they came back in, and any
+    without a record are ignored
+
+    >>> rows = [
+    ...     ('u', 'a', u'http://local.ch/', None, 200L, 'c', 'u'),
+    ...     ('t', 'a', u'foo', None, None, None, None),
+    ...     ('t', 'a', u'bar', None, None, None, None),
+    ...     ('t', 'b', u'orphan', None, None, None, None),
+    ...     ('p', 'a', u'k', u'v', None, None, None),
+    ...     ]
+    >>> records = fold(rows)
+    >>> records.keys()
+    ['a']
+    >>> a = records['a']
+    >>> a['uri'], a['status'], a['tags'], a['pairs']
+    ('http://local.ch/', 200, ['foo', 'bar'], {'k': 'v'})
+    """
+    records = {}
+    tags = []
+    pairs = []
+    for row in rows:
+        kind = row[0]
+        if kind == 'u':
+            records[row[1]] = uri_data(row[2:])
+        elif kind == 't':
+            tags.append(row)
+        else:
+            pairs.append(row)
+
+    for row in tags:
+        if row[1] in records:
+            add_tag(records[row[1]], row[2])
+
+    for row in pairs:
+        if row[1] in records:
+            add_pair(records[row[1]], row[2], row[3])
+
+    return records
+
+def utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf8')
+    return s
+
+def diff_tags(stored, tags):
+    """
+    Tags to delete and tags to insert to turn the stored
+    tags into the new ones
+
+    >>> diff_tags(['a', 'b', 'c'], ['c', 'd', 'a'])
+    (['b'], ['d'])
+    >>> diff_tags(['a', 'a'], ['a'])
+    ([], [])
+    """
+    keep = set(tags)
+    removed = []
+    for tag in stored:
+        if tag not in keep and tag not in removed:
+            removed.append(tag)
+    have = set(stored)
+    added = [tag for tag in tags if tag not in have]
+    return removed, added
+
+def diff_pairs(stored, pairs):
+    """
+    Keys to delete and ( key, value ) pairs to insert to turn
+    the stored pairs into the new ones - a changed value is
+    deleted and inserted again
+
+    >>> diff_pairs({'a': '1', 'b': '2', 'c': '3'}, {'a': '1', 'b': '5', 'd': '4'})
+    (['b', 'c'], [('b', '5'), ('d', '4')])
+    """
+    removed = [k for k, v in stored.items() if pairs.get(k) != v]
+    added = [(k, v) for k, v in pairs.items() if stored.get(k) != v]
+    removed.sort()
+    added.sort()
+    return removed, added
+
+class CountingCursor(object):
+    """
+    Wraps a DB-API cursor, counting the statements sent. An
+    executemany counts as one statement
+
+    >>> class Cursor(object):
+    ...     def execute(self, sql, params = None): pass
+    ...     def executemany(self, sql, params): pass
+    ...     rowcount = 1
+    >>> c = CountingCursor(Cursor())
+    >>> c.execute('SELECT 1')
+    >>> c.executemany('INSERT ...', [(1, ), (2, )])
+    >>> c.statements, c.rowcount
+    (2, 1)
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.statements = 0
+
+    def execute(self, *args, **kwargs):
+        self.statements += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.statements += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
 def reconnect(func):
     """
-    Decorator - reconnect and retry if we
-    get an OperationalError
+    Decorator - run with a connection checked out of the pool,
+    unless this thread already holds one. If we get an
+    OperationalError the connection is discarded and we
+    retry once with another
     """
     def retry(self, *args, **kwargs):
-        try:
+        if self.db is not None:
             return func(self, *args, **kwargs)
+        try:
+            return self._checked_out(func, args, kwargs)
         except MySQLdb.OperationalError, e:
-            del self.db
-            self.db = self._connect()
-            return func(self, *args, **kwargs)
+            return self._checked_out(func, args, kwargs)
     return retry
 
 class MySQL(object):
@@ -59,73 +275,260 @@ class MySQL(object):
     True
     >>> u2.pairs == u1.pairs
     True
+    >>> u3 = URI()
+    >>> u3.uri = 'http://local.ch/test2.html'
+    >>> u3.status = 200
+    >>> u3.created = now()
+    >>> u3.updated = now()
+    >>> m.insert(u3)
+    >>> found = m.load_many([u2.id, u3.id, 'abc'])
+    >>> sorted(found.keys()) == sorted([u2.id, u3.id])
+    True
+    >>> found[u2.id].tags == u1.tags
+    True
+    >>> [[x.id for x in batch] for batch in m.recent(2, 1)] == [[u3.id], [u2.id]]
+    True
+    >>> before = stats.snapshot()['mysql'].get('update_statements', 0)
+    >>> u2.tags = ['abc', 'xyz', 'new']
+    >>> m.update(u2)
+    >>> stats.snapshot()['mysql']['update_statements'] - before
+    3
+    >>> m.load(u2.id).tags
+    ['abc', 'xyz', 'new']
+
+    Tags differing only in case are kept apart
+
+    >>> u2.tags = ['Foo', 'foo']
+    >>> m.update(u2)
+    >>> u2.tags = ['foo']
+    >>> m.update(u2)
+    >>> m.load(u2.id).tags
+    ['foo']
+    >>> m.delete(u3.id)
     >>> m.delete(u2.id)
     >>> None == m.load(u2.id)
     True
+
+    Batches are a transaction each
+
+    >>> uris = []
+    >>> for i in range(3):
+    ...     u = URI()
+    ...     u.uri = 'http://local.ch/batch_%s.html' % i
+    ...     u.status = 200
+    ...     u.created = u.updated = now()
+    ...     uris.append(u)
+    >>> m.insert_many(uris)
+    >>> for u in uris: u.tags = ['batch']
+    >>> m.update_many(uris)
+    >>> [x.tags for x in m.load_many([u.id for u in uris]).values()]
+    [['batch'], ['batch'], ['batch']]
+    >>> page = m.by_status(200, 2)
+    >>> len(page), m.by_status(404, 2)
+    (2, [])
+    >>> after = m.by_status(200, 2, (page[-1].updated, page[-1].id))
+    >>> sorted([x.id for x in page + after]) == sorted([u.id for u in uris])
+    True
+    >>> found = m.by_tags(['batch'], 2, status = 200)
+    >>> found += m.by_tags(['batch', 'none'], 2, found[-1].id, match_any = True)
+    >>> [x.id for x in found] == sorted([u.id for u in uris])
+    True
+    >>> m.by_tags(['batch', 'none'], 2), m.by_tags(['batch'], 2, status = 404)
+    ([], [])
+    >>> m.by_tags(['Batch'], 2), m.by_tags(['batch', 'BATCH'], 2)
+    ([], [])
+    >>> m.delete_many([uris[0].id])
+    >>> from datetime import timedelta
+    >>> m.purge(retention = {200: 0}, pause = 0, now = now() + timedelta(1))
+    2
+    >>> m.load_many([u.id for u in uris])
+    {}
     """    
     def __init__(self, config = None, dropfirst = False, bootstrap = True):
         self.config = self._default_config(config)
-        if bootstrap:
-            self.db = self._connect()
-            self.bootstrap(dropfirst)
+        # ids are hex everywhere outside this class - with
+        # binary_ids they're converted in the SQL itself
+        if self.config['binary_ids']:
+            self.id_bytes = 20
+            self.key_sql = 'UNHEX(%s)'
+            self.id_sql = 'LOWER(HEX(id))'
         else:
-            self.db = self._connect(usedb = True)
+            self.id_bytes = 40
+            self.key_sql = '%s'
+            self.id_sql = 'id'
+        self.local = threading.local()
+        self.pool = Pool(
+            lambda: self._connect(usedb = True),
+            size = self.config['pool_size'],
+            timeout = self.config['pool_timeout'],
+            max_idle = self.config['pool_max_idle'],
+            namespace = 'mysql_pool'
+            )
+        for name in ('in_use', 'idle'):
+            stats.register_gauge('mysql_pool', name,
+                                 lambda name = name: self.pool.gauges()[name])
+        if bootstrap:
+            # may not have a database to USE yet so
+            # this connection doesn't come from the pool
+            self.local.db = self._connect()
+            try:
+                self.bootstrap(dropfirst)
+            finally:
+                self.local.db.close()
+                self.local.db = None
 
     def fresh_connection(self):
         """
-        Make sure we have a fresh connection for each request
+        Connections are checked out of the pool per operation,
+        so there's nothing to do here
         """
-        return MySQL(config = self.config, bootstrap = False)
+        return self
 
-    @db_cache.load
-    @reconnect
-    def load(self, id):
+    def _get_db(self):
+        return getattr(self.local, 'db', None)
+
+    db = property(_get_db, doc = "Connection checked out by the current thread, if any")
+
+    def _checked_out(self, func, args, kwargs):
         """
-        Takes a SHA-1 id
+        Call func with a pooled connection as self.db
         """
-        cursor = self.db.cursor()
-
-        sql = """SELECT
-        uri, location, status, created, updated
-        FROM urldammit_uris WHERE id = %s"""
-        cursor.execute(sql, (id, ))
-        row = cursor.fetchone()
+        db = self.local.db = self.pool.get()
+        self.local.cursors = []
+        try:
+            try:
+                result = func(self, *args, **kwargs)
+            except MySQLdb.OperationalError:
+                self._release(db, broken = True)
+                raise
+            except:
+                self._release(db)
+                raise
+            self._release(db)
+            return result
+        finally:
+            self.local.db = None
+            name = func.__name__
+            stats.incr('mysql', name)
+            stats.incr('mysql', name + '_statements',
+                       sum([c.statements for c in self.local.cursors]))
+            self.local.cursors = []
+
+    def cursor(self):
+        """
+        A cursor on the current thread's connection, which
+        counts the statements sent for the stats
+        """
+        cursor = CountingCursor(self.db.cursor())
+        self.local.cursors.append(cursor)
+        return cursor
 
-        if not row:
-            return None
+    def keys(self, n):
+        """
+        Parameter markers for n ids, converting them from hex
+        if need be
+        """
+        return ", ".join([self.key_sql] * n)
 
-        data = {}
-        data['uri'] = None
-        if isinstance(row[0], unicode):
-            data['uri'] = row[0].encode('utf8')
+    def rows(self, values, template):
+        """
+        Row markers for a multi-row INSERT of values - template
+        has %s where the id goes. Built here rather than with
+        executemany, which can't parse functions like UNHEX()
+        in the VALUES clause
+        """
+        return ", ".join([template % self.key_sql] * len(values))
 
-        data['location'] = None
-        if isinstance(row[1], unicode):
-            data['location'] = row[1].encode('utf8')
+    def _release(self, db, broken = False):
+        """
+        Return a connection to the pool, ending any open
+        transaction first so the next user doesn't see an old
+        snapshot - or discard it if it's broken
+        """
+        if not broken:
+            try:
+                db.rollback()
+            except MySQLdb.Error:
+                broken = True
+        if broken:
+            self.pool.discard(db)
+        else:
+            self.pool.put(db)
 
-        data['status'] = int(row[2])
-        data['created'] = row[3]
-        data['updated'] = row[4]
+    @db_cache.load
+    @reconnect
+    def load(self, id):
+        """
+        Takes a SHA-1 id
+        """
+        return self._load_many(self.cursor(), [id]).get(id)
 
-        data['tags'] = None
-        sql = "SELECT tag FROM urldammit_tags WHERE id = %s"
-        cursor.execute(sql, (id, ))
-        rows = cursor.fetchall()
-        for row in rows:
-            if data['tags'] == None:
-                data['tags'] = []
-            data['tags'].append(row[0].encode('utf8'))
-
-        data['pairs'] = None
-        sql = "SELECT pair_key, pair_value FROM urldammit_pairs WHERE id = %s"
-        cursor.execute(sql, (id, ))
-        rows = cursor.fetchall()
-        for row in rows:
-            if data['pairs'] == None:
-                data['pairs'] = dict()
-            data['pairs'][row[0].encode('utf8')] = row[1].encode('utf8')
+    @db_cache.load_many
+    @reconnect
+    def load_many(self, ids):
+        """
+        Takes a list of SHA-1 ids - returns a dict of
+        id -> URI for those found
+        """
+        if not ids:
+            return {}
+        
+        return self._load_many(self.cursor(), ids)
 
-        return URI.load(data)
+    def recent(self, limit, batch_size = 500):
+        """
+        Generate batches (lists) of the most recently updated
+        URIs, newest first, up to limit URIs in total. Pages
+        through urldammit_uris by ( updated, id ) rather than
+        OFFSET, so each batch costs the same. Holds a pooled
+        connection until the generator is exhausted or closed
+        """
+        db = self.pool.get()
+        try:
+            for batch in self._recent(db, limit, batch_size):
+                yield batch
+        except MySQLdb.OperationalError:
+            self._release(db, broken = True)
+            raise
+        except:
+            self._release(db)
+            raise
+        self._release(db)
+
+    def _recent(self, db, limit, batch_size):
+        cursor = db.cursor()
+        last = None
+        while limit > 0:
+            size = min(batch_size, limit)
+            if last:
+                sql = """SELECT %s, updated FROM urldammit_uris
+                WHERE updated < %%s OR ( updated = %%s AND id < %s )
+                ORDER BY updated DESC, id DESC LIMIT %%s"""\
+                    % (self.id_sql, self.key_sql)
+                cursor.execute(sql, (last[1], last[1], last[0], size))
+            else:
+                sql = """SELECT %s, updated FROM urldammit_uris
+                ORDER BY updated DESC, id DESC LIMIT %%s""" % self.id_sql
+                cursor.execute(sql, (size, ))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            last = rows[-1]
+            found = self._load_many(cursor, [row[0] for row in rows])
+            yield [found[row[0]] for row in rows if row[0] in found]
+            limit -= len(rows)
+            # release locks / snapshot between batches
+            db.commit()
+
+    def _load_many(self, cursor, ids):
+        """
+        Fetch URIs by id with a single statement, bypassing
+        the cache - returns a dict of id -> URI
+        """
+        sql = LOAD_SQL % {'id': self.id_sql, 'keys': self.keys(len(ids))}
+        cursor.execute(sql, tuple(ids) * 3)
+        records = fold(cursor.fetchall())
+        return dict((id, URI.load(data)) for id, data in records.items())
 
     @db_cache.insert
     @reconnect
@@ -133,15 +536,28 @@ class MySQL(object):
         """
         Takes a URI object
         """
-        cursor = self.db.cursor()
-        
+        self._insert(self.cursor(), uri)
+        self.db.commit()
+
+    @db_cache.insert_many
+    @reconnect
+    def insert_many(self, uris):
+        """
+        Takes a list of URI objects, inserted in one transaction
+        """
+        cursor = self.cursor()
+        for uri in uris:
+            self._insert(cursor, uri)
+        self.db.commit()
+
+    def _insert(self, cursor, uri):
         sql = """INSERT INTO urldammit_uris
         ( id, uri, created, location, status, updated )
         VALUES
-        ( %s, %s, %s, %s, %s, %s )
+        ( %s, %%s, %%s, %%s, %%s, %%s )
         ON DUPLICATE KEY UPDATE
-        location = %s, status = %s, updated = %s
-        """
+        location = %%s, status = %%s, updated = %%s
+        """ % self.key_sql
 
         create_date = todatetime(uri.created)
         update_date = todatetime(uri.updated)
@@ -153,28 +569,37 @@ class MySQL(object):
 
         # Duplicate the UPDATE params
         params = params + params[3:]
-        print "Got here: " + str(params)
 
         cursor.execute( sql, params )
 
-        self._store_tags(cursor, uri, deletefirst = False)
-        self._store_pairs(cursor, uri, deletefirst = False)
-
-        self.db.commit()
+        self._store_tags(cursor, uri, existing = False)
+        self._store_pairs(cursor, uri, existing = False)
 
     @db_cache.update
     @reconnect
     def update(self, uri):
         """
-        Takes a URI object
+        Takes a URI object - tags and pairs are only
+        written if they've changed
+        """
+        self._update(self.cursor(), uri)
+        self.db.commit()
 
-        TODO: only update tags / pairs if changed
+    @db_cache.update_many
+    @reconnect
+    def update_many(self, uris):
         """
-        cursor = self.db.cursor()
+        Takes a list of URI objects, updated in one transaction
+        """
+        cursor = self.cursor()
+        for uri in uris:
+            self._update(cursor, uri)
+        self.db.commit()
 
+    def _update(self, cursor, uri):
         sql = """UPDATE urldammit_uris SET
-        location = %s, status = %s, updated = %s
-        WHERE id = %s"""
+        location = %%s, status = %%s, updated = %%s
+        WHERE id = %s""" % self.key_sql
 
         params = (
             uri.location,
@@ -187,8 +612,6 @@ class MySQL(object):
 
         self._store_tags(cursor, uri)
         self._store_pairs(cursor, uri)
-        
-        self.db.commit()
 
     @db_cache.delete
     @reconnect
@@ -196,15 +619,27 @@ class MySQL(object):
         """
         Takes a SHA-1 id
         """
-        cursor = self.db.cursor()
-        sql = "DELETE FROM urldammit_uris WHERE id = %s"
-        cursor.execute(sql, (id, ))
+        cursor = self.cursor()
+        for table in ('urldammit_uris', 'urldammit_tags', 'urldammit_pairs'):
+            sql = "DELETE FROM %s WHERE id = %s" % (table, self.key_sql)
+            cursor.execute(sql, (id, ))
 
-        sql = "DELETE FROM urldammit_tags WHERE id = %s"
-        cursor.execute(sql, (id, ))
+        self.db.commit()
 
-        sql = "DELETE FROM urldammit_pairs WHERE id = %s"
-        cursor.execute(sql, (id, ))
+    @db_cache.delete_many
+    @reconnect
+    def delete_many(self, ids):
+        """
+        Takes a list of SHA-1 ids, deleted in one
+        transaction with a statement per table
+        """
+        if not ids:
+            return
+
+        cursor = self.cursor()
+        for table in ('urldammit_uris', 'urldammit_tags', 'urldammit_pairs'):
+            sql = "DELETE FROM %s WHERE id IN (%s)" % (table, self.keys(len(ids)))
+            cursor.execute(sql, tuple(ids))
 
         self.db.commit()
 
@@ -229,42 +664,150 @@ class MySQL(object):
         sql = "USE %s" % self.config['db_name']
         cursor.execute(sql)
         
-        sql = """CREATE TABLE IF NOT EXISTS urldammit_uris (
-            id BINARY( 40 ) NOT NULL ,
-            uri VARCHAR( %s ) NOT NULL ,
-            location VARCHAR( %s ) NULL ,
-            status MEDIUMINT UNSIGNED NOT NULL ,
-            created DATETIME NOT NULL ,
-            updated DATETIME NOT NULL ,
-            PRIMARY KEY ( id )
-            ) ENGINE = innodb CHARACTER SET utf8 COLLATE utf8_unicode_ci;
-            """ % ( constants.URI_LEN, constants.URI_LOCATION_LEN )
-        cursor.execute(sql)
-
-        sql = """CREATE TABLE IF NOT EXISTS urldammit_tags (
-        id BINARY( 40 ) NOT NULL ,
-        tag VARCHAR( %s ) NOT NULL ,
-        KEY id_index (id)
-        ) ENGINE = innodb CHARACTER SET utf8 COLLATE utf8_unicode_ci;
-        """ % ( constants.URI_TAG_LEN )
-        cursor.execute(sql)
-
-        sql = """CREATE TABLE IF NOT EXISTS urldammit_pairs (
-        id BINARY( 40 ) NOT NULL ,
-        pair_key VARCHAR( %s ) NOT NULL ,
-        pair_value VARCHAR( %s ) NOT NULL ,
-        KEY id_index (id)
-        ) ENGINE = innodb CHARACTER SET utf8 COLLATE utf8_unicode_ci;
-        """ % ( constants.URI_PAIR_KEY_LEN, constants.URI_PAIR_VALUE_LEN )
-        cursor.execute(sql)
+        found = id_bytes(cursor)
+        if found and found != self.id_bytes:
+            warnings.resetwarnings()
+            raise ValueError(
+                "%s has %s byte ids but binary_ids is %s - see mysql_migrate"\
+                % (self.config['db_name'], found, self.config['binary_ids'])
+                )
+
+        create_tables(cursor, self.id_bytes)
+        # tables created before the index existed
+        self._ensure_index(cursor, 'urldammit_uris', 'updated_index', 'updated')
+        self._ensure_index(cursor, 'urldammit_uris', 'status_updated_index',
+                           'status, updated')
+        self._ensure_index(cursor, 'urldammit_tags', 'tag_id_index', 'tag, id')
         
         warnings.resetwarnings()
 
+    def _ensure_index(self, cursor, table, name, columns):
+        """
+        Add an index to an existing table unless it's there already
+        """
+        cursor.execute("SHOW INDEX FROM %s WHERE Key_name = %%s" % table, (name, ))
+        if not cursor.fetchall():
+            cursor.execute("ALTER TABLE %s ADD INDEX %s ( %s )" % (table, name, columns))
+
+    def stale(self, status, before, batch_size = 500):
+        """
+        Generate batches (lists) of the ids of records with
+        the status last updated before the given time, oldest
+        first. Pages by ( updated, id ) on status_updated_index
+        (InnoDB secondary indexes end with the primary key),
+        a short query per batch on a pooled connection
+        """
+        last = None
+        while True:
+            ids = self._stale(status, before, batch_size, last)
+            if not ids:
+                return
+            last = ids[-1]
+            yield [id for updated, id in ids]
+
+    @reconnect
+    def _stale(self, status, before, batch_size, last):
+        """
+        The next batch of ( updated, id ) for stale, after last
+        """
+        cursor = self.cursor()
+        sql = """SELECT updated, %s FROM urldammit_uris
+        WHERE status = %%s AND updated < %%s""" % self.id_sql
+        params = [status, todatetime(before)]
+        if last:
+            sql += " AND ( updated > %%s OR ( updated = %%s AND id > %s ) )"\
+                   % self.key_sql
+            params.extend((last[0], last[0], last[1]))
+        sql += " ORDER BY updated, id LIMIT %s"
+        params.append(batch_size)
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        self.db.commit()
+        return rows
+
+    @reconnect
+    def by_status(self, status, limit, after = None):
+        """
+        A page (list) of up to limit URIs with the status, most
+        recently updated first - after is the ( updated, id ) of
+        the last URI on the previous page. Reads backwards along
+        status_updated_index, which ends with the primary key,
+        from after - the plain updated <= %s gives the range
+        optimizer somewhere to start, so a page costs the same
+        at any depth
+        """
+        cursor = self.cursor()
+        sql = "SELECT %s FROM urldammit_uris WHERE status = %%s" % self.id_sql
+        params = [status]
+        if after:
+            sql += " AND updated <= %%s AND ( updated < %%s OR id < %s )"\
+                   % self.key_sql
+            updated = todatetime(after[0])
+            params.extend((updated, updated, after[1]))
+        sql += " ORDER BY updated DESC, id DESC LIMIT %s"
+        params.append(limit)
+        cursor.execute(sql, params)
+        ids = [row[0] for row in cursor.fetchall()]
+        found = self._load_many(cursor, ids)
+        return [found[id] for id in ids if id in found]
+
+    @reconnect
+    def by_tags(self, tags, limit, after = None, status = None,
+                match_any = False):
+        """
+        A page (list) of up to limit URIs with all the tags (or
+        any of them), optionally only those with the status, in
+        id order - after is the id of the last URI on the
+        previous page. Reads tag_id_index from after, one range
+        per tag for any
+        """
+        cursor = self.cursor()
+        if match_any:
+            ids = set()
+            for tag in tags:
+                ids.update(self._tagged(cursor, [tag], status, after, limit))
+            ids = sorted(ids)[:limit]
+        else:
+            ids = self._tagged(cursor, tags, status, after, limit)
+        found = self._load_many(cursor, ids)
+        return [found[id] for id in ids if id in found]
+
+    def _tagged(self, cursor, tags, status, after, limit):
+        """
+        Ids of up to limit URIs with all the tags, after the
+        given id - walks the first tag's range, joining the others.
+        Each tag is compared as is, to use tag_id_index, and as
+        BINARY, as tags are case sensitive but the column's
+        utf8_unicode_ci collation isn't
+        """
+        sql = ["SELECT %s FROM urldammit_tags t0"
+               % self.id_sql.replace('id', 't0.id')]
+        params = []
+        for n, tag in enumerate(tags[1:]):
+            sql.append("JOIN urldammit_tags t%s ON t%s.tag = %%s"
+                       " AND BINARY t%s.tag = %%s AND t%s.id = t0.id"
+                       % (n + 1, n + 1, n + 1, n + 1))
+            params.extend((tag, tag))
+        if status is not None:
+            sql.append("JOIN urldammit_uris u ON u.id = t0.id AND u.status = %s")
+            params.append(status)
+        sql.append("WHERE t0.tag = %s AND BINARY t0.tag = %s")
+        params.extend((tags[0], tags[0]))
+        if after:
+            sql.append("AND t0.id > %s" % self.key_sql)
+            params.append(after)
+        # GROUP BY rather than DISTINCT, which won't ORDER BY the
+        # raw id when binary ids are selected as hex
+        sql.append("GROUP BY t0.id ORDER BY t0.id LIMIT %s")
+        params.append(limit)
+        cursor.execute(" ".join(sql), params)
+        return [row[0] for row in cursor.fetchall()]
+
     def purge(self, **kwargs):
         """
-        Clean up old data
+        Delete stale records - see purge.run
         """
-        pass
+        return purge.run(self, **kwargs)
 
     def _default_config(self, config):
         if not config: config = {}
@@ -273,6 +816,10 @@ class MySQL(object):
         config['db_user'] = config.get('db_user', 'urldammit')
         config['db_pass'] = config.get('db_pass', 'where1sMyUrl')
         config['db_name'] = config.get('db_name', 'urldammit_live')
+        config['pool_size'] = config.get('pool_size', 10)
+        config['pool_timeout'] = config.get('pool_timeout', 5)
+        config['pool_max_idle'] = config.get('pool_max_idle', 300)
+        config['binary_ids'] = config.get('binary_ids', False)
 
         return config
         
@@ -325,30 +872,71 @@ class MySQL(object):
         db.charset = 'utf8'
         return db
 
-    def _store_tags(self, cursor, uri, deletefirst = True):
-        if uri.tags_updated:
-            if deletefirst:
-                sql = "DELETE FROM urldammit_tags WHERE id = %s"
-                cursor.execute(sql, (uri.id, ))
-            
+    def _store_tags(self, cursor, uri, existing = True):
+        """
+        Write the tags if they've changed. For an existing
+        record only the difference from what's stored is written
+        """
+        if not uri.tags_updated:
+            return
+
+        tags = [utf8(tag) for tag in uri.tags or []]
+        stored = []
+        if existing:
+            sql = "SELECT tag FROM urldammit_tags WHERE id = %s" % self.key_sql
+            cursor.execute(sql, (uri.id, ))
+            stored = [row[0].encode('utf8') for row in cursor.fetchall()]
+
+        removed, added = diff_tags(stored, tags)
+
+        # BINARY as diff_tags is case sensitive but the
+        # column's utf8_unicode_ci collation isn't
+        if removed:
+            sql = "DELETE FROM urldammit_tags WHERE id = %s AND BINARY tag IN (%s)"\
+                  % (self.key_sql, placeholders(removed))
+            cursor.execute(sql, (uri.id, ) + tuple(removed))
+
+        if added:
             sql = """INSERT INTO urldammit_tags
-            ( id, tag ) VALUES ( %s, %s )"""
+            ( id, tag ) VALUES %s""" % self.rows(added, '( %s, %%s )')
+            params = []
+            for tag in added:
+                params.extend((uri.id, tag))
+            cursor.execute(sql, params)
 
-            for tag in uri.tags:
-                cursor.execute(sql, (uri.id, tag))
-
-    def _store_pairs(self, cursor, uri, deletefirst = True):
-        if uri.pairs_updated:
-            if deletefirst:
-                sql = "DELETE FROM urldammit_pairs WHERE id = %s"
-                cursor.execute(sql, (uri.id, ))
-            
+    def _store_pairs(self, cursor, uri, existing = True):
+        """
+        Write the pairs if they've changed. For an existing
+        record only the difference from what's stored is written
+        """
+        if not uri.pairs_updated:
+            return
+
+        pairs = dict((utf8(k), utf8(v)) for k, v in (uri.pairs or {}).items())
+        stored = {}
+        if existing:
+            sql = """SELECT pair_key, pair_value
+            FROM urldammit_pairs WHERE id = %s""" % self.key_sql
+            cursor.execute(sql, (uri.id, ))
+            for row in cursor.fetchall():
+                stored[row[0].encode('utf8')] = row[1].encode('utf8')
+
+        removed, added = diff_pairs(stored, pairs)
+
+        # BINARY as for _store_tags
+        if removed:
+            sql = """DELETE FROM urldammit_pairs
+            WHERE id = %s AND BINARY pair_key IN (%s)""" % (self.key_sql, placeholders(removed))
+            cursor.execute(sql, (uri.id, ) + tuple(removed))
+
+        if added:
             sql = """INSERT INTO urldammit_pairs
             ( id, pair_key, pair_value )
-            VALUES ( %s, %s, %s)"""
-
-            for k, v in uri.pairs.items():
-                cursor.execute(sql, (uri.id, k, v))        
+            VALUES %s""" % self.rows(added, '( %s, %%s, %%s )')
+            params = []
+            for k, v in added:
+                params.extend((uri.id, k, v))
+            cursor.execute(sql, params)
 
 def _test():
     import doctest
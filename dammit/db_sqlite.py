@@ -0,0 +1,524 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+SQLite backend, for single node deployments and testing
+without a database server.
+
+The database is opened in WAL mode, so readers don't block the
+writer (or each other), with a connection per thread. SQL is kept
+constant so the sqlite3 module's statement cache can reuse the
+prepared statements. Batches (insert_many, update_many) are
+written in a single transaction.
+"""
+import threading
+import sqlite3
+from uri import URI
+import db_cache, purge
+
+BUSY_TIMEOUT = 5
+"""Seconds to wait for another connection's write lock."""
+
+IN_SIZE = 500
+"""Most ids per IN ( ... ) clause - SQLite allows 999 parameters."""
+
+def chunks(items, size = IN_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def placeholders(values):
+    """
+    >>> placeholders([1, 2, 3])
+    '?, ?, ?'
+    """
+    return ", ".join(["?"] * len(values))
+
+class SQLite(object):
+    """
+    >>> import os, tempfile, datetime
+    >>> from datetime import datetime; now = datetime.now
+    >>> path = os.path.join(tempfile.mkdtemp(), 'urldammit.db')
+    >>> s = SQLite({'db_path': path})
+    >>> s.connection().execute("PRAGMA journal_mode").fetchone()
+    ('wal',)
+    >>> u = URI()
+    >>> u.uri = 'http://local.ch/test1.html'
+    >>> u.status = 200
+    >>> u.created = now()
+    >>> u.updated = now()
+    >>> u.tags = ['foo','bar']
+    >>> u.pairs = {'foo':'hello', 'bar':'world'}
+    >>> s.insert(u)
+    >>> u1 = s.load(u.id)
+    >>> u1.uri == u.uri, u1.tags == u.tags, u1.pairs == u.pairs
+    (True, True, True)
+    >>> u1.created == u.created, u1.updated == u.updated
+    (True, True)
+    >>> u1.tags = ['abc','xyz']
+    >>> u1.pairs = {'foo':'goodbye'}
+    >>> u1.updated = now()
+    >>> s.update(u1)
+    >>> u2 = s.load(u1.id)
+    >>> u2.tags, u2.pairs
+    (['abc', 'xyz'], {'foo': 'goodbye'})
+
+    Batches
+
+    >>> uris = []
+    >>> for i in range(3):
+    ...     u = URI()
+    ...     u.uri = 'http://local.ch/batch_%s.html' % i
+    ...     u.status = 200
+    ...     u.created = u.updated = datetime(2009, 1, i + 1)
+    ...     uris.append(u)
+    >>> s.insert_many(uris)
+    >>> for u in uris: u.tags = ['batch']
+    >>> s.update_many(uris)
+    >>> found = s.load_many([u.id for u in uris] + ['abc'])
+    >>> sorted(found.keys()) == sorted([u.id for u in uris])
+    True
+    >>> [found[u.id].tags for u in uris]
+    [['batch'], ['batch'], ['batch']]
+    >>> [[x.uri for x in batch] for batch in s.recent(3, 2)]
+    [['http://local.ch/test1.html', 'http://local.ch/batch_2.html'], ['http://local.ch/batch_1.html']]
+
+    Data survives reopening
+
+    >>> s = SQLite({'db_path': path})
+    >>> s.load(u2.id).tags
+    ['abc', 'xyz']
+    >>> s.delete(u2.id)
+    >>> print s.load(u2.id)
+    None
+    >>> list(s.stale(200, datetime(2009, 1, 3), 1)) == [[uris[0].id], [uris[1].id]]
+    True
+    >>> page = s.by_status(200, 2)
+    >>> [x.uri for x in page]
+    ['http://local.ch/batch_2.html', 'http://local.ch/batch_1.html']
+    >>> [x.uri for x in s.by_status(200, 2, (page[-1].updated, page[-1].id))]
+    ['http://local.ch/batch_0.html']
+    >>> s.by_status(404, 2)
+    []
+
+    Pages bigger than IN_SIZE are loaded IN_SIZE ids at a time
+
+    >>> many = []
+    >>> for i in range(IN_SIZE + 1):
+    ...     u = URI()
+    ...     u.uri = 'http://local.ch/many_%s.html' % i
+    ...     u.status = 200
+    ...     u.tags = ['many']
+    ...     u.created = u.updated = datetime(2009, 2, 1)
+    ...     many.append(u)
+    >>> s.insert_many(many)
+    >>> sizes = []
+    >>> load = s._load_many
+    >>> s._load_many = lambda conn, ids: sizes.append(len(ids)) or load(conn, ids)
+    >>> len(s.by_status(200, 1000)) == IN_SIZE + 4, max(sizes) == IN_SIZE
+    (True, True)
+    >>> sizes = []
+    >>> len(s.by_tags(['many', 'batch'], 1000, match_any = True)) == IN_SIZE + 4
+    True
+    >>> max(sizes) == IN_SIZE
+    True
+    >>> del s._load_many
+    >>> s.delete_many([u.id for u in many])
+
+    >>> [x.uri for x in s.by_tags(['batch'], 5, status = 200)] == sorted(
+    ...     [u.uri for u in uris], key = URI.hash)
+    True
+    >>> page = s.by_tags(['batch', 'abc'], 2, match_any = True)
+    >>> page += s.by_tags(['batch', 'abc'], 2, page[-1].id, match_any = True)
+    >>> len(page), [x.id for x in page] == sorted([x.id for x in page])
+    (3, True)
+    >>> s.by_tags(['batch', 'abc'], 5), s.by_tags(['batch'], 5, status = 404)
+    ([], [])
+    >>> plan = s.connection().execute("EXPLAIN QUERY PLAN SELECT id FROM urldammit_uris "
+    ...     "WHERE status = 404 ORDER BY updated DESC, id DESC LIMIT 10").fetchall()
+    >>> [row for row in plan if 'TEMP B-TREE' in row[-1]]
+    []
+    >>> s.purge(retention = {200: 1}, pause = 0, now = datetime(2009, 1, 4))
+    2
+    >>> s.delete_many([u.id for u in uris])
+    >>> s.load_many([u.id for u in uris])
+    {}
+    """
+    def __init__(self, config = None, dropfirst = False, bootstrap = True):
+        self.config = self._default_config(config)
+        self.local = threading.local()
+        if bootstrap:
+            self.bootstrap(dropfirst)
+
+    def fresh_connection(self):
+        """
+        Each thread keeps its own connection, so there's
+        nothing to do here
+        """
+        return self
+
+    def connection(self):
+        """
+        The current thread's connection, opened on first use
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.config['db_path'],
+                timeout = BUSY_TIMEOUT,
+                detect_types = sqlite3.PARSE_DECLTYPES,
+                isolation_level = None,
+                cached_statements = 64
+                )
+            # give back utf-8 str, like the other backends
+            conn.text_factory = str
+            conn.execute("PRAGMA journal_mode = WAL")
+            # safe with WAL - only the last commits may be
+            # lost on power failure, not consistency
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @db_cache.load
+    def load(self, id):
+        """
+        Takes a SHA-1 id
+        """
+        return self._load_many(self.connection(), [id]).get(id)
+
+    @db_cache.load_many
+    def load_many(self, ids):
+        """
+        Takes a list of SHA-1 ids - returns a dict of
+        id -> URI for those found
+        """
+        return self._load_chunked(self.connection(), ids)
+
+    def recent(self, limit, batch_size = 500):
+        """
+        Generate batches (lists) of the most recently updated
+        URIs, newest first, up to limit URIs in total, paging
+        by ( updated, id )
+        """
+        conn = self.connection()
+        last = None
+        while limit > 0:
+            size = min(batch_size, limit)
+            if last:
+                rows = conn.execute("""SELECT id, updated FROM urldammit_uris
+                WHERE updated < ? OR ( updated = ? AND id < ? )
+                ORDER BY updated DESC, id DESC LIMIT ?""",
+                                    (last[1], last[1], last[0], size)).fetchall()
+            else:
+                rows = conn.execute("""SELECT id, updated FROM urldammit_uris
+                ORDER BY updated DESC, id DESC LIMIT ?""", (size, )).fetchall()
+            if not rows:
+                return
+            last = rows[-1]
+            found = self._load_many(conn, [row[0] for row in rows])
+            yield [found[row[0]] for row in rows if row[0] in found]
+            limit -= len(rows)
+
+    @db_cache.insert
+    def insert(self, uri):
+        """
+        Takes a URI object
+        """
+        self._write(self._insert_many, [uri])
+
+    @db_cache.insert_many
+    def insert_many(self, uris):
+        """
+        Takes a list of URI objects, inserted in one transaction
+        """
+        self._write(self._insert_many, uris)
+
+    @db_cache.update
+    def update(self, uri):
+        """
+        Takes a URI object - tags and pairs are only
+        written if they've changed
+        """
+        self._write(self._update_many, [uri])
+
+    @db_cache.update_many
+    def update_many(self, uris):
+        """
+        Takes a list of URI objects, updated in one transaction
+        """
+        self._write(self._update_many, uris)
+
+    @db_cache.delete
+    def delete(self, id):
+        """
+        Takes a SHA-1 id
+        """
+        self._write(self._delete_many, [id])
+
+    @db_cache.delete_many
+    def delete_many(self, ids):
+        """
+        Takes a list of SHA-1 ids, deleted in one transaction
+        """
+        self._write(self._delete_many, ids)
+
+    def bootstrap(self, dropfirst = False):
+        """
+        Setup the tables and indexes
+        """
+        conn = self.connection()
+        if dropfirst:
+            for table in ('urldammit_uris', 'urldammit_tags', 'urldammit_pairs'):
+                conn.execute("DROP TABLE IF EXISTS %s" % table)
+
+        conn.execute("""CREATE TABLE IF NOT EXISTS urldammit_uris (
+            id TEXT NOT NULL PRIMARY KEY,
+            uri TEXT NOT NULL,
+            location TEXT NULL,
+            status INTEGER NOT NULL,
+            created TIMESTAMP NOT NULL,
+            updated TIMESTAMP NOT NULL
+            )""")
+        conn.execute("DROP INDEX IF EXISTS status_index")
+        # ( status, updated ) only, before by_status
+        columns = conn.execute("PRAGMA index_info(status_updated_index)").fetchall()
+        if columns and 'id' not in [column[2] for column in columns]:
+            conn.execute("DROP INDEX status_updated_index")
+        conn.execute("""CREATE INDEX IF NOT EXISTS status_updated_index
+            ON urldammit_uris ( status, updated, id )""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS updated_index
+            ON urldammit_uris ( updated )""")
+
+        conn.execute("""CREATE TABLE IF NOT EXISTS urldammit_tags (
+            id TEXT NOT NULL,
+            tag TEXT NOT NULL
+            )""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS tags_id_index
+            ON urldammit_tags ( id )""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS tags_tag_index
+            ON urldammit_tags ( tag, id )""")
+
+        conn.execute("""CREATE TABLE IF NOT EXISTS urldammit_pairs (
+            id TEXT NOT NULL,
+            pair_key TEXT NOT NULL,
+            pair_value TEXT NOT NULL
+            )""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS pairs_id_index
+            ON urldammit_pairs ( id )""")
+
+    def stale(self, status, before, batch_size = 500):
+        """
+        Generate batches (lists) of the ids of records with
+        the status last updated before the given time, oldest
+        first, paging by ( updated, id )
+        """
+        conn = self.connection()
+        last = None
+        while True:
+            if last:
+                rows = conn.execute("""SELECT id, updated FROM urldammit_uris
+                WHERE status = ? AND updated < ?
+                AND ( updated > ? OR ( updated = ? AND id > ? ) )
+                ORDER BY updated, id LIMIT ?""",
+                                    (status, before, last[1], last[1], last[0],
+                                     batch_size)).fetchall()
+            else:
+                rows = conn.execute("""SELECT id, updated FROM urldammit_uris
+                WHERE status = ? AND updated < ?
+                ORDER BY updated, id LIMIT ?""",
+                                    (status, before, batch_size)).fetchall()
+            if not rows:
+                return
+            last = rows[-1]
+            yield [row[0] for row in rows]
+
+    def by_status(self, status, limit, after = None):
+        """
+        A page (list) of up to limit URIs with the status, most
+        recently updated first - after is the ( updated, id ) of
+        the last URI on the previous page. Reads backwards along
+        status_updated_index from after - the plain updated <= ?
+        is what lets the planner seek there rather than walk the
+        index from the top
+        """
+        conn = self.connection()
+        if after:
+            rows = conn.execute("""SELECT id FROM urldammit_uris
+            WHERE status = ? AND updated <= ?
+            AND ( updated < ? OR id < ? )
+            ORDER BY updated DESC, id DESC LIMIT ?""",
+                                (status, after[0], after[0], after[1],
+                                 limit)).fetchall()
+        else:
+            rows = conn.execute("""SELECT id FROM urldammit_uris
+            WHERE status = ? ORDER BY updated DESC, id DESC LIMIT ?""",
+                                (status, limit)).fetchall()
+        found = self._load_chunked(conn, [row[0] for row in rows])
+        return [found[row[0]] for row in rows if row[0] in found]
+
+    def by_tags(self, tags, limit, after = None, status = None,
+                match_any = False):
+        """
+        A page (list) of up to limit URIs with all the tags (or
+        any of them), optionally only those with the status, in
+        id order - after is the id of the last URI on the
+        previous page. Reads tags_tag_index from after, one
+        range per tag for any
+        """
+        conn = self.connection()
+        if match_any:
+            ids = set()
+            for tag in tags:
+                ids.update(self._tagged(conn, [tag], status, after, limit))
+            ids = sorted(ids)[:limit]
+        else:
+            ids = self._tagged(conn, tags, status, after, limit)
+        found = self._load_chunked(conn, ids)
+        return [found[id] for id in ids if id in found]
+
+    def purge(self, **kwargs):
+        """
+        Delete stale records - see purge.run
+        """
+        return purge.run(self, **kwargs)
+
+    def _default_config(self, config):
+        if not config: config = {}
+        config['db_path'] = config.get('db_path', 'urldammit.db')
+        return config
+
+    def _write(self, method, items):
+        """
+        Run method(conn, items) in a transaction
+        """
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            method(conn, items)
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _load_chunked(self, conn, ids):
+        """
+        As _load_many for any number of ids, IN_SIZE at a time
+        """
+        found = {}
+        for batch in chunks(list(ids)):
+            found.update(self._load_many(conn, batch))
+        return found
+
+    def _load_many(self, conn, ids):
+        """
+        Fetch URIs by id, bypassing the cache - returns a
+        dict of id -> URI
+        """
+        marks = placeholders(ids)
+        records = {}
+        for row in conn.execute("""SELECT
+        id, uri, location, status, created, updated
+        FROM urldammit_uris WHERE id IN (%s)""" % marks, ids):
+            records[row[0]] = {
+                'uri': row[1],
+                'location': row[2],
+                'status': row[3],
+                'created': row[4],
+                'updated': row[5],
+                'tags': None,
+                'pairs': None,
+                }
+
+        if not records:
+            return {}
+
+        for id, tag in conn.execute("""SELECT id, tag FROM urldammit_tags
+        WHERE id IN (%s) ORDER BY rowid""" % marks, ids):
+            data = records[id]
+            if data['tags'] is None:
+                data['tags'] = []
+            data['tags'].append(tag)
+
+        for id, k, v in conn.execute("""SELECT id, pair_key, pair_value
+        FROM urldammit_pairs WHERE id IN (%s)""" % marks, ids):
+            data = records[id]
+            if data['pairs'] is None:
+                data['pairs'] = {}
+            data['pairs'][k] = v
+
+        return dict((id, URI.load(data)) for id, data in records.items())
+
+    def _tagged(self, conn, tags, status, after, limit):
+        """
+        Ids of up to limit URIs with all the tags, after the
+        given id - walks the first tag's range, joining the others
+        """
+        sql = ["SELECT DISTINCT t0.id FROM urldammit_tags t0"]
+        params = []
+        for n, tag in enumerate(tags[1:]):
+            sql.append("JOIN urldammit_tags t%s ON t%s.tag = ? AND t%s.id = t0.id"
+                       % (n + 1, n + 1, n + 1))
+            params.append(tag)
+        if status is not None:
+            sql.append("JOIN urldammit_uris u ON u.id = t0.id AND u.status = ?")
+            params.append(status)
+        sql.append("WHERE t0.tag = ?")
+        params.append(tags[0])
+        if after:
+            sql.append("AND t0.id > ?")
+            params.append(after)
+        sql.append("ORDER BY t0.id LIMIT ?")
+        params.append(limit)
+        return [row[0] for row in conn.execute(" ".join(sql), params)]
+
+    def _insert_many(self, conn, uris):
+        conn.executemany("""INSERT OR REPLACE INTO urldammit_uris
+        ( id, uri, location, status, created, updated )
+        VALUES ( ?, ?, ?, ?, ?, ? )""", [
+            (u.id, u.uri, u.location, u.status, u.created, u.updated)
+            for u in uris])
+        self._store_tags(conn, uris)
+        self._store_pairs(conn, uris)
+
+    def _update_many(self, conn, uris):
+        conn.executemany("""UPDATE urldammit_uris SET
+        location = ?, status = ?, updated = ?
+        WHERE id = ?""", [
+            (u.location, u.status, u.updated, u.id) for u in uris])
+        self._store_tags(conn, [u for u in uris if u.tags_updated])
+        self._store_pairs(conn, [u for u in uris if u.pairs_updated])
+
+    def _delete_many(self, conn, ids):
+        params = [(id, ) for id in ids]
+        for table in ('urldammit_uris', 'urldammit_tags', 'urldammit_pairs'):
+            conn.executemany("DELETE FROM %s WHERE id = ?" % table, params)
+
+    def _store_tags(self, conn, uris):
+        """
+        Replace the tags of each URI
+        """
+        conn.executemany("DELETE FROM urldammit_tags WHERE id = ?",
+                         [(u.id, ) for u in uris])
+        rows = []
+        for u in uris:
+            for tag in u.tags or []:
+                rows.append((u.id, tag))
+        conn.executemany("INSERT INTO urldammit_tags ( id, tag ) VALUES ( ?, ? )", rows)
+
+    def _store_pairs(self, conn, uris):
+        """
+        Replace the pairs of each URI
+        """
+        conn.executemany("DELETE FROM urldammit_pairs WHERE id = ?",
+                         [(u.id, ) for u in uris])
+        rows = []
+        for u in uris:
+            for k, v in (u.pairs or {}).items():
+                rows.append((u.id, k, v))
+        conn.executemany("""INSERT INTO urldammit_pairs
+        ( id, pair_key, pair_value ) VALUES ( ?, ?, ? )""", rows)
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
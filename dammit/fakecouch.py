@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A small in-process stand-in for a CouchDB server, speaking
+enough of the HTTP API for db_couch - databases, documents with
+revisions and conflicts, _all_docs and views - so its tests and
+benchmarks don't need a real CouchDB.
+
+Views can't run the JavaScript in design documents, so they're
+given as Python functions of a document returning a list of
+( key, value ) pairs, keyed by "design/view".
+
+Every request is recorded in requests, as ( method, path ).
+"""
+import threading, urllib, urlparse, uuid
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import simplejson
+
+class Handler(BaseHTTPRequestHandler):
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        body = None
+        if length:
+            body = simplejson.loads(self.rfile.read(length))
+        status, data = self.server.couch.handle(self.command, self.path, body)
+        content = simplejson.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        if isinstance(data, dict) and '_rev' in data:
+            self.send_header('ETag', '"%s"' % data['_rev'])
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _handle
+
+    def log_message(self, *args):
+        pass
+
+class Conflict(Exception):
+    pass
+
+class FakeCouch(object):
+    """
+    >>> from couchdb import Server, ResourceConflict
+    >>> couch = FakeCouch({'test/by_name': lambda doc: [(doc['name'], None)]})
+    >>> server = Server(couch.start())
+    >>> db = server.create('test')
+    >>> db['a'] = doc = {'name': 'zed'}
+    >>> db['b'] = {'name': 'amy'}
+    >>> db['a'] = {'name': 'bob'}
+    Traceback (most recent call last):
+    ...
+    ResourceConflict: ('conflict', 'Document update conflict.')
+    >>> doc['name'] = 'bob'
+    >>> db['a'] = doc
+    >>> print db['a']['name']
+    bob
+    >>> print [str(row.id) for row in db.view('test/by_name')]
+    ['b', 'a']
+    >>> print [str(row.id) for row in db.view('_all_docs', descending = True, limit = 1)]
+    ['b']
+    >>> couch.requests[:2]
+    [('PUT', '/test'), ('PUT', '/test/a')]
+
+    Bulk updates and fetches
+
+    >>> docs = [{'_id': 'c', 'name': 'cat'}, {'_id': 'a', 'name': 'ann'}]
+    >>> list(db.update(docs))
+    Traceback (most recent call last):
+    ...
+    ResourceConflict: ('conflict', 'Document update conflict.')
+    >>> 'c' in db
+    False
+    >>> docs[1]['_rev'] = db['a']['_rev']
+    >>> [doc['_id'] for doc in db.update(docs)]
+    ['c', 'a']
+    >>> rows = db.view('_all_docs', keys = ['a', 'x', 'c'], include_docs = True)
+    >>> print [(str(row.key), row.doc and str(row.doc['name'])) for row in rows]
+    [('a', 'ann'), ('x', None), ('c', 'cat')]
+    >>> list(db.update([{'_id': 'c', '_rev': db['c']['_rev'], '_deleted': True}])) and 'c' in db
+    False
+    >>> couch.stop()
+    """
+    def __init__(self, views = None):
+        self.views = views or {}
+        self.databases = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        """
+        Serve on a free local port in a background thread -
+        returns the server's URL
+        """
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.couch = self
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return 'http://127.0.0.1:%s/' % self.server.server_port
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, body):
+        """
+        Returns ( status, response data )
+        """
+        url = urlparse.urlsplit(path)
+        parts = [urllib.unquote(p) for p in url.path.split('/') if p]
+        query = {}
+        for name, values in urlparse.parse_qs(url.query).items():
+            value = values[-1]
+            if name not in ('startkey_docid', 'endkey_docid', 'rev'):
+                try:
+                    value = simplejson.loads(value)
+                except ValueError:
+                    pass
+            query[name] = value
+
+        self.lock.acquire()
+        try:
+            self.requests.append((method, url.path))
+            try:
+                return self.route(method, parts, query, body)
+            except KeyError:
+                return 404, {'error': 'not_found', 'reason': 'missing'}
+            except Conflict:
+                return 409, {'error': 'conflict',
+                             'reason': 'Document update conflict.'}
+        finally:
+            self.lock.release()
+
+    def route(self, method, parts, query, body):
+        if not parts:
+            return 200, {'couchdb': 'Welcome', 'version': '0.8.0'}
+
+        if parts == ['_all_dbs']:
+            return 200, sorted(self.databases.keys())
+
+        name = parts[0]
+        if len(parts) == 1:
+            if method == 'PUT':
+                if name in self.databases:
+                    return 412, {'error': 'file_exists',
+                                 'reason': 'The database already exists.'}
+                self.databases[name] = {}
+                return 201, {'ok': True}
+            docs = self.databases[name]
+            if method == 'DELETE':
+                del self.databases[name]
+                return 200, {'ok': True}
+            return 200, {'db_name': name, 'doc_count': len(docs)}
+
+        docs = self.databases[name]
+        rest = parts[1:]
+
+        if rest == ['_all_docs']:
+            keys = None
+            if body:
+                keys = body.get('keys')
+            return 200, self.all_docs(docs, keys, query)
+
+        if rest == ['_bulk_docs']:
+            return 201, self.bulk_docs(docs, body['docs'])
+
+        if rest[0] == '_view' and len(rest) == 3:
+            return 200, self.view(docs, '/'.join(rest[1:]), query)
+
+        if rest[0] == '_design' and len(rest) == 4 and rest[2] == '_view':
+            return 200, self.view(docs, '%s/%s' % (rest[1], rest[3]), query)
+
+        id = '/'.join(rest)
+        if method in ('GET', 'HEAD'):
+            return 200, docs[id]
+        if method == 'PUT':
+            rev = self.put(docs, id, body)
+            return 201, {'ok': True, 'id': id, 'rev': rev}
+        if method == 'DELETE':
+            if docs[id]['_rev'] != query.get('rev'):
+                raise Conflict
+            del docs[id]
+            return 200, {'ok': True}
+        return 405, {'error': 'method_not_allowed', 'reason': method}
+
+    def put(self, docs, id, doc):
+        """
+        Store a document, checking its _rev against the
+        stored one - returns the new _rev
+        """
+        current = docs.get(id)
+        if current is None:
+            if doc.get('_rev'):
+                raise Conflict
+            generation = 0
+        else:
+            if doc.get('_rev') != current['_rev']:
+                raise Conflict
+            generation = int(current['_rev'].split('-')[0])
+        doc = dict(doc)
+        doc['_id'] = id
+        doc['_rev'] = '%s-%s' % (generation + 1, abs(hash(repr(doc))))
+        docs[id] = doc
+        return doc['_rev']
+
+    def bulk_docs(self, docs, updates):
+        """
+        Store many documents - as with CouchDB 0.8, if any
+        conflicts none are stored
+        """
+        staged = dict(docs)
+        revs = []
+        for doc in updates:
+            id = doc.get('_id') or uuid.uuid4().hex
+            revs.append({'id': id, 'rev': self.put(staged, id, doc)})
+            if doc.get('_deleted'):
+                del staged[id]
+        docs.clear()
+        docs.update(staged)
+        return {'ok': True, 'new_revs': revs}
+
+    def all_docs(self, docs, keys, query):
+        if keys is None:
+            keys = sorted(docs.keys())
+            if query.get('descending'):
+                keys.reverse()
+        rows = []
+        for id in keys:
+            doc = docs.get(id)
+            if doc is None:
+                rows.append({'key': id, 'error': 'not_found'})
+                continue
+            row = {'id': id, 'key': id, 'value': {'rev': doc['_rev']}}
+            if query.get('include_docs'):
+                row['doc'] = doc
+            rows.append(row)
+        return {'total_rows': len(docs), 'offset': 0,
+                'rows': self.page(rows, query)}
+
+    def view(self, docs, name, query):
+        map = self.views[name]
+        rows = []
+        for id, doc in docs.items():
+            for key, value in map(doc):
+                rows.append((key, id, value))
+        rows.sort()
+        descending = query.get('descending')
+        if descending:
+            rows.reverse()
+
+        if 'key' in query:
+            rows = [row for row in rows if row[0] == query['key']]
+        if 'startkey' in query:
+            start = (query['startkey'], query.get('startkey_docid', ''))
+            if descending:
+                rows = [row for row in rows if row[:2] <= start]
+            else:
+                rows = [row for row in rows if row[:2] >= start]
+        if 'endkey' in query:
+            end = query['endkey']
+            if descending:
+                rows = [row for row in rows if row[0] >= end]
+            else:
+                rows = [row for row in rows if row[0] <= end]
+
+        result = []
+        for key, id, value in rows:
+            row = {'id': id, 'key': key, 'value': value}
+            if query.get('include_docs'):
+                row['doc'] = docs[id]
+            result.append(row)
+        return {'total_rows': len(rows), 'offset': 0,
+                'rows': self.page(result, query)}
+
+    def page(self, rows, query):
+        rows = rows[query.get('skip', 0):]
+        if 'limit' in query:
+            rows = rows[:query['limit']]
+        return rows
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -33,15 +33,21 @@ discarded. [1]_
 
 from __future__ import generators
 import time
-from heapq import heappush, heappop, heapify
+import stats, sizeof
 
-__version__ = "0.2"
+__version__ = "0.3"
 __all__ = ['CacheKeyError', 'LRUCache', 'DEFAULT_SIZE']
 __docformat__ = 'reStructuredText en'
 
 DEFAULT_SIZE = 16
 """Default size of a new LRUCache object, if no 'size' argument is given."""
 
+SWEEP_LIMIT = 8
+"""Most expired records discarded by a single write to a cache with a ttl."""
+
+SIZE_SAMPLE = 100
+"""Records sampled to estimate the memory used by a cache."""
+
 class CacheKeyError(KeyError):
     """Error raised when cache requests fail
     
@@ -88,108 +94,405 @@ class LRUCache(object):
 
     for j in cache:   # iterate (in LRU order)
         print j, cache[j] # iterator produces keys, not values
+
+    Records are kept in a dictionary for lookup and threaded onto a
+    circular doubly linked list in access order, so reads, writes,
+    deletes and evictions are all O(1).
+
+    If 'max_bytes' is set, the cache is also bounded by the estimated
+    memory its values use: the least recently used records are
+    discarded until the total is back under budget. Sizes come from
+    'sizer' (sizeof.estimate by default), called once per write.
+
+    If 'ttl' is set, records expire that many seconds after they were
+    last written. Expired records are dropped lazily when read and a
+    few at a time on each write (see sweep()), so no single call pays
+    for a scan of the whole cache.
+
+    >>> cache = LRUCache(3)
+    >>> for i in range(5):
+    ...     cache[i] = str(i)
+    >>> list(cache)
+    [2, 3, 4]
+    >>> cache[2]
+    '2'
+    >>> cache[5] = '5'
+    >>> list(cache)
+    [4, 2, 5]
+    >>> 3 in cache
+    False
+    >>> cache.get(3, 'gone')
+    'gone'
+    >>> cache.get(4)
+    '4'
+    >>> list(cache)
+    [2, 5, 4]
+    >>> del cache[4]
+    >>> list(cache)
+    [2, 5]
+    >>> del cache[4]
+    Traceback (most recent call last):
+    CacheKeyError: 4
+    >>> cache.size = 1
+    >>> list(cache), len(cache)
+    ([5], 1)
+    >>> cache.mtime(5) <= time.time()
+    True
+    >>> LRUCache(0)
+    Traceback (most recent call last):
+    ValueError: 0
+
+    >>> cache = LRUCache(100, max_bytes=250)
+    >>> for i in range(5):
+    ...     cache[i] = 'x' * 60
+    >>> list(cache), cache.bytes
+    ([3, 4], 194)
+    >>> cache[3] = 'x' * 200
+    >>> list(cache), cache.bytes
+    ([3], 237)
+    >>> cache.max_bytes = None
+    >>> cache[5] = 'x' * 200
+    >>> list(cache)
+    [3, 5]
+    >>> cache.max_bytes = 300
+    >>> list(cache), cache.bytes
+    ([5], 237)
+
+    >>> cache = LRUCache(3, ttl=-1)
+    >>> cache['foo'] = 'bar'
+    >>> 'foo' in cache
+    False
+    >>> cache['foo']
+    Traceback (most recent call last):
+    CacheKeyError: 'foo'
     """
     
     class __Node(object):
         """Record of a cached value. Not for public consumption."""
+        __slots__ = ('prev', 'next', 'wprev', 'wnext',
+                     'key', 'obj', 'atime', 'mtime', 'expires', 'bytes')
         
         def __init__(self, key, obj, timestamp):
-            object.__init__(self)
+            self.prev = self.next = self
+            self.wprev = self.wnext = self
             self.key = key
             self.obj = obj
             self.atime = timestamp
             self.mtime = self.atime
-	    
-        def __cmp__(self, other):
-            return cmp(self.atime, other.atime)
+            self.expires = None
+            self.bytes = 0
 
         def __repr__(self):
             return "<%s %s => %s (%s)>" % \
                    (self.__class__, self.key, self.obj, \
                     time.asctime(time.localtime(self.atime)))
 
-    def __init__(self, size=DEFAULT_SIZE):
+    def __init__(self, size=DEFAULT_SIZE, ttl=None, namespace='lru',
+                 max_bytes=None, sizer=None):
         # Check arguments
         if size <= 0:
             raise ValueError, size
         elif type(size) is not type(0):
             raise TypeError, size
-        object.__init__(self)	
-        self.__heap = []
+        object.__init__(self)
+        # Sentinel of the access list: root.next is the least recently
+        # used record, root.prev the most recently used. The same
+        # sentinel heads the write list (wnext / wprev), oldest first
+        self.__root = self.__Node(None, None, 0)
         self.__dict = {}
+        self.bytes = 0
+        """Estimated memory used by the cached values, while max_bytes
+        is set."""
+        self.sizer = sizer or sizeof.estimate
+        self.namespace = namespace
+        """Group the cache's hits, misses etc. are counted under (see
+        the stats module)."""
+        self.ttl = ttl
+        """Seconds a record lives after it was last written, or None
+        to keep records until they are discarded. Changing it only
+        affects records written afterwards."""
         self.size = size
         """Maximum size of the cache.
         If more than 'size' elements are added to the cache,
         the least-recently-used ones will be discarded."""
+        self.max_bytes = max_bytes
+        """Maximum estimated memory used by the cached values, or None
+        for no limit. Auto-shrinks on assignment, like size."""
 	
     def __len__(self):
-        return len(self.__heap)
+        return len(self.__dict)
     
     def __contains__(self, key):
-        return self.__dict.has_key(key)
+        return self.__lookup(key) is not None
     
     def __setitem__(self, key, obj):
-        if self.__dict.has_key(key):
-            node = self.__dict[key]
+        now = time.time()
+        node = self.__dict.get(key)
+        if node is not None:
             node.obj = obj
-            node.atime = time.time()
-            node.mtime = node.atime
-            heapify(self.__heap)
+            node.atime = now
+            node.mtime = now
+            self.__unlink(node)
+            self.__wunlink(node)
         else:
             # size may have been reset, so we loop
-            while len(self.__heap) >= self.size:
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
-            node = self.__Node(key, obj, time.time())
+            while len(self.__dict) >= self.size:
+                self.__evict()
+            node = self.__Node(key, obj, now)
             self.__dict[key] = node
-            heappush(self.__heap, node)
+        self.__append(node)
+        self.__wappend(node)
+        stats.incr(self.namespace, 'sets')
+        if self.ttl is not None:
+            node.expires = now + self.ttl
+            self.sweep()
+        else:
+            node.expires = None
+        if self.max_bytes is not None:
+            self.bytes -= node.bytes
+            node.bytes = self.sizer(obj)
+            self.bytes += node.bytes
+            self.__shrink()
 	
     def __getitem__(self, key):
-        if not self.__dict.has_key(key):
+        node = self.__lookup(key)
+        if node is None:
+            stats.incr(self.namespace, 'misses')
             raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            node.atime = time.time()
-            heapify(self.__heap)
-            return node.obj
+        stats.incr(self.namespace, 'hits')
+        node.atime = time.time()
+        self.__unlink(node)
+        self.__append(node)
+        return node.obj
 	
+    def get(self, key, default=None):
+        """Return the value for key if cached (counting as an access),
+        else default."""
+        node = self.__lookup(key)
+        if node is None:
+            stats.incr(self.namespace, 'misses')
+            return default
+        stats.incr(self.namespace, 'hits')
+        node.atime = time.time()
+        self.__unlink(node)
+        self.__append(node)
+        return node.obj
+
+    def get_many(self, keys):
+        """Return a dictionary of the keys found in the cache.
+
+        >>> cache = LRUCache(3)
+        >>> cache.set_many({1: 'a', 2: 'b'})
+        >>> cache.get_many([1, 3])
+        {1: 'a'}
+        >>> cache.delete_many([1, 3])
+        >>> list(cache)
+        [2]
+        """
+        found = {}
+        for key in keys:
+            node = self.__lookup(key)
+            if node is not None:
+                node.atime = time.time()
+                self.__unlink(node)
+                self.__append(node)
+                found[key] = node.obj
+        stats.incr(self.namespace, 'hits', len(found))
+        stats.incr(self.namespace, 'misses', len(keys) - len(found))
+        return found
+
+    def set_many(self, mapping):
+        for key, obj in mapping.items():
+            self[key] = obj
+
+    def delete_many(self, keys):
+        """Discard the keys, ignoring those not in the cache."""
+        for key in keys:
+            node = self.__dict.pop(key, None)
+            if node is not None:
+                self.__discard(node)
+                stats.incr(self.namespace, 'deletes')
+
     def __delitem__(self, key):
-        if not self.__dict.has_key(key):
+        node = self.__dict.pop(key, None)
+        if node is None:
             raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            del self.__dict[key]
-            self.__heap.remove(node)
-            heapify(self.__heap)
-            return node.obj
+        self.__discard(node)
+        stats.incr(self.namespace, 'deletes')
+        return node.obj
 
     def __iter__(self):
-        copy = self.__heap[:]
-        while len(copy) > 0:
-            node = heappop(copy)
-            yield node.key
-        raise StopIteration
+        # Snapshot the keys so the cache may be modified while iterating
+        keys = []
+        now = time.time()
+        root = self.__root
+        node = root.next
+        while node is not root:
+            if node.expires is None or node.expires > now:
+                keys.append(node.key)
+            node = node.next
+        return iter(keys)
 
     def __setattr__(self, name, value):
+        if name == 'max_bytes' and value is not None and \
+               getattr(self, 'max_bytes', None) is None:
+            # start accounting for the records already cached
+            self.__measure()
         object.__setattr__(self, name, value)
-        # automagically shrink heap on resize
+        # automagically shrink on resize
         if name == 'size':
-            while len(self.__heap) > value:
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
+            while len(self.__dict) > value:
+                self.__evict()
+        elif name == 'max_bytes' and value is not None:
+            self.__shrink()
 	    
     def __repr__(self):
-        return "<%s (%d elements)>" % (str(self.__class__), len(self.__heap))
+        return "<%s (%d elements)>" % (str(self.__class__), len(self.__dict))
 
     def mtime(self, key):
         """Return the last modification time for the cache record with key.
         May be useful for cache instances where the stored values can get
         'stale', such as caching file or network resource contents."""
-        if not self.__dict.has_key(key):
+        node = self.__lookup(key)
+        if node is None:
             raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            return node.mtime
+        return node.mtime
+
+    def sweep(self, limit=SWEEP_LIMIT):
+        """Discard up to 'limit' expired records, oldest write first.
+
+        Called on every write while a ttl is set, so expired records
+        are reclaimed a few at a time rather than by a full scan. Can
+        also be called periodically from outside; returns the number
+        of records discarded.
+
+        >>> cache = LRUCache(10, ttl=60)
+        >>> for i in range(3):
+        ...     cache[i] = i
+        >>> cache.sweep(), len(cache)
+        (0, 3)
+        >>> cache.ttl = -1
+        >>> cache[3] = 3
+        >>> 3 in cache, len(cache)
+        (False, 3)
+        >>> cache.sweep(), len(cache)
+        (0, 3)
+        >>> for i in range(3):
+        ...     cache[i] = i
+        >>> len(cache), list(cache)
+        (0, [])
+        """
+        root = self.__root
+        now = time.time()
+        swept = 0
+        while swept < limit:
+            node = root.wnext
+            if node is root or node.expires is None or node.expires > now:
+                break
+            del self.__dict[node.key]
+            self.__discard(node)
+            swept += 1
+        if swept:
+            stats.incr(self.namespace, 'expired', swept)
+        return swept
+
+    def gauges(self):
+        """Functions reporting the current size of the cache, for
+        stats.register_gauge.
+
+        >>> cache = LRUCache(10)
+        >>> for i in range(5):
+        ...     cache[i] = 'x' * 100
+        >>> g = cache.gauges()
+        >>> g['size'](), g['bytes']() == 5 * sizeof.estimate('x' * 100)
+        (5, True)
+        """
+        return {
+            'size': self.__len__,
+            'bytes': self.__estimate_bytes,
+            'max_bytes': lambda: self.max_bytes,
+            }
+
+    def __estimate_bytes(self):
+        """Memory used by the cached values - tracked on write when
+        max_bytes is set, otherwise estimated from a sample of the
+        most recently used records."""
+        if self.max_bytes is not None:
+            return self.bytes
+        root = self.__root
+        node = root.prev
+        sampled = total = 0
+        while node is not root and sampled < SIZE_SAMPLE:
+            total += sizeof.estimate(node.obj)
+            sampled += 1
+            node = node.prev
+        if not sampled:
+            return 0
+        return total * len(self.__dict) // sampled
+
+    def __lookup(self, key):
+        """Return the live record for key, dropping it if expired"""
+        node = self.__dict.get(key)
+        if node is None:
+            return None
+        if node.expires is not None and node.expires <= time.time():
+            del self.__dict[key]
+            self.__discard(node)
+            stats.incr(self.namespace, 'expired')
+            return None
+        return node
+
+    def __append(self, node):
+        """Link node in as the most recently used record"""
+        root = self.__root
+        last = root.prev
+        last.next = node
+        node.prev = last
+        node.next = root
+        root.prev = node
+
+    def __unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def __wappend(self, node):
+        """Link node in as the most recently written record"""
+        root = self.__root
+        last = root.wprev
+        last.wnext = node
+        node.wprev = last
+        node.wnext = root
+        root.wprev = node
+
+    def __wunlink(self, node):
+        node.wprev.wnext = node.wnext
+        node.wnext.wprev = node.wprev
+
+    def __discard(self, node):
+        """Unlink a record already removed from the dictionary"""
+        self.__unlink(node)
+        self.__wunlink(node)
+        self.bytes -= node.bytes
+
+    def __measure(self):
+        """Size every cached record, when byte accounting starts"""
+        total = 0
+        for node in self.__dict.itervalues():
+            node.bytes = self.sizer(node.obj)
+            total += node.bytes
+        self.bytes = total
+
+    def __shrink(self):
+        """Discard records until back under max_bytes"""
+        while self.bytes > self.max_bytes and self.__dict:
+            self.__evict()
+
+    def __evict(self):
+        """Discard the least recently used record"""
+        lru = self.__root.next
+        del self.__dict[lru.key]
+        self.__discard(lru)
+        stats.incr(self.namespace, 'evictions')
 
 if __name__ == "__main__":
     cache = LRUCache(25)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from cachemanager import namespacer
+from cachemanager import namespacer, multi_namespacer
+import stats
 
 class MemcachedWrapper(object):
     """
@@ -19,13 +20,35 @@ class MemcachedWrapper(object):
     True
     >>> mcw['foo'] == 'bar'
     True
+    >>> mcw.get('foo')
+    'bar'
     >>> del mcw['foo']
     >>> 'foo' in mcw
     False
+    >>> mcw.get('foo', 'baz')
+    'baz'
+
+    Batches of keys cost one round trip
+
+    >>> mcw.set_many({'a': 1, 'b': 2})
+    >>> mcw.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+    True
+    >>> mcw.delete_many(['a', 'b'])
+    >>> mcw.get_many(['a', 'b'])
+    {}
+
+    With a ttl, memcached expires the records itself
+
+    >>> mcw = MemcachedWrapper(mc, 'test', ttl = 60)
+    >>> mcw['foo'] = 'bar'
+    >>> 'foo' in mcw
+    True
+    >>> del mcw['foo']
     """
-    def __init__(self, mc, namespace):
+    def __init__(self, mc, namespace, ttl = None):
         self.mc = mc
         self.namespace = namespace
+        self.ttl = ttl
 
     def __len__(self):
         raise Exception("Not implemented")
@@ -36,17 +59,81 @@ class MemcachedWrapper(object):
 
     @namespacer
     def __setitem__(self, key, val):
-	self.mc.set(key, val)
+        stats.incr(self.namespace, 'sets')
+        self.mc.set(key, val, self.ttl or 0)
+
+    @namespacer
+    def set(self, key, val, ttl = None):
+        """
+        Store with a ttl other than the wrapper's own
+        """
+        if ttl is None:
+            ttl = self.ttl
+        stats.incr(self.namespace, 'sets')
+        self.mc.set(key, val, ttl or 0)
 
     @namespacer
     def __getitem__(self, key):
-        return self.mc.get(key)
+        val = self.mc.get(key)
+        stats.lookup(self.namespace, val is not None)
+        return val
+
+    @namespacer
+    def add(self, key, val, ttl = 0):
+        """
+        Store only if the key is not already set - returns
+        whether it was stored. Useful as a lock / lease
+
+        >>> import memcache
+        >>> mcw = MemcachedWrapper(memcache.Client(['127.0.0.1:11211']), 'test')
+        >>> mcw.add('lease', 1, 5)
+        True
+        >>> mcw.add('lease', 1, 5)
+        False
+        >>> del mcw['lease']
+        """
+        return bool(self.mc.add(key, val, ttl))
+
+    @namespacer
+    def get(self, key, default = None):
+        """
+        Single round trip lookup - prefer to 'key in cache'
+        followed by cache[key]
+        """
+        val = self.mc.get(key)
+        stats.lookup(self.namespace, val is not None)
+        if val is None:
+            return default
+        return val
 
     @namespacer
     def __delitem__(self, key):
+        stats.incr(self.namespace, 'deletes')
         if self.mc.delete(key) == 0:
             raise KeyError(key)
     
+    @multi_namespacer
+    def get_many(self, keys, prefix):
+        found = self.mc.get_multi(keys, key_prefix = prefix)
+        stats.lookup(self.namespace, True, len(found))
+        stats.lookup(self.namespace, False, len(keys) - len(found))
+        return found
+
+    @multi_namespacer
+    def set_many(self, mapping, prefix, ttl = None):
+        """
+        ttl overrides the wrapper's own, as for set
+        """
+        if ttl is None:
+            ttl = self.ttl
+        stats.incr(self.namespace, 'sets', len(mapping))
+        self.mc.set_multi(mapping, ttl or 0, key_prefix = prefix)
+
+    @multi_namespacer
+    def delete_many(self, keys, prefix):
+        stats.incr(self.namespace, 'deletes', len(keys))
+        self.mc.delete_multi(keys, key_prefix = prefix)
+    
     def __repr__(self):
         return "MemcachedWrapper"
 
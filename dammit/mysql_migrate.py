@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Convert a MySQL database from 40 byte hex ids to 20 byte raw
+SHA-1 ids (the binary_ids option of db_mysql.MySQL) while it's
+in use.
+
+    python mysql_migrate.py [options] copy
+    python mysql_migrate.py [options] finish
+
+copy - installs triggers logging the ids of every change to the
+existing tables, creates the new tables (suffixed _bin) then
+copies everything across in chunks of ids, each chunk its own
+short transaction, pausing between chunks. Finally changes made
+meanwhile are replayed. It can be interrupted and run again,
+carrying on where it left off.
+
+finish - run once writes have stopped (e.g. while deploying the
+binary_ids = True config): replays the last few changes, swaps
+the tables with a single RENAME TABLE and removes the triggers.
+The old tables are kept, suffixed _hex, to roll back to.
+
+Triggers need the TRIGGER privilege (or SUPER with binary
+logging enabled).
+"""
+import sys, time, logging
+import db_mysql
+from db_mysql import placeholders
+
+TABLES = ('urldammit_uris', 'urldammit_tags', 'urldammit_pairs')
+
+COLUMNS = {
+    'urldammit_uris': 'uri, location, status, created, updated',
+    'urldammit_tags': 'tag',
+    'urldammit_pairs': 'pair_key, pair_value',
+    }
+
+NEW = '_bin'
+OLD = '_hex'
+CHANGES = 'urldammit_migrate_changes'
+
+DEFAULT_CHUNK = 1000
+"""Ids copied per transaction."""
+
+DEFAULT_PAUSE = 0.1
+"""Seconds to wait between chunks, leaving room for other queries."""
+
+def copy_sql(table, where):
+    """
+    INSERT ... SELECT from the hex table to the binary one
+
+    >>> print copy_sql('urldammit_tags', 'id > %s')
+    INSERT INTO urldammit_tags_bin ( id, tag )
+        SELECT UNHEX(id), tag FROM urldammit_tags WHERE id > %s
+    """
+    columns = COLUMNS[table]
+    return """INSERT INTO %s%s ( id, %s )
+    SELECT UNHEX(id), %s FROM %s WHERE %s""" % (
+        table, NEW, columns, columns, table, where)
+
+def install_triggers(cursor):
+    """
+    Log the id of every insert, update or delete on the
+    old tables to the changes table
+    """
+    cursor.execute("""CREATE TABLE IF NOT EXISTS %s (
+    seq BIGINT UNSIGNED NOT NULL AUTO_INCREMENT ,
+    id BINARY( 40 ) NOT NULL ,
+    PRIMARY KEY ( seq )
+    ) ENGINE = innodb""" % CHANGES)
+
+    cursor.execute("SHOW TRIGGERS")
+    installed = set([row[0] for row in cursor.fetchall()])
+
+    for table in TABLES:
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            name = "%s_%s" % (table, event.lower())
+            if name in installed:
+                continue
+            cursor.execute("""CREATE TRIGGER %s AFTER %s ON %s
+            FOR EACH ROW INSERT INTO %s ( id ) VALUES ( %s.id )""" % (
+                name, event, table, CHANGES, row))
+
+def drop_triggers(cursor):
+    for table in TABLES:
+        for event in ('insert', 'update', 'delete'):
+            cursor.execute("DROP TRIGGER IF EXISTS %s_%s" % (table, event))
+    cursor.execute("DROP TABLE IF EXISTS %s" % CHANGES)
+
+def copy_chunks(db, chunk = DEFAULT_CHUNK, pause = DEFAULT_PAUSE):
+    """
+    Copy the old tables to the new in chunks of ids, starting
+    after the highest id copied so far. Returns the number of
+    records copied
+    """
+    cursor = db.cursor()
+    cursor.execute("SELECT LOWER(HEX(MAX(id))) FROM urldammit_uris%s" % NEW)
+    last = cursor.fetchone()[0] or ''
+    db.commit()
+
+    count = 0
+    start = time.time()
+    while True:
+        sql = """SELECT id FROM urldammit_uris
+        WHERE id > %s ORDER BY id LIMIT %s"""
+        cursor.execute(sql, (last, chunk))
+        ids = [row[0] for row in cursor.fetchall()]
+
+        if len(ids) == chunk:
+            where, params = "id > %s AND id <= %s", (last, ids[-1])
+        else:
+            # the rest, including any tags / pairs with ids
+            # beyond the last record
+            where, params = "id > %s", (last, )
+
+        for table in TABLES:
+            cursor.execute(copy_sql(table, where), params)
+        db.commit()
+
+        count += len(ids)
+        logging.info(
+            "mysql_migrate: %s records copied in %.1fs",
+            count, time.time() - start
+            )
+
+        if len(ids) < chunk:
+            return count
+
+        last = ids[-1]
+        time.sleep(pause)
+
+def catch_up(db, chunk = DEFAULT_CHUNK):
+    """
+    Copy again the records changed since the triggers were
+    installed, a chunk at a time, until there are none left.
+    Returns the number of changes replayed
+    """
+    cursor = db.cursor()
+    count = 0
+    while True:
+        sql = "SELECT seq, id FROM %s ORDER BY seq LIMIT %%s" % CHANGES
+        cursor.execute(sql, (chunk, ))
+        rows = cursor.fetchall()
+        if not rows:
+            db.commit()
+            return count
+
+        ids = list(set([row[1] for row in rows]))
+        for table in TABLES:
+            sql = "DELETE FROM %s%s WHERE id IN (%s)" % (
+                table, NEW, ", ".join(["UNHEX(%s)"] * len(ids)))
+            cursor.execute(sql, ids)
+            where = "id IN (%s)" % placeholders(ids)
+            cursor.execute(copy_sql(table, where), ids)
+
+        sql = "DELETE FROM %s WHERE seq <= %%s" % CHANGES
+        cursor.execute(sql, (rows[-1][0], ))
+        db.commit()
+        count += len(rows)
+
+def copy(db, chunk = DEFAULT_CHUNK, pause = DEFAULT_PAUSE):
+    cursor = db.cursor()
+    install_triggers(cursor)
+    db_mysql.create_tables(cursor, 20, NEW)
+    db.commit()
+    copied = copy_chunks(db, chunk, pause)
+    replayed = catch_up(db, chunk)
+    logging.info(
+        "mysql_migrate: copied %s records, replayed %s changes - "
+        "run finish once writes have stopped", copied, replayed)
+
+def finish(db, chunk = DEFAULT_CHUNK):
+    cursor = db.cursor()
+    if db_mysql.id_bytes(cursor, 'urldammit_uris%s' % NEW) != 20:
+        raise ValueError("Nothing to finish - run copy first")
+
+    replayed = catch_up(db, chunk)
+    renames = []
+    for table in TABLES:
+        renames.append("%s TO %s%s" % (table, table, OLD))
+        renames.append("%s%s TO %s" % (table, NEW, table))
+    cursor.execute("RENAME TABLE %s" % ", ".join(renames))
+    drop_triggers(cursor)
+    db.commit()
+    logging.info(
+        "mysql_migrate: replayed %s changes and switched to binary ids - "
+        "old tables are suffixed %s", replayed, OLD)
+
+def main(argv):
+    from optparse import OptionParser
+    parser = OptionParser(usage = "%prog [options] copy|finish")
+    parser.add_option('--host')
+    parser.add_option('--user')
+    parser.add_option('--password')
+    parser.add_option('--db')
+    parser.add_option('--chunk', type = 'int', default = DEFAULT_CHUNK)
+    parser.add_option('--pause', type = 'float', default = DEFAULT_PAUSE)
+    options, args = parser.parse_args(argv)
+    if args not in (['copy'], ['finish']):
+        parser.error("expected copy or finish")
+
+    config = {}
+    for key, value in (('db_host', options.host), ('db_user', options.user),
+                       ('db_pass', options.password), ('db_name', options.db)):
+        if value is not None:
+            config[key] = value
+
+    logging.basicConfig(level = logging.INFO)
+    m = db_mysql.MySQL(config, bootstrap = False)
+    db = m.pool.get()
+    try:
+        if args == ['copy']:
+            copy(db, options.chunk, options.pause)
+        else:
+            finish(db, options.chunk)
+    finally:
+        db.close()
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--test']:
+        _test()
+    else:
+        main(sys.argv[1:])
@@ -4,7 +4,7 @@
 For tests - a cache which doesn't remember
 anything
 """
-from cachemanager import namespacer
+from cachemanager import namespacer, multi_namespacer
 
 class NullCache(object):
     """
@@ -17,6 +17,14 @@ class NullCache(object):
     >>> nc['foo'] == 'bar'
     Traceback (most recent call last):
     KeyError: '_foo'
+    >>> print nc.get('foo')
+    None
+    >>> nc.get('foo', 'bar')
+    'bar'
+    >>> nc.set_many({'foo': 'bar'})
+    >>> nc.get_many(['foo'])
+    {}
+    >>> nc.delete_many(['foo'])
     >>> del nc['foo']
     Traceback (most recent call last):
     KeyError: '_foo'
@@ -35,10 +43,30 @@ class NullCache(object):
     def __setitem__(self, key, val):
 	pass
 
+    @namespacer
+    def set(self, key, val, ttl = None):
+        pass
+
     @namespacer
     def __getitem__(self, key):
         raise KeyError(key)
 
+    @namespacer
+    def get(self, key, default = None):
+        return default
+
+    @multi_namespacer
+    def get_many(self, keys, prefix):
+        return {}
+
+    @multi_namespacer
+    def set_many(self, mapping, prefix, ttl = None):
+        pass
+
+    @multi_namespacer
+    def delete_many(self, keys, prefix):
+        pass
+
     @namespacer
     def __delitem__(self, key):
         raise KeyError(key)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A bounded, thread-safe pool of database connections.
+
+Connections are opened on demand up to a maximum and handed back
+to the pool after use rather than closed. On checkout, a connection
+that has been idle longer than max_idle seconds is closed and
+replaced (the server may well have dropped it already) and one
+idle longer than ping_after seconds is pinged first - anything
+that fails the ping is replaced too. When every connection is in
+use, checkout waits up to timeout seconds then raises PoolTimeout.
+
+Connections which fail while in use should be discarded rather
+than put back, which frees their slot for a new one.
+"""
+import time, threading
+import stats
+
+DEFAULT_SIZE = 10
+"""Most connections open at once."""
+
+DEFAULT_TIMEOUT = 5
+"""Seconds to wait for a connection when all are in use."""
+
+DEFAULT_MAX_IDLE = 300
+"""Seconds a connection may sit unused before it's recycled."""
+
+DEFAULT_PING_AFTER = 5
+"""Seconds a connection may sit unused before it's pinged on checkout."""
+
+class PoolTimeout(Exception):
+    """Raised when no connection is free within the checkout timeout"""
+    pass
+
+def ping(conn):
+    """
+    Default health check - for MySQLdb / DB-API connections
+    with a ping() method, which raises if the connection is dead
+    """
+    conn.ping()
+
+def close(conn):
+    """
+    Default way to close a connection, ignoring any errors
+    as it's most likely broken already
+    """
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+class Pool(object):
+    """
+    Pool of connections made by calling connect()
+
+    >>> class Conn(object):
+    ...     opened = 0
+    ...     def __init__(self):
+    ...         Conn.opened += 1
+    ...         self.alive = True
+    ...     def ping(self):
+    ...         if not self.alive: raise IOError('gone away')
+    ...     def close(self):
+    ...         self.alive = False
+    >>> p = Pool(Conn, size = 2, timeout = 0.1)
+    >>> a = p.get()
+    >>> p.put(a)
+    >>> p.get() is a
+    True
+    >>> b = p.get()
+    >>> Conn.opened, p.gauges()['in_use']
+    (2, 2)
+    >>> p.get()
+    Traceback (most recent call last):
+    ...
+    PoolTimeout: no connection free after 0.1 seconds
+
+    Broken connections are discarded, freeing the slot
+
+    >>> p.discard(b)
+    >>> b.alive
+    False
+    >>> c = p.get()
+    >>> c is b, Conn.opened
+    (False, 3)
+
+    Idle connections are checked before reuse
+
+    >>> p.put(c)
+    >>> c.alive = False
+    >>> p.ping_after = 0
+    >>> d = p.get()
+    >>> d is c, Conn.opened
+    (False, 4)
+    >>> p.put(d)
+    >>> p.max_idle = 0
+    >>> p.get() is d
+    False
+    """
+    def __init__(self, connect, size = DEFAULT_SIZE,
+                 timeout = DEFAULT_TIMEOUT, max_idle = DEFAULT_MAX_IDLE,
+                 ping_after = DEFAULT_PING_AFTER, ping = ping,
+                 close = close, namespace = 'pool'):
+        if size < 1:
+            raise ValueError, size
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.ping = ping
+        self.close = close
+        self.namespace = namespace
+        # ( connection, time returned ) - most recently used last
+        self.idle = []
+        self.in_use = 0
+        self.cond = threading.Condition(threading.Lock())
+
+    def get(self, timeout = None):
+        """
+        Check out a connection, opening one if needed
+        """
+        if timeout is None:
+            timeout = self.timeout
+        conn, since = self._checkout(timeout)
+        try:
+            if conn is not None:
+                conn = self._check(conn, since)
+            if conn is None:
+                conn = self.connect()
+                stats.incr(self.namespace, 'connects')
+        except:
+            self._release()
+            raise
+        return conn
+
+    def put(self, conn):
+        """
+        Return a healthy connection to the pool
+        """
+        self.cond.acquire()
+        try:
+            self.idle.append((conn, time.time()))
+            self.in_use -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def discard(self, conn):
+        """
+        Close a broken connection instead of returning it
+        """
+        self.close(conn)
+        stats.incr(self.namespace, 'discarded')
+        self._release()
+
+    def clear(self):
+        """
+        Close all idle connections
+        """
+        self.cond.acquire()
+        try:
+            idle, self.idle = self.idle, []
+        finally:
+            self.cond.release()
+        for conn, since in idle:
+            self.close(conn)
+
+    def gauges(self):
+        self.cond.acquire()
+        try:
+            return {'in_use': self.in_use, 'idle': len(self.idle),
+                    'size': self.size}
+        finally:
+            self.cond.release()
+
+    def _checkout(self, timeout):
+        """
+        Claim a slot, returning an idle connection with the
+        time it was returned, or ( None, None ) if a new
+        connection should be opened
+        """
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while not self.idle and self.in_use >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    stats.incr(self.namespace, 'timeouts')
+                    raise PoolTimeout(
+                        "no connection free after %s seconds" % timeout)
+                self.cond.wait(remaining)
+            self.in_use += 1
+            if self.idle:
+                return self.idle.pop()
+            return (None, None)
+        finally:
+            self.cond.release()
+
+    def _release(self):
+        self.cond.acquire()
+        try:
+            self.in_use -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def _check(self, conn, since):
+        """
+        Returns conn if it's still usable, otherwise closes
+        it and returns None
+        """
+        idle = time.time() - since
+        if idle > self.max_idle:
+            stats.incr(self.namespace, 'recycled')
+            self.close(conn)
+            return None
+        if idle > self.ping_after:
+            try:
+                self.ping(conn)
+            except Exception:
+                stats.incr(self.namespace, 'discarded')
+                self.close(conn)
+                return None
+        return conn
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Delete stale records - those with a given status which haven't
+been updated for a number of days, e.g. 404s nobody has reported
+as found again in six months.
+
+    python dammit/purge.py [options]
+
+Backends find stale records with stale(status, before,
+batch_size), generating batches of ids oldest first, paging by
+( updated, id ) over an index on ( status, updated ) - so each
+batch is a short query. Each batch is deleted with one
+delete_many, which also drops it from the db cache, then handed
+to forget() for any other caches, then we pause, leaving the
+database room for other work.
+
+"updated" is the last time a registration changed the record -
+re-reporting the same status doesn't touch it - so it's the
+nearest thing we have to "last seen": requests for a URI aren't
+recorded.
+"""
+import os, sys, time, datetime, logging, threading
+import stats
+from uri import write_each
+
+DEFAULT_RETENTION = {404: 180}
+"""Days to keep records of each status - others are kept forever."""
+
+DEFAULT_BATCH_SIZE = 500
+"""Records deleted per batch."""
+
+DEFAULT_PAUSE = 0.5
+"""Seconds to wait between batches."""
+
+DEFAULT_INTERVAL = 24 * 60 * 60
+"""Seconds between scheduled purges."""
+
+def run(db, retention = None, batch_size = DEFAULT_BATCH_SIZE,
+        pause = DEFAULT_PAUSE, forget = None, dry_run = False, now = None):
+    """
+    Delete the records older than the retention for their status
+    - a dict of status -> days. forget is called with the ids of
+    each batch deleted. Returns the number of records deleted (or
+    that would be, for a dry run)
+
+    Counted in the 'purge' group of the stats module
+
+    >>> from db_mock import MockDB
+    >>> from uri import URI
+    >>> stats.reset()
+    >>> db = MockDB()
+    >>> for n in range(5):
+    ...     u = URI()
+    ...     u.uri = 'http://local.ch/%s.html' % n
+    ...     u.status = 200
+    ...     if n % 2: u.status = 404
+    ...     u.updated = datetime.datetime(2009, 1, 1) + datetime.timedelta(days = 30 * n)
+    ...     db.insert(u)
+    >>> forgotten = []
+    >>> now = datetime.datetime(2009, 12, 1)
+    >>> run(db, {404: 180}, batch_size = 1, pause = 0, dry_run = True, now = now)
+    2
+    >>> run(db, {404: 280, 200: 280}, batch_size = 1, pause = 0,
+    ...     forget = forgotten.extend, now = now)
+    2
+    >>> sorted(u.uri for u in db.uris.values())
+    ['http://local.ch/2.html', 'http://local.ch/3.html', 'http://local.ch/4.html']
+    >>> len(forgotten), stats.snapshot()['purge']['records']
+    (2, 2)
+    """
+    if retention is None:
+        retention = DEFAULT_RETENTION
+    if now is None:
+        now = datetime.datetime.now()
+
+    total = 0
+    start = time.time()
+    for status, days in sorted(retention.items()):
+        before = now - datetime.timedelta(days = days)
+        count = 0
+        for ids in db.stale(status, before, batch_size):
+            if dry_run:
+                count += len(ids)
+                continue
+
+            errors = write_each(db, 'delete', ids)
+            deleted = [id for id, error in zip(ids, errors) if error is None]
+            failed = len(ids) - len(deleted)
+            if failed:
+                stats.incr('purge', 'errors', failed)
+                logging.error("purge: %s deletes failed: %s", failed,
+                              [e for e in errors if e][0])
+            if forget and deleted:
+                forget(deleted)
+            stats.incr('purge', 'records', len(deleted))
+            count += len(deleted)
+            logging.info(
+                "purge: %s records with status %s deleted in %.1fs",
+                count, status, time.time() - start
+                )
+            time.sleep(pause)
+        total += count
+
+    stats.observe('purge', 'run', time.time() - start)
+    return total
+
+def start(db, interval = DEFAULT_INTERVAL, **kwargs):
+    """
+    Run run() every interval seconds, in a background thread -
+    returns the thread
+    """
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                count = run(db, **kwargs)
+                logging.info("purge: finished with %s records", count)
+            except Exception, e:
+                logging.error("purge: failed: %s", e)
+
+    thread = threading.Thread(target = loop, name = 'purge')
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+def main(argv):
+    """
+    Purge the database given by config.get_db(), dropping the
+    records from the shared caches too
+    """
+    from optparse import OptionParser
+    parser = OptionParser(usage = "%prog [options]")
+    parser.add_option('--keep', action = 'append', default = [],
+                      metavar = 'STATUS=DAYS',
+                      help = "retention per status, e.g. 404=180 (repeatable)")
+    parser.add_option('--batch', type = 'int', default = DEFAULT_BATCH_SIZE)
+    parser.add_option('--pause', type = 'float', default = DEFAULT_PAUSE)
+    parser.add_option('--dry-run', action = 'store_true', default = False,
+                      help = "just count the records which would be deleted")
+    options, args = parser.parse_args(argv)
+
+    retention = {}
+    for keep in options.keep:
+        try:
+            status, days = [int(x) for x in keep.split('=')]
+        except ValueError:
+            parser.error("expected STATUS=DAYS, not %s" % keep)
+        retention[status] = days
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    import config
+    import cachemanager
+
+    known = cachemanager.new_instance('known')
+    def forget(ids):
+        cachemanager.delete_many(known, ids)
+
+    logging.basicConfig(level = logging.INFO)
+    count = run(
+        config.get_db(), retention or None, options.batch, options.pause,
+        forget = forget, dry_run = options.dry_run
+        )
+    print "%s records %s" % (count, options.dry_run and "to purge" or "purged")
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--test']:
+        _test()
+    else:
+        main(sys.argv[1:])
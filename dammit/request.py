@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import datetime, re, logging
+import datetime, time, re, logging
 from types import *
 from urlparse import urlsplit, urlunsplit
 from urllib import unquote_plus as urldecode
@@ -138,6 +138,78 @@ def pack_response(u):
         logging.error("Can't dump '%s'" % d)
         return ''
 
+class Rendered(object):
+    """
+    A URI together with its JSON response, so requests served
+    from the cache don't repeat pack_response. The response is
+    rendered again if the URI's updated time has moved on
+
+    >>> class TestUri: uri = 'http://www.google.com'; updated = 1
+    >>> u = TestUri()
+    >>> r = Rendered(u)
+    >>> r.response()
+    '{"updated": "1", "uri": "http://www.google.com"}'
+    >>> r.response() is r.response()
+    True
+    >>> u.updated = 2
+    >>> r.response()
+    '{"updated": "2", "uri": "http://www.google.com"}'
+    """
+    __slots__ = ('uri', 'updated', 'body')
+
+    def __init__(self, u):
+        self.uri = u
+        self.render()
+
+    def render(self):
+        self.updated = self.uri.updated
+        self.body = pack_response(self.uri)
+
+    def response(self):
+        if self.updated != self.uri.updated:
+            self.render()
+        return self.body
+
+    def __getstate__(self):
+        return (self.uri, self.updated, self.body)
+
+    def __setstate__(self, state):
+        self.uri, self.updated, self.body = state
+
+def pack_cursor(u):
+    """
+    The position after a URI in a page ordered by ( updated, id ),
+    for the next page to start from
+
+    >>> class TestUri: updated = datetime.datetime(2009, 1, 2, 3, 4, 5, 6); id = 'abc'
+    >>> pack_cursor(TestUri())
+    '20090102030405.000006-abc'
+    """
+    return "%s.%06d-%s" % (
+        u.updated.strftime('%Y%m%d%H%M%S'), u.updated.microsecond, u.id
+        )
+
+cursor_pattern = re.compile('^([0-9]{14})\.([0-9]{6})-([0-9a-f]{40})$')
+def unpack_cursor(s):
+    """
+    The ( updated, id ) from pack_cursor, or None if it
+    isn't one
+
+    >>> unpack_cursor('20090102030405.000006-' + 'a' * 40)[0]
+    datetime.datetime(2009, 1, 2, 3, 4, 5, 6)
+    >>> unpack_cursor('2009-' + 'a' * 40)
+    >>> unpack_cursor('20091302030405.000006-' + 'a' * 40)
+    """
+    match = cursor_pattern.match(s or '')
+    if not match:
+        return None
+    stamp, microsecond, id = match.groups()
+    try:
+        updated = datetime.datetime(*time.strptime(stamp, '%Y%m%d%H%M%S')[:6])
+    except ValueError:
+        return None
+    return (updated.replace(microsecond = int(microsecond)), id)
+
 statusmap = {
     200: '200 OK',
     201: '201 Created',
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rough estimates of the memory used by cached values.
+
+Figures are for CPython 2 on a 64 bit platform and only
+need to be good enough to compare caches and spot growth
+"""
+import datetime
+from uri import URI, GuardedURI
+
+POINTER = 8
+
+URI_OVERHEAD = 16 + POINTER * len(URI.__slots__) + 77 + 2 * 48 + 24
+"""A URI with its id, timestamps and status - add the rest with estimate_uri"""
+
+def string_size(s):
+    if s is None:
+        return 0
+    if type(s) is unicode:
+        return 52 + 4 * len(s)
+    return 37 + len(s)
+
+def estimate_uri(u):
+    """
+    Estimate for URI objects, going straight to the slots
+    rather than walking them generically
+
+    >>> u = URI()
+    >>> u.uri = 'http://local.ch/'
+    >>> u.status = 200
+    >>> u.tags = ['foo', 'bar']
+    >>> u.pairs = {'a': 'x' * 255}
+    >>> bare = estimate_uri(u)
+    >>> u.pairs = dict(('k%s' % i, 'x' * 255) for i in range(20))
+    >>> estimate_uri(u) - bare > 19 * 255
+    True
+    """
+    size = URI_OVERHEAD + string_size(u._uri) + string_size(u._location)
+    tags = u._tags
+    if tags:
+        size += 72 + POINTER * len(tags)
+        for tag in tags:
+            size += string_size(tag)
+    pairs = u._pairs
+    if pairs:
+        size += 280 + 3 * POINTER * len(pairs)
+        for k, v in pairs.iteritems():
+            size += string_size(k) + string_size(v)
+    if u._meta:
+        size += estimate(u._meta)
+    return size
+
+estimators = {
+    URI: estimate_uri,
+    GuardedURI: estimate_uri,
+    }
+
+def estimate(obj):
+    """
+    Approximate number of bytes used by obj and
+    everything it refers to
+
+    >>> estimate('abc')
+    40
+    >>> estimate(['abc', 'abc']) > 2 * estimate('abc')
+    True
+    >>> estimate({'a': 'b'}) > estimate('a') + estimate('b')
+    True
+    """
+    t = type(obj)
+    if t in estimators:
+        return estimators[t](obj)
+    if t is str:
+        return 37 + len(obj)
+    if t is unicode:
+        return 52 + 4 * len(obj)
+    if obj is None or t in (bool, int, long, float):
+        return 24
+    if t in (list, tuple):
+        size = 72 + POINTER * len(obj)
+        for item in obj:
+            size += estimate(item)
+        return size
+    if t is dict:
+        size = 280 + 3 * POINTER * len(obj)
+        for k, v in obj.items():
+            size += estimate(k) + estimate(v)
+        return size
+    if t is datetime.datetime:
+        return 48
+    slots = getattr(t, '__slots__', None)
+    if slots:
+        size = 16 + POINTER * len(slots)
+        for slot in slots:
+            size += estimate(getattr(obj, slot, None))
+        return size
+    if hasattr(obj, '__dict__'):
+        return 64 + estimate(obj.__dict__)
+    return 64
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
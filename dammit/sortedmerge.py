@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Merge of already sorted iterables, for Python 2.5 which
+lacks heapq.merge
+"""
+import heapq
+
+def merge(*iterables):
+    """
+    Generate the values of the sorted iterables in sorted
+    order, reading each lazily as heapq.merge does. Equal
+    values come out in the order of the iterables given
+
+    >>> list(merge([1, 4, 7], [], [2, 5], iter([3, 6, 8])))
+    [1, 2, 3, 4, 5, 6, 7, 8]
+    >>> list(merge([(1, 'a')], [(1, 'b')], [(0, 'c')]))
+    [(0, 'c'), (1, 'a'), (1, 'b')]
+    >>> list(merge())
+    []
+    """
+    heap = []
+    for i, it in enumerate(iterables):
+        next = iter(it).next
+        try:
+            heap.append((next(), i, next))
+        except StopIteration:
+            pass
+    heapq.heapify(heap)
+    while heap:
+        value, i, next = heap[0]
+        yield value
+        try:
+            heapq.heapreplace(heap, (next(), i, next))
+        except StopIteration:
+            heapq.heappop(heap)
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Counters for instrumenting the caches and backends, cheap
+enough to leave on in production.
+
+Each thread increments counters in its own dictionary, so
+counting takes no locks - the per-thread dictionaries are
+only summed when a snapshot is taken.
+
+Counters are grouped, usually by cache namespace ('known',
+'unknown', 'db' ...). Gauges are functions called at snapshot
+time for values like the current size of a cache.
+"""
+import threading
+
+local = threading.local()
+tables = []
+tables_lock = threading.Lock()
+gauges = {}
+
+def table():
+    """
+    The counters of the current thread
+    """
+    try:
+        return local.table
+    except AttributeError:
+        t = local.table = {}
+        tables_lock.acquire()
+        try:
+            tables.append(t)
+        finally:
+            tables_lock.release()
+        return t
+
+def incr(group, name, n = 1):
+    """
+    Add n to a counter
+
+    >>> reset()
+    >>> incr('known', 'hits')
+    >>> incr('known', 'hits', 2)
+    >>> snapshot()
+    {'known': {'hits': 3}}
+    """
+    t = table()
+    key = (group, name)
+    t[key] = t.get(key, 0) + n
+
+def lookup(group, found, n = 1):
+    """
+    Count n cache lookups as hits or misses
+
+    >>> reset()
+    >>> lookup('known', True)
+    >>> lookup('known', False, 2)
+    >>> snapshot()['known'] == {'hits': 1, 'misses': 2}
+    True
+    """
+    if found:
+        incr(group, 'hits', n)
+    else:
+        incr(group, 'misses', n)
+
+def observe(group, name, seconds):
+    """
+    Record the duration of an operation - kept as a count,
+    a total and a maximum
+
+    >>> reset()
+    >>> observe('db', 'load', 0.5)
+    >>> observe('db', 'load', 0.25)
+    >>> s = snapshot()['db']
+    >>> s['load_count'], s['load_seconds'], s['load_seconds_max']
+    (2, 0.75, 0.5)
+    """
+    t = table()
+    key = (group, name + '_count')
+    t[key] = t.get(key, 0) + 1
+    key = (group, name + '_seconds')
+    t[key] = t.get(key, 0) + seconds
+    key = (group, name + '_seconds_max')
+    if seconds > t.get(key, 0):
+        t[key] = seconds
+
+def register_gauge(group, name, fn):
+    """
+    Register a function returning a current value e.g. the
+    number of records in a cache. It may return None if the
+    value isn't available
+
+    >>> reset()
+    >>> register_gauge('known', 'size', lambda: 42)
+    >>> register_gauge('known', 'bytes', lambda: None)
+    >>> snapshot()
+    {'known': {'size': 42}}
+    """
+    gauges[(group, name)] = fn
+
+def snapshot():
+    """
+    Current totals, as a dict of group -> name -> value
+    """
+    tables_lock.acquire()
+    try:
+        current = list(tables)
+    finally:
+        tables_lock.release()
+
+    totals = {}
+    for t in current:
+        for (group, name), value in t.items():
+            values = totals.setdefault(group, {})
+            if name.endswith('_max'):
+                values[name] = max(values.get(name, 0), value)
+            else:
+                values[name] = values.get(name, 0) + value
+
+    for (group, name), fn in gauges.items():
+        try:
+            value = fn()
+        except Exception:
+            value = None
+        if value is not None:
+            totals.setdefault(group, {})[name] = value
+
+    return totals
+
+def as_text(totals = None, prefix = 'urldammit'):
+    """
+    Render a snapshot as one "name value" line per counter,
+    for scrapers
+
+    >>> print as_text({'known': {'hits': 3, 'misses': 1}})
+    urldammit_known_hits 3
+    urldammit_known_misses 1
+    """
+    if totals is None:
+        totals = snapshot()
+    lines = []
+    groups = totals.keys()
+    groups.sort()
+    for group in groups:
+        names = totals[group].keys()
+        names.sort()
+        for name in names:
+            lines.append("%s_%s_%s %s" % (
+                prefix, group.replace('.', '_'), name, totals[group][name]
+                ))
+    return "\n".join(lines)
+
+def reset():
+    """
+    Zero all counters and forget gauges - for tests
+    """
+    tables_lock.acquire()
+    try:
+        for t in tables:
+            t.clear()
+    finally:
+        tables_lock.release()
+    gauges.clear()
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
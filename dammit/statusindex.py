@@ -0,0 +1,555 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A compact, read-only snapshot of what HEAD needs to answer for
+every URI - status, updated and, for 301s, the location - kept
+in a file that's memory mapped and binary searched, plus an
+in-memory dict of the changes made since it was written.
+
+The snapshot file holds, after a header and a 256 entry fan-out
+table (the number of digests with each first byte or less, as in
+git's pack indexes):
+
+    digests     N x 20 byte raw SHA-1 ids, sorted
+    statuses    N x unsigned short
+    updated     N x unsigned int - seconds since the epoch
+    locations   N x unsigned int - offset into the string table
+    strings     length prefixed 301 locations
+
+So each URI costs 30 bytes of file, plus its location if it's
+a 301, but only the pages touched by lookups are resident.
+
+Changes are merged into a new snapshot by merge(), a sequential
+walk of the old snapshot alongside the sorted changes, and the
+new file swapped in. start() runs that in a background thread,
+first pulling in records updated since the last catch up (less a
+margin) from the backend, so changes made by other processes are
+picked up too. Deletes by other processes (e.g. purge.py) are
+only seen when start() rebuilds the snapshot, every
+rebuild_interval seconds.
+"""
+import os, sys, time, mmap, struct, shutil, tempfile
+import threading, logging, calendar, datetime
+from binascii import hexlify, unhexlify
+import stats, sortedmerge
+
+MAGIC = 'UDSI'
+VERSION = 1
+
+HEADER = struct.Struct('>4sII')
+"""magic, version, number of entries"""
+
+FANOUT = struct.Struct('>256I')
+
+NO_LOCATION = 0xffffffff
+
+DEFAULT_MERGE_INTERVAL = 300
+"""Seconds between merges of the changes into the snapshot."""
+
+DEFAULT_REBUILD_INTERVAL = 24 * 60 * 60
+"""Seconds between rebuilds from the backend - 0 for never."""
+
+CATCH_UP_MARGIN = datetime.timedelta(seconds = 60)
+"""
+How far before the last catch up to look again - for updated
+times stored in whole seconds, clock skew between processes and
+writes landing while the backend was read.
+"""
+
+DEFAULT_CHUNK = 1000000
+"""Entries sorted in memory at once by rebuild()."""
+
+MISSING = object()
+
+class Status(object):
+    """
+    What the index knows about a URI - enough for
+    urldammit's HEAD, which treats it like a URI
+    """
+    __slots__ = ('id', 'status', 'updated', 'location')
+
+    def __init__(self, id, status, updated, location):
+        self.id = id
+        self.status = status
+        self.updated = updated
+        self.location = location
+
+def seconds(dt):
+    """
+    >>> seconds(datetime.datetime(2009, 1, 1, 12, 30, 15, 500))
+    1230813015
+    >>> seconds(None)
+    0
+    """
+    if dt is None:
+        return 0
+    return calendar.timegm(dt.timetuple())
+
+def to_datetime(seconds):
+    """
+    >>> to_datetime(1230813015)
+    datetime.datetime(2009, 1, 1, 12, 30, 15)
+    """
+    if not seconds:
+        return None
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+def to_entry(u):
+    """
+    ( digest, status, updated, location ) for a URI
+    """
+    location = None
+    if u.status == 301 and u.location:
+        location = u.location
+        if isinstance(location, unicode):
+            location = location.encode('utf-8')
+    return (unhexlify(u.id), u.status, seconds(u.updated), location)
+
+def to_status(entry):
+    digest, status, updated, location = entry
+    return Status(hexlify(digest), status, to_datetime(updated), location)
+
+def write(path, entries):
+    """
+    Write a snapshot of entries - ( digest, status, updated,
+    location ) tuples, sorted by digest - replacing path once
+    complete. Returns the number of entries
+
+    Each section is streamed to a temporary file first, so
+    nothing is held in memory. The snapshot is written to a
+    file of its own beside path, so writers sharing the path
+    can't interleave - the last rename wins
+    """
+    sections = [tempfile.TemporaryFile() for i in range(5)]
+    digests, statuses, times, locations, strings = sections
+    fanout = [0] * 256
+    count = 0
+    string_size = 0
+    for digest, status, updated, location in entries:
+        digests.write(digest)
+        statuses.write(struct.pack('>H', status))
+        times.write(struct.pack('>I', updated))
+        if location is None:
+            locations.write(struct.pack('>I', NO_LOCATION))
+        else:
+            locations.write(struct.pack('>I', string_size))
+            strings.write(struct.pack('>I', len(location)) + location)
+            string_size += 4 + len(location)
+        fanout[ord(digest[0])] += 1
+        count += 1
+
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path) or '.',
+                               prefix = os.path.basename(path) + '.')
+    out = os.fdopen(fd, 'wb')
+    try:
+        try:
+            out.write(HEADER.pack(MAGIC, VERSION, count))
+            out.write(FANOUT.pack(*fanout))
+            for section in sections:
+                section.seek(0)
+                shutil.copyfileobj(section, out, 1 << 20)
+                section.close()
+            out.flush()
+            os.fsync(out.fileno())
+        finally:
+            out.close()
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+    return count
+
+def merge_entries(entries, changes):
+    """
+    Walk sorted snapshot entries alongside sorted changes,
+    ( digest, entry or None to delete ), yielding the result
+
+    >>> old = [('a', 200, 0, None), ('c', 200, 0, None), ('d', 200, 0, None)]
+    >>> changes = [('b', ('b', 404, 0, None)), ('c', None), ('d', ('d', 301, 0, 'x'))]
+    >>> [e[:2] for e in merge_entries(old, changes)]
+    [('a', 200), ('b', 404), ('d', 301)]
+    """
+    changes = iter(changes)
+    change = next_or_none(changes)
+    for entry in entries:
+        while change and change[0] < entry[0]:
+            if change[1]:
+                yield change[1]
+            change = next_or_none(changes)
+        if change and change[0] == entry[0]:
+            if change[1]:
+                yield change[1]
+            change = next_or_none(changes)
+        else:
+            yield entry
+    while change:
+        if change[1]:
+            yield change[1]
+        change = next_or_none(changes)
+
+def next_or_none(iterator):
+    try:
+        return iterator.next()
+    except StopIteration:
+        return None
+
+class Snapshot(object):
+    """
+    A memory mapped snapshot file
+    """
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, version, count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a status index" % path)
+        self.count = count
+        self.fanout = FANOUT.unpack_from(self.map, HEADER.size)
+        self.digests = HEADER.size + FANOUT.size
+        self.statuses = self.digests + 20 * count
+        self.times = self.statuses + 2 * count
+        self.locations = self.times + 4 * count
+        self.strings = self.locations + 4 * count
+
+    def find(self, digest):
+        """
+        Position of digest, or -1
+        """
+        first = ord(digest[0])
+        lo = first and self.fanout[first - 1] or 0
+        hi = self.fanout[first]
+        m, base = self.map, self.digests
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + mid * 20
+            found = m[start:start + 20]
+            if found < digest:
+                lo = mid + 1
+            elif found > digest:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def entry(self, i):
+        m = self.map
+        start = self.digests + i * 20
+        status, = struct.unpack_from('>H', m, self.statuses + i * 2)
+        updated, = struct.unpack_from('>I', m, self.times + i * 4)
+        offset, = struct.unpack_from('>I', m, self.locations + i * 4)
+        location = None
+        if offset != NO_LOCATION:
+            offset += self.strings
+            length, = struct.unpack_from('>I', m, offset)
+            location = m[offset + 4:offset + 4 + length]
+        return (m[start:start + 20], status, updated, location)
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self.entry(i)
+
+    def __len__(self):
+        return self.count
+
+class StatusIndex(object):
+    """
+    >>> from uri import URI
+    >>> from db_mock import MockDB
+    >>> path = os.path.join(tempfile.mkdtemp(), 'status.idx')
+    >>> index = StatusIndex(path)
+    >>> def make(n, status, location = None):
+    ...     u = URI()
+    ...     u.uri = 'http://local.ch/%s.html' % n
+    ...     u.status = 200
+    ...     u.status = status
+    ...     if location: u.location = location
+    ...     u.updated = datetime.datetime(2009, 1, 1, 12, n)
+    ...     return u
+    >>> db = MockDB()
+    >>> for n in range(10):
+    ...     db.insert(make(n, 200))
+    >>> index.rebuild(db, chunk = 3)
+    10
+    >>> s = index.get(URI.hash('http://local.ch/4.html'))
+    >>> s.status, s.updated
+    (200, datetime.datetime(2009, 1, 1, 12, 4))
+    >>> print index.get(URI.hash('http://local.ch/10.html'))
+    None
+
+    Changes are seen straight away, then merged
+
+    >>> index.put(make(4, 301, 'http://local.ch/four.html'))
+    >>> index.delete(URI.hash('http://local.ch/5.html'))
+    >>> index.put(make(10, 404))
+    >>> index.get(URI.hash('http://local.ch/4.html')).location
+    'http://local.ch/four.html'
+    >>> print index.get(URI.hash('http://local.ch/5.html'))
+    None
+    >>> index.merge()
+    10
+    >>> len(index.changes), len(index.snapshot)
+    (0, 10)
+    >>> s = index.get(URI.hash('http://local.ch/4.html'))
+    >>> s.status, s.location
+    (301, 'http://local.ch/four.html')
+    >>> index.get(URI.hash('http://local.ch/10.html')).status
+    404
+    >>> print index.get(URI.hash('http://local.ch/5.html'))
+    None
+
+    Records updated in the backend since a time
+
+    >>> u = make(3, 404)
+    >>> u.updated = datetime.datetime(2009, 1, 2)
+    >>> db.update(u)
+    >>> index.catch_up(db, datetime.datetime(2009, 1, 1, 13))
+    1
+    >>> index.get(u.id).status
+    404
+
+    Reopening
+
+    >>> StatusIndex(path).get(URI.hash('http://local.ch/4.html')).status
+    301
+
+    Rebuilding drops changes the db doesn't have, e.g. records
+    another process has deleted
+
+    >>> index.put(make(12, 200))
+    >>> index.rebuild(db)
+    10
+    >>> print index.get(URI.hash('http://local.ch/12.html'))
+    None
+    >>> len(index.changes)
+    0
+
+    Each merge writes a file of its own, renamed over path
+
+    >>> other = StatusIndex(path)
+    >>> other.put(make(11, 200))
+    >>> other.merge(), index.merge()
+    (11, 10)
+    >>> print index.get(URI.hash('http://local.ch/11.html'))
+    None
+    >>> os.listdir(os.path.dirname(path))
+    ['status.idx']
+    """
+    def __init__(self, path):
+        self.path = path
+        self.changes = {}
+        self.lock = threading.Lock()
+        self.merging = threading.Lock()
+        self.snapshot = None
+        if os.path.exists(path):
+            self.snapshot = Snapshot(path)
+        stats.register_gauge('statusindex', 'entries', lambda: self.snapshot and len(self.snapshot))
+        stats.register_gauge('statusindex', 'changes', lambda: len(self.changes))
+
+    def get(self, id):
+        """
+        The Status for a SHA-1 id, or None if it's
+        not in the index
+        """
+        try:
+            digest = unhexlify(id)
+        except TypeError:
+            return None
+        entry = self.changes.get(digest, MISSING)
+        if entry is MISSING:
+            entry = None
+            snapshot = self.snapshot
+            if snapshot:
+                i = snapshot.find(digest)
+                if i >= 0:
+                    entry = snapshot.entry(i)
+        stats.lookup('statusindex', entry is not None)
+        if entry is None:
+            return None
+        return to_status(entry)
+
+    def put(self, u):
+        """
+        Record a stored URI
+        """
+        entry = to_entry(u)
+        self.lock.acquire()
+        try:
+            self.changes[entry[0]] = entry
+        finally:
+            self.lock.release()
+
+    def delete(self, id):
+        """
+        Record a deleted SHA-1 id
+        """
+        self.lock.acquire()
+        try:
+            self.changes[unhexlify(id)] = None
+        finally:
+            self.lock.release()
+
+    def merge(self):
+        """
+        Write a new snapshot with the changes so far, then swap
+        it in. Returns the number of entries
+        """
+        self.merging.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                changes = self.changes.items()
+            finally:
+                self.lock.release()
+            changes.sort()
+            entries = self.snapshot or []
+            count, snapshot = self._write(merge_entries(entries, changes))
+            self._swap(snapshot, changes)
+            return count
+        finally:
+            self.merging.release()
+
+    def rebuild(self, db, chunk = DEFAULT_CHUNK):
+        """
+        Write a new snapshot of every record in db, sorting
+        chunk records at a time. Changes recorded before it began
+        are dropped - the db has them, or has since deleted them.
+        Returns the number of entries
+        """
+        self.merging.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                superseded = self.changes.items()
+            finally:
+                self.lock.release()
+            tmp = tempfile.mkdtemp()
+            try:
+                parts = []
+                entries = []
+                for batch in db.recent(sys.maxint):
+                    entries.extend(to_entry(u) for u in batch)
+                    if len(entries) >= chunk:
+                        parts.append(self._write_part(tmp, len(parts), entries))
+                        entries = []
+                if entries or not parts:
+                    parts.append(self._write_part(tmp, len(parts), entries))
+                count, snapshot = self._write(sortedmerge.merge(*parts))
+            finally:
+                shutil.rmtree(tmp)
+            self._swap(snapshot, superseded)
+            return count
+        finally:
+            self.merging.release()
+
+    def catch_up(self, db, since):
+        """
+        Record every URI updated in db since the given time -
+        returns the number found
+        """
+        count = 0
+        for batch in db.recent(sys.maxint):
+            for u in batch:
+                if u.updated and u.updated < since:
+                    return count
+                self.put(u)
+                count += 1
+        return count
+
+    def _write_part(self, tmp, n, entries):
+        entries.sort()
+        path = os.path.join(tmp, '%s.idx' % n)
+        write(path, entries)
+        return Snapshot(path)
+
+    def _write(self, entries):
+        """
+        Write a snapshot of entries to a file of our own, map
+        it, and only then rename it to path - so the snapshot we
+        swap in is the one we wrote, even if another process
+        shares the path. Returns ( count, Snapshot )
+        """
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(self.path) or '.',
+                                   prefix = os.path.basename(self.path) + '.')
+        os.close(fd)
+        try:
+            count = write(tmp, entries)
+            snapshot = Snapshot(tmp)
+            os.rename(tmp, self.path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return count, snapshot
+
+    def _swap(self, snapshot, merged):
+        """
+        Swap in the new snapshot, then drop the changes it
+        holds, unless they've changed again meanwhile
+        """
+        self.lock.acquire()
+        try:
+            # the old snapshot isn't closed - lookups may be
+            # using it. It's unmapped once unreferenced
+            self.snapshot = snapshot
+            for digest, entry in merged:
+                if self.changes.get(digest, MISSING) is entry:
+                    del self.changes[digest]
+        finally:
+            self.lock.release()
+
+def start(index, db, interval = DEFAULT_MERGE_INTERVAL,
+          rebuild_interval = DEFAULT_REBUILD_INTERVAL):
+    """
+    Merge changes into the snapshot every interval seconds, in
+    a background thread, catching up with the backend before
+    each. The snapshot is rebuilt from the backend if there
+    isn't one, and then every rebuild_interval seconds (unless
+    that's 0). Returns the thread
+    """
+    def run():
+        # each catch up starts from when the last one (or the
+        # last rebuild) began, less CATCH_UP_MARGIN - a snapshot
+        # we reopen is as recent as the file
+        since = None
+        if index.snapshot is not None:
+            since = datetime.datetime.fromtimestamp(os.path.getmtime(index.path))
+        rebuilt = time.time()
+        while True:
+            try:
+                if index.snapshot is None or (rebuild_interval and
+                        time.time() - rebuilt >= rebuild_interval):
+                    began = datetime.datetime.now()
+                    count = index.rebuild(db)
+                    since, rebuilt = began, time.time()
+                else:
+                    count = index.merge()
+                logging.info("statusindex: %s entries", count)
+            except Exception, e:
+                logging.error("statusindex: merge failed: %s", e)
+            time.sleep(interval)
+            if since is None:
+                continue
+            try:
+                began = datetime.datetime.now()
+                index.catch_up(db, since - CATCH_UP_MARGIN)
+                since = began
+            except Exception, e:
+                logging.error("statusindex: catch up failed: %s", e)
+
+    thread = threading.Thread(target = run, name = 'statusindex')
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
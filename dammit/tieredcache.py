@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A small in-process cache in front of a shared one
+(e.g. memcached), so hot keys cost no network round trip
+"""
+from lrucache import LRUCache
+import cachemanager
+
+DEFAULT_LOCAL_SIZE = 1000
+DEFAULT_LOCAL_TTL = 5
+
+class TieredCache(object):
+    """
+    Reads try the local tier first, falling back to the shared
+    tier and remembering what it returned. Writes and deletes
+    go through to both tiers, so this process never sees its
+    own stale data. Changes made by other processes show up
+    once the local copy expires, hence the short local ttl.
+
+    >>> shared = {}
+    >>> tc = TieredCache(LRUCache(10, ttl = 60), shared)
+    >>> tc['foo'] = 'bar'
+    >>> shared['foo'], tc.local['foo']
+    ('bar', 'bar')
+    >>> shared['foo'] = 'changed elsewhere'
+    >>> tc['foo']
+    'bar'
+    >>> del tc.local['foo']
+    >>> tc['foo']
+    'changed elsewhere'
+    >>> 'foo' in tc.local
+    True
+    >>> del tc['foo']
+    >>> 'foo' in tc, 'foo' in shared
+    (False, False)
+    >>> tc['foo']
+    Traceback (most recent call last):
+    KeyError: 'foo'
+    >>> del tc['foo']
+    Traceback (most recent call last):
+    KeyError: 'foo'
+    >>> print tc.get('foo')
+    None
+
+    >>> tc.set('foo', 'bar', 60)
+    >>> shared['foo'], tc.local['foo']
+    ('bar', 'bar')
+    >>> del tc['foo']
+
+    >>> shared['a'] = 1
+    >>> tc.set_many({'b': 2})
+    >>> tc.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+    True
+    >>> tc.delete_many(['a', 'b'])
+    >>> shared, len(tc)
+    ({}, 0)
+    """
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def _get_ttl(self):
+        return getattr(self.shared, 'ttl', None)
+
+    def _set_ttl(self, ttl):
+        if hasattr(self.shared, 'ttl'):
+            self.shared.ttl = ttl
+
+    ttl = property(_get_ttl, _set_ttl, doc = "Time to live of the shared tier")
+
+    def _get_max_bytes(self):
+        return getattr(self.local, 'max_bytes', None)
+
+    def _set_max_bytes(self, limit):
+        self.local.max_bytes = limit
+
+    max_bytes = property(
+        _get_max_bytes, _set_max_bytes,
+        doc = "Memory budget of the local tier"
+        )
+
+    def __len__(self):
+        return len(self.local)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, val):
+        self.shared[key] = val
+        self.local[key] = val
+
+    def set(self, key, val, ttl = None):
+        """
+        Store with a ttl for the shared tier, where it supports
+        one - the local tier keeps its own short ttl
+        """
+        cachemanager.set_expiring(self.shared, key, val, ttl)
+        self.local[key] = val
+
+    def __getitem__(self, key):
+        val = self.get(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __delitem__(self, key):
+        found = True
+        try:
+            del self.local[key]
+        except KeyError:
+            found = False
+        try:
+            del self.shared[key]
+        except KeyError:
+            if not found:
+                raise
+
+    def get(self, key, default = None):
+        val = self.local.get(key)
+        if val is not None:
+            return val
+        val = self.shared.get(key)
+        if val is None:
+            return default
+        self.local[key] = val
+        return val
+
+    def add(self, key, val, ttl = 0):
+        """
+        Add to the shared tier only - see MemcachedWrapper.add.
+        With nothing shared to coordinate on, always succeeds
+        """
+        if hasattr(self.shared, 'add'):
+            return self.shared.add(key, val, ttl)
+        return True
+
+    def get_many(self, keys):
+        found = self.local.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            fetched = cachemanager.get_many(self.shared, missing)
+            self.local.set_many(fetched)
+            found.update(fetched)
+        return found
+
+    def set_many(self, mapping, ttl = None):
+        """
+        As set, ttl is for the shared tier only
+        """
+        cachemanager.set_many(self.shared, mapping, ttl)
+        self.local.set_many(mapping)
+
+    def delete_many(self, keys):
+        self.local.delete_many(keys)
+        cachemanager.delete_many(self.shared, keys)
+
+    def gauges(self):
+        """
+        For stats.register_gauge - the size of the local tier
+        """
+        gauges = {}
+        if hasattr(self.local, 'gauges'):
+            for name, fn in self.local.gauges().items():
+                gauges['local_' + name] = fn
+        return gauges
+
+    def __repr__(self):
+        return "TieredCache(%r, %r)" % (self.local, self.shared)
+
+def tiered_constructor(shared_constructor,
+                       size = DEFAULT_LOCAL_SIZE, ttl = DEFAULT_LOCAL_TTL):
+    """
+    Wrap a cache constructor (see cachemanager) so the caches
+    it creates get a local LRU tier of 'size' records, each
+    kept for at most 'ttl' seconds
+
+    >>> import cachemanager
+    >>> make = tiered_constructor(cachemanager.dict_constructor, 5, 1)
+    >>> tc = make('known')
+    >>> tc.local.size, tc.local.ttl, tc.shared
+    (5, 1, {})
+    """
+    def tiered_cache_constructor(namespace):
+        return TieredCache(
+            LRUCache(size, ttl = ttl, namespace = "%s.local" % namespace),
+            shared_constructor(namespace)
+            )
+    return tiered_cache_constructor
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import sys, datetime, sha, re, logging
+import sys, copy, datetime, sha, re, logging
 import constants
 
 def Property(function):
@@ -606,6 +606,109 @@ class URIManager(object):
         """
         return self.db.fresh_connection().load(id)
 
+    def load_many(self, ids):
+        """
+        Load many records given their IDs - returns a dict of
+        id -> URI for those found. Uses the backend's load_many
+        where it has one, else loads them one by one
+
+        >>> from db_mock import MockDB
+        >>> db = MockDB()
+        >>> um = URIManager(db)
+        >>> u = um.register('http://local.ch/many.html')
+        >>> um.load_many([u.id, 'foo']).keys() == [u.id]
+        True
+        """
+        return load_many(self.db.fresh_connection(), ids)
+
+    def by_status(self, status, limit, after = None):
+        """
+        A page of up to limit records with the status, most
+        recently updated first. after is the ( updated, id ) of
+        the last record on the previous page
+
+        >>> from db_mock import MockDB
+        >>> um = URIManager(MockDB())
+        >>> a = um.register('http://local.ch/a.html')
+        >>> b = um.register('http://local.ch/b.html')
+        >>> b = um.register('http://local.ch/b.html', 404)
+        >>> [u.uri for u in um.by_status(404, 10)]
+        ['http://local.ch/b.html']
+        >>> um.by_status(200, 10, (a.updated, a.id))
+        []
+        """
+        return self.db.fresh_connection().by_status(status, limit, after)
+
+    def by_tags(self, tags, limit, after = None, status = None,
+                match_any = False):
+        """
+        A page of up to limit records with all the tags - or any
+        of them with match_any - optionally only those with the
+        status, in id order. after is the id of the last record
+        on the previous page
+
+        >>> from db_mock import MockDB
+        >>> um = URIManager(MockDB())
+        >>> a = um.register('http://local.ch/a.html', tags = ['article'])
+        >>> b = um.register('http://local.ch/b.html', tags = ['article', 'news'])
+        >>> b = um.register('http://local.ch/b.html', 404)
+        >>> [u.uri for u in um.by_tags(['article'], 10, status = 404)]
+        ['http://local.ch/b.html']
+        >>> [u.uri for u in um.by_tags(['article', 'news'], 10)]
+        ['http://local.ch/b.html']
+        >>> len(um.by_tags(['news', 'article'], 10, match_any = True))
+        2
+        """
+        return self.db.fresh_connection().by_tags(
+            tags, limit, after, status, match_any
+            )
+
+    def store_many(self, uris):
+        """
+        Write URI objects as they are, e.g. for an import -
+        inserting those the backend doesn't have and updating
+        the rest. Uses one load_many then one insert_many and
+        one update_many call, where the backend has them.
+        Backend bookkeeping in the meta of stored records
+        (keys starting with '_' e.g. couch's _rev) is carried
+        over to the URIs being written
+
+        >>> from db_mock import MockDB
+        >>> db = MockDB()
+        >>> um = URIManager(db)
+        >>> u1 = um.register('http://local.ch/a.html', tags = ['a'])
+        >>> u1.meta['_rev'] = '1'
+        >>> uris = []
+        >>> for uri in ('http://local.ch/a.html', 'http://local.ch/b.html'):
+        ...     u = URI()
+        ...     u.uri = uri
+        ...     u.status = 200
+        ...     u.tags = ['imported']
+        ...     uris.append(u)
+        >>> um.store_many(uris)
+        >>> [um.load(u.id).tags for u in uris]
+        [['imported'], ['imported']]
+        >>> uris[0].meta['_rev']
+        '1'
+        """
+        db = self.db.fresh_connection()
+        stored = load_many(db, [u.id for u in uris])
+        new = []
+        existing = []
+        for u in uris:
+            if u.id in stored:
+                for k, v in stored[u.id].meta.items():
+                    if k.startswith('_'):
+                        u.meta.setdefault(k, v)
+                existing.append(u)
+            else:
+                new.append(u)
+
+        if new:
+            write_many(db, 'insert', new)
+        if existing:
+            write_many(db, 'update', existing)
+
     def register(self, uri, status = 200, **kwargs):
         """
         Store a record or a URI - handles update vs. insert
@@ -669,13 +772,112 @@ class URIManager(object):
         id = URI.hash(uri)
         db = self.db.fresh_connection()
 
-        u = db.load(id)
+        u, operation = self._apply(db.load(id), uri, status, kwargs)
+        if operation:
+            getattr(db, operation)(u)
+        return u
+
+    def register_many(self, registrations):
+        """
+        register for many URIs - registrations is a list of dicts
+        of register's arguments ('uri' required). Existing records
+        are loaded with one load_many, then written with one
+        insert_many and one update_many, where the backend has
+        them. Registrations of the same URI apply in order
+
+        Returns a list of ( URI, None ) or ( None, exception )
+        in the order of registrations - each URI a copy of the
+        record as that registration left it, as register would
+        have returned it
+
+        >>> from db_mock import MockDB
+        >>> db = MockDB()
+        >>> um = URIManager(db)
+        >>> a = um.register('http://local.ch/a.html', tags = ['a'])
+        >>> results = um.register_many([
+        ...     {'uri': 'http://local.ch/a.html', 'status': 404},
+        ...     {'uri': 'http://local.ch/b.html', 'status': 404},
+        ...     {'uri': 'http://local.ch/c.html', 'pairs': {'x': 'y'}},
+        ...     {'uri': 'http://local.ch/c.html', 'status': 301,
+        ...      'location': 'http://local.ch/d.html'},
+        ...     {'uri': 'http://local.ch/c.html', 'status': 200},
+        ...     {'status': 200},
+        ...     ])
+        >>> [u and (u.uri, u.status) for u, e in results]
+        [('http://local.ch/a.html', 404), None, ('http://local.ch/c.html', 200), ('http://local.ch/c.html', 301), ('http://local.ch/c.html', 301), None]
+        >>> results[2][0].pairs, results[2][0].location
+        ({'x': 'y'}, None)
+        >>> print results[1][1]
+        Cannot store 'http://local.ch/b.html' with status '404': no status 200 record found
+        >>> results[5][1]
+        KeyError('uri',)
+        >>> c = um.load(URI.hash('http://local.ch/c.html'))
+        >>> c.status, c.location, c.pairs
+        (301, 'http://local.ch/d.html', {'x': 'y'})
+        >>> um.load(a.id).tags
+        ['a']
+        """
+        db = self.db.fresh_connection()
+        # an id, or the exception hashing the uri raised
+        ids = []
+        for registration in registrations:
+            try:
+                ids.append(URI.hash(registration['uri']))
+            except Exception, e:
+                ids.append(e)
+        current = load_many(
+            db, list(set([id for id in ids if isinstance(id, str)]))
+            )
+
+        results = []
+        # id -> 'insert' or 'update', in the order first written
+        operations = {}
+        order = []
+        for registration, id in zip(registrations, ids):
+            if isinstance(id, Exception):
+                results.append((None, id))
+                continue
+            kwargs = dict(registration)
+            uri = kwargs.pop('uri')
+            status = kwargs.pop('status', 200)
+            try:
+                u, operation = self._apply(current.get(id), uri, status, kwargs)
+            except URIError, e:
+                results.append((None, e))
+                continue
+            current[id] = u
+            results.append((copy.deepcopy(u), None))
+            if operation and operations.get(id) != 'insert':
+                if id not in operations:
+                    order.append(id)
+                operations[id] = operation
+
+        failed = {}
+        for operation in ('insert', 'update'):
+            uris = [current[id] for id in order if operations[id] == operation]
+            for u, error in zip(uris, write_each(db, operation, uris)):
+                if error:
+                    failed[u.id] = error
+
+        if failed:
+            for i, (u, e) in enumerate(results):
+                if u and u.id in failed:
+                    results[i] = (None, failed[u.id])
+        return results
+
+    def _apply(self, u, uri, status, kwargs):
+        """
+        Apply a registration to the stored record u (or None)
+        by the rules of register - returns the URI and the
+        backend operation needed: 'insert', 'update' or None
+        """
         newrecord = True
+        kwargs = dict(kwargs)
 
         if u:
             if u.is_redirected():
                 # 301 is immutable - can return straight away
-                return u
+                return u, None
             newrecord = False
         else:
             if 200 <= status < 300:
@@ -716,13 +918,13 @@ class URIManager(object):
         if newrecord:
             u.created = now
             u.updated = now
-            db.insert(u)
-        else:
-            if updated:
-                u.updated = now
-                db.update(u)
+            return u, 'insert'
 
-        return u
+        if updated:
+            u.updated = now
+            return u, 'update'
+
+        return u, None
 
     def delete(self, id):
         """
@@ -738,6 +940,81 @@ class URIManager(object):
         """
         self.db.fresh_connection().delete(id)
 
+    def delete_many(self, ids):
+        """
+        Delete many records given their IDs, with the backend's
+        delete_many where it has one. Returns a list of
+        ( id, None ) or ( id, exception ) in the order of ids
+
+        >>> from db_mock import MockDB
+        >>> db = MockDB()
+        >>> um = URIManager(db)
+        >>> ids = [um.register('http://local.ch/%s.html' % n).id for n in 'ab']
+        >>> [e for id, e in um.delete_many(ids)]
+        [None, None]
+        >>> um.load_many(ids)
+        {}
+        """
+        db = self.db.fresh_connection()
+        return zip(ids, write_each(db, 'delete', ids))
+
+def load_many(db, ids):
+    """
+    A backend's load_many, or a loop over load if it has none
+    """
+    if hasattr(db, 'load_many'):
+        return db.load_many(ids)
+    found = {}
+    for id in ids:
+        u = db.load(id)
+        if u:
+            found[id] = u
+    return found
+
+def write_many(db, operation, uris):
+    """
+    Call a backend's insert_many / update_many (operation is
+    'insert' or 'update') or loop over insert / update if it
+    has no batch version
+    """
+    if hasattr(db, operation + '_many'):
+        getattr(db, operation + '_many')(uris)
+        return
+    method = getattr(db, operation)
+    for u in uris:
+        method(u)
+
+def write_each(db, operation, items):
+    """
+    As write_many, also for 'delete' (items are then ids), but
+    returns a list of the exception raised for each item, or
+    None where it was written. If a batch call fails, every
+    item in it gets the error
+
+    >>> class Backend(object):
+    ...     def delete(self, id):
+    ...         if id != 'a': raise KeyError(id)
+    >>> write_each(Backend(), 'delete', ['a', 'b'])
+    [None, KeyError('b',)]
+    """
+    method = getattr(db, operation + '_many', None)
+    if method:
+        try:
+            method(items)
+        except Exception, e:
+            return [e] * len(items)
+        return [None] * len(items)
+
+    method = getattr(db, operation)
+    errors = []
+    for item in items:
+        try:
+            method(item)
+            errors.append(None)
+        except Exception, e:
+            errors.append(e)
+    return errors
+
 def _test():
     import doctest
     doctest.testmod()
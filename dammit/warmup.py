@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Preload caches with the most recently updated records, so
+a freshly started process doesn't send every first request
+for a popular URI to the database
+"""
+import time, logging, threading
+import cachemanager, db_cache, stats
+
+DEFAULT_BATCH_SIZE = 500
+
+def warm(db, limit, store = None, batch_size = DEFAULT_BATCH_SIZE,
+         known = None):
+    """
+    Stream up to limit of the most recently updated records
+    from the backend in batches, filling the db cache and
+    passing each record to store (e.g. to fill urldammit's
+    'known' cache). Returns the number of records loaded
+
+    Only misses are filled - a request or update may have
+    cached a record since the batch was read, and that copy
+    is the fresher one. known, if given, is the cache store
+    fills, so records already in it aren't passed to store
+
+    Progress is logged per batch and counted in the
+    'warmup' group of the stats module
+
+    >>> import datetime
+    >>> from db_mock import MockDB
+    >>> from uri import URI
+    >>> stats.reset()
+    >>> cachemanager.register_cache_constructor(cachemanager.dict_constructor)
+    >>> db = MockDB()
+    >>> for i in range(5):
+    ...     u = URI()
+    ...     u.uri = 'http://local.ch/%s.html' % i
+    ...     u.status = 200
+    ...     u.updated = datetime.datetime(2009, 1, i + 1)
+    ...     db.insert(u)
+    >>> known = {}
+    >>> def store(u):
+    ...     known[u.id] = u
+    >>> warm(db, 3, store, batch_size = 2)
+    3
+    >>> sorted(u.uri for u in known.values())
+    ['http://local.ch/2.html', 'http://local.ch/3.html', 'http://local.ch/4.html']
+    >>> sorted(db_cache.get_cache().keys()) == sorted(known.keys())
+    True
+    >>> stats.snapshot()['warmup']['records']
+    3
+
+    Records already cached are left alone
+
+    >>> cache = db_cache.get_cache()
+    >>> newest = db.recent(1).next()[0]
+    >>> cache[newest.id] = 'fresher'
+    >>> known[newest.id] = 'fresher'
+    >>> warm(db, 3, store, batch_size = 2, known = known)
+    3
+    >>> cache[newest.id], known[newest.id]
+    ('fresher', 'fresher')
+    """
+    cache = db_cache.get_cache()
+    start = time.time()
+    count = 0
+    for batch in db.recent(limit, batch_size):
+        ids = [u.id for u in batch]
+        cached = cachemanager.get_many(cache, ids)
+        # an Absent marker is stale now the record exists
+        missing = dict(
+            (u.id, u) for u in batch if u.id not in cached
+            or isinstance(cached[u.id], db_cache.Absent)
+            )
+        if missing:
+            cachemanager.set_many(cache, missing)
+        if store:
+            if known is not None:
+                cached = cachemanager.get_many(known, ids)
+            else:
+                cached = {}
+            for u in batch:
+                if u.id not in cached:
+                    store(u)
+        count += len(batch)
+        stats.incr('warmup', 'records', len(batch))
+        logging.info(
+            "warmup: %s of %s records loaded in %.1fs",
+            count, limit, time.time() - start
+            )
+
+    elapsed = time.time() - start
+    stats.observe('warmup', 'run', elapsed)
+    logging.info("warmup: finished with %s records in %.1fs", count, elapsed)
+    return count
+
+def start(db, limit, store = None, batch_size = DEFAULT_BATCH_SIZE,
+          known = None):
+    """
+    Run warm() in a background thread, so startup isn't
+    held up - returns the thread
+    """
+    def run():
+        try:
+            warm(db, limit, store, batch_size, known)
+        except Exception, e:
+            logging.error("warmup: failed: %s", e)
+    
+    thread = threading.Thread(target = run, name = 'warmup')
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -269,6 +269,58 @@ class WebTests(unittest.TestCase):
             )
         self.assert_( response['content-location'] == uri)
 
+    def testReport(self):
+        self.body['uri'] = 'http://foobar.com/%s.html'\
+                           % sys._getframe().f_code.co_name
+        response, content = self._post()
+        self.assert_( response['status'] == '200' )
+
+        self._init_http()
+        self.body['status'] = '404'
+        response, content = self._post()
+        self.assert_( response['status'] == '200' )
+
+        self._init_http()
+        response, content = self.http.request(
+            '%s/_report/404?limit=1' % self.url, 'GET'
+            )
+        self.assert_( response['status'] == '200' )
+        self.assert_( self.body['uri'] in content )
+        self.assert_( '"next": "' in content )
+
+        self._init_http()
+        response, content = self.http.request(
+            '%s/_report/404?after=foo' % self.url, 'GET'
+            )
+        self.assert_( response['status'] == '400' )
+
+    def testFindByTags(self):
+        self.body['uri'] = 'http://foobar.com/%s.html'\
+                           % sys._getframe().f_code.co_name
+        self.body['tags'] = '["webtest","broken"]'
+        response, content = self._post()
+        self.assert_( response['status'] == '200' )
+
+        self._init_http()
+        del self.body['tags']
+        self.body['status'] = '404'
+        response, content = self._post()
+        self.assert_( response['status'] == '200' )
+
+        self._init_http()
+        response, content = self.http.request(
+            '%s/_tags/webtest,broken?status=404' % self.url, 'GET'
+            )
+        self.assert_( response['status'] == '200' )
+        self.assert_( self.body['uri'] in content )
+
+        self._init_http()
+        response, content = self.http.request(
+            '%s/_tags/webtest,nothere' % self.url, 'GET'
+            )
+        self.assert_( response['status'] == '200' )
+        self.assert_( self.body['uri'] not in content )
+        self.assert_( '"next": null' in content )
 
 
 
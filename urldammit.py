@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import urllib2, logging, re
+import simplejson
 import web
-from dammit import cachemanager
+from dammit import cachemanager, stats
 from dammit.request import *
 from dammit.uri import *
 from dammit.log import Log
@@ -16,11 +17,14 @@ urls = (
     '/_tools/?', 'tools',
     '/_tools/addurl', 'tools_addurl',
     '/_tools/checkurl', 'tools_checkurl',
+    '/_stats', 'statistics',
+    '/_report/([0-9]{3})', 'report',
+    '/_tags/([a-zA-Z0-9,]+)', 'tagged',
     '/([0-9a-f]{40})', 'urldammit',
     '/find/(.*)', 'find',
     )
 
-instances = {'manager': None, 'known': None, 'unknown': None}
+instances = {'manager': None, 'known': None, 'unknown': None, 'status': None}
 def make_instance_getter(key, fn):
     def get_instance():
         if instances[key] == None:
@@ -42,11 +46,49 @@ else:
     get_known = make_instance_getter('known', lambda: cachemanager.new_instance('known'))
     get_unknown = make_instance_getter('unknown', lambda: cachemanager.new_instance('unknown'))
 """
+
+# optional per-namespace time to live e.g. {'known': 300, 'unknown': 60}
+for namespace, ttl in getattr(config, 'cache_ttls', {}).items():
+    cachemanager.register_ttl(namespace, ttl)
+
+# optional memory budget in (estimated) bytes e.g. {'known': 64 << 20}
+for namespace, limit in getattr(config, 'cache_max_bytes', {}).items():
+    cachemanager.register_max_bytes(namespace, limit)
+
+# optional fixed memory negative cache e.g. {'capacity': 10000000}
+if getattr(config, 'unknown_bloom', None):
+    from dammit.bloomcache import BloomCache
+    cachemanager.register_cache_constructor(
+        lambda namespace: BloomCache(**config.unknown_bloom), 'unknown'
+        )
+
+# optional in-process tier in front of the shared cache
+# e.g. {'known': {'size': 10000, 'ttl': 5}}
+if getattr(config, 'local_caches', None):
+    from dammit.tieredcache import tiered_constructor
+    for namespace, options in config.local_caches.items():
+        cachemanager.register_cache_constructor(
+            tiered_constructor(
+                cachemanager.constructor_for(namespace), **options
+                ),
+            namespace
+            )
     
 get_manager = make_instance_getter('manager', lambda: URIManager(config.get_db()))
 get_known = make_instance_getter('known', lambda: cachemanager.new_instance('known'))
 get_unknown = make_instance_getter('unknown', lambda: cachemanager.new_instance('unknown'))
 
+# optional memory mapped index of every URI's status, answering
+# HEAD before any cache or the db e.g. {'path': '/var/lib/urldammit/status.idx'}
+# plus optional 'merge_interval' and 'rebuild_interval' in seconds
+def make_status_index():
+    options = getattr(config, 'status_index', None)
+    if not options:
+        return None
+    from dammit.statusindex import StatusIndex
+    return StatusIndex(options['path'])
+get_status_index = make_instance_getter('status', make_status_index)
+
 class urldammit(object):
     """
     Main service handler
@@ -70,15 +112,17 @@ class urldammit(object):
         if not id:
             return "where's my url dammit?"
 
-        u = self._locate(id)
+        entry = self._lookup(id)
         
-        if not u:
+        if not entry:
             return
+
+        u = entry.uri
         
         if not self._redirect(u):
             self._ok(u)
         
-        return self._render(u)
+        return entry.response()
 
     validstatus = re.compile("^200|301|404$")
     
@@ -141,21 +185,31 @@ class urldammit(object):
         See what we know about this uri...
         uri is in fact a SHA-1 hash of the uri
         """
-        def ithas(key, cache):
-            if key in cache:
-                return cache[key]
+        index = get_status_index()
+        if index:
+            status = index.get(id)
+            if status:
+                return status
+
+        entry = self._lookup(id)
+        if not entry:
             return None
+        return entry.uri
 
+    def _lookup(self, id):
+        """
+        As _locate but returns the Rendered entry from
+        the 'known' cache, holding the URI and its response
+        """
         unknown = get_unknown()
         known = get_known()
         
-        u = ithas(id, unknown)
-        if u:
+        if unknown.get(id):
             web.notfound()
             return None
 
-        u = ithas(id, known)
-        if not u:
+        entry = known.get(id)
+        if not entry:
             u = get_manager().load(id)
             
             
@@ -164,9 +218,9 @@ class urldammit(object):
                 web.notfound()
                 return None
             
-            known[id] = u
+            entry = remember(u)
         
-        return u
+        return entry
 
     def _store(self, uri, i):
         """
@@ -182,7 +236,6 @@ class urldammit(object):
         tags = unpack_tags(getattr(i, 'tags', []))
         pairs = unpack_pairs(getattr(i, 'pairs', {}))
         location = getattr(i, 'location', None)
-        known = get_known()
         unknown = get_unknown()
 
         try:
@@ -194,9 +247,14 @@ class urldammit(object):
                 location = location
                 )
 
-            known[u.id] = u
-            if u.id in unknown:
+            remember(u)
+            index = get_status_index()
+            if index:
+                index.put(u)
+            try:
                 del unknown[u.id]
+            except KeyError:
+                pass
 
             web.seeother("%s/%s" % (web.ctx.home, u.id))
             return
@@ -206,8 +264,13 @@ class urldammit(object):
 
     def _delete(self, id):
         known = get_known()
-        if id in known:
+        try:
             del known[id]
+        except KeyError:
+            pass
+        index = get_status_index()
+        if index:
+            index.delete(id)
         get_manager().delete(id)
 
     def _ok(self, u):
@@ -232,13 +295,6 @@ class urldammit(object):
         
         return False
 
-    def _render(self, u):
-        """
-        Display result, encoded as json
-        """
-        if not u: return
-        return pack_response(u)
-
     def _badrequest(self, msg):
         """
         Bad request (e.g. trying to record info on a status 404 url which
@@ -259,6 +315,125 @@ class find(object):
             "%s/%s" % ( web.ctx.home, URI.hash(url) )
             )
 
+class statistics(object):
+    """
+    Cache and backend counters - JSON by default,
+    or "name value" lines with ?format=text
+    """
+    def GET(self):
+        totals = stats.snapshot()
+        if getattr(web.input(), 'format', None) == 'text':
+            web.header('Content-Type', 'text/plain')
+            return stats.as_text(totals)
+        web.header('Content-Type', 'application/json')
+        return simplejson.dumps(totals)
+
+class listing(object):
+    """
+    Base for handlers returning a page of records as JSON -
+    {"uris": [...], "next": cursor}. The cursor is passed back
+    as ?after=... for the following page, and is null on the
+    last. ?limit=n sets the page size, up to MAX_LIMIT. The page
+    is written out a record at a time
+    """
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+
+    def _limit(self, i):
+        """
+        The page size asked for, or None if it's out of range
+        """
+        try:
+            limit = int(getattr(i, 'limit', self.DEFAULT_LIMIT))
+        except ValueError:
+            return None
+        if 0 < limit <= self.MAX_LIMIT:
+            return limit
+        return None
+
+    def _page(self, uris, cursor):
+        web.header('Content-Type', 'application/json')
+        return self._render(uris, cursor)
+
+    def _render(self, uris, cursor):
+        yield '{"uris": ['
+        for n, u in enumerate(uris):
+            if n:
+                yield ', '
+            yield pack_response(u)
+        yield '], "next": %s}' % simplejson.dumps(cursor)
+
+    def _badrequest(self, msg):
+        web.ctx.status = statusmap[400]
+        return view.badrequest(reason = msg)
+
+class report(listing):
+    """
+    Records with a given status, most recently updated first
+    e.g. /_report/404 for the broken URLs
+    """
+    def GET(self, status):
+        i = web.input()
+        limit = self._limit(i)
+        if not limit:
+            return self._badrequest("limit must be 1 to %s" % self.MAX_LIMIT)
+
+        after = getattr(i, 'after', None)
+        if after:
+            after = unpack_cursor(after)
+            if not after:
+                return self._badrequest("Bad value for after")
+
+        uris = get_manager().by_status(int(status), limit, after)
+        cursor = None
+        if len(uris) == limit:
+            cursor = pack_cursor(uris[-1])
+        return self._page(uris, cursor)
+
+class tagged(listing):
+    """
+    Records with all the given (comma separated) tags, in id
+    order e.g. /_tags/article,news - or with any of them with
+    ?match=any. ?status=404 keeps only the broken ones
+    """
+    MAX_TAGS = 10
+    validid = re.compile('^[0-9a-f]{40}$')
+
+    def GET(self, tags):
+        i = web.input()
+        tags = unique([tag for tag in tags.split(',') if tag])
+        if not tags or len(tags) > self.MAX_TAGS:
+            return self._badrequest("1 to %s tags required" % self.MAX_TAGS)
+        for tag in tags:
+            if not URI.validtag.match(tag):
+                return self._badrequest("Bad value for tag: '%s'" % tag)
+
+        match = getattr(i, 'match', 'all')
+        if not match in ('all', 'any'):
+            return self._badrequest("match must be all or any")
+
+        status = getattr(i, 'status', None)
+        if status is not None:
+            if not urldammit.validstatus.match(status):
+                return self._badrequest("Bad value for status: '%s'" % status)
+            status = int(status)
+
+        limit = self._limit(i)
+        if not limit:
+            return self._badrequest("limit must be 1 to %s" % self.MAX_LIMIT)
+
+        after = getattr(i, 'after', None)
+        if after and not self.validid.match(after):
+            return self._badrequest("Bad value for after")
+
+        uris = get_manager().by_tags(
+            tags, limit, after or None, status, match == 'any'
+            )
+        cursor = None
+        if len(uris) == limit:
+            cursor = uris[-1].id
+        return self._page(uris, cursor)
+
 class tools:
     """
     Tools for humans...
@@ -308,7 +483,86 @@ def required(input, key):
     return val
 
 
+def unique(items):
+    """
+    The items without repeats, in their first order
+    """
+    seen = set()
+    found = []
+    for item in items:
+        if not item in seen:
+            seen.add(item)
+            found.append(item)
+    return found
+
+def count_cache_calls(handler):
+    """
+    Processor reporting the number of calls made to
+    shared caches while handling the request, in an
+    X-Cache-Calls header e.g. "known=1, unknown=1"
+    """
+    cachemanager.reset_calls()
+    try:
+        return handler()
+    finally:
+        counts = cachemanager.call_counts().items()
+        counts.sort()
+        web.header(
+            'X-Cache-Calls',
+            ", ".join("%s=%s" % (k, v) for k, v in counts)
+            )
+
+def forget(ids):
+    """
+    Drop purged records from the 'known' cache and
+    the status index
+    """
+    cachemanager.delete_many(get_known(), ids)
+    index = get_status_index()
+    if index:
+        for id in ids:
+            index.delete(id)
+
+def remember(u):
+    """
+    Put a record in the 'known' cache, along with its
+    rendered response - returns the cache entry
+    """
+    entry = Rendered(u)
+    get_known()[u.id] = entry
+    return entry
+
 if __name__ == '__main__':
     application = web.application(urls, globals())
+    application.add_processor(count_cache_calls)
+    if getattr(config, 'warmup_records', None):
+        from dammit import warmup
+        warmup.start(
+            get_manager().db.fresh_connection(),
+            config.warmup_records,
+            remember,
+            known = get_known()
+            )
+    if get_status_index():
+        from dammit import statusindex
+        statusindex.start(
+            get_status_index(),
+            get_manager().db.fresh_connection(),
+            config.status_index.get(
+                'merge_interval', statusindex.DEFAULT_MERGE_INTERVAL
+                ),
+            config.status_index.get(
+                'rebuild_interval', statusindex.DEFAULT_REBUILD_INTERVAL
+                )
+            )
+    # optional scheduled purge of stale records
+    # e.g. {'retention': {404: 180}, 'interval': 86400}
+    if getattr(config, 'purge', None):
+        from dammit import purge
+        purge.start(
+            get_manager().db.fresh_connection(),
+            forget = forget,
+            **config.purge
+            )
     application.run(Log)
 